@@ -0,0 +1,47 @@
+from __future__ import print_function
+import argparse, os, time
+from wormhole import transit
+
+# Run this as 'python misc/bench-transit-ciphers.py' to compare the transit
+# cipher suites. For each record size, it encrypts and then decrypts the
+# same amount of data with each suite that this host supports (AES-256-GCM
+# needs AES-NI or similar), and reports the throughput of each direction.
+# The suite that two peers settle on is the first one in the sender's list
+# that the receiver also supports, and that list is in the order shown here.
+
+def bench(suite_class, record_size, total):
+    key = os.urandom(32)
+    suite = suite_class(key)
+    plaintext = os.urandom(record_size)
+    count = max(1, total // record_size)
+    start = time.time()
+    encrypted = [suite.encrypt(plaintext, suite.NONCE.pack(n))
+                 for n in range(count)]
+    encrypt_time = time.time() - start
+    start = time.time()
+    for e in encrypted:
+        suite.decrypt(e)
+    decrypt_time = time.time() - start
+    nbytes = count * record_size
+    return nbytes / encrypt_time / 1e6, nbytes / decrypt_time / 1e6
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--total", type=int, default=64,
+                   help="MiB of records per suite and record size")
+    args = p.parse_args()
+    total = args.total * 1024 * 1024
+
+    available = transit.available_cipher_suites()
+    for suite_class in transit.CIPHER_SUITES:
+        if suite_class not in available:
+            print("%s: not available on this host" % suite_class.name)
+    for record_size in [16 * 1024, 256 * 1024, 4 * 1024 * 1024]:
+        print("%dKiB records" % (record_size // 1024))
+        for suite_class in available:
+            enc, dec = bench(suite_class, record_size, total)
+            print("  %-18s encrypt %8.1f MB/s  decrypt %8.1f MB/s"
+                  % (suite_class.name, enc, dec))
+
+if __name__ == "__main__":
+    main()
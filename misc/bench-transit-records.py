@@ -0,0 +1,157 @@
+from __future__ import print_function
+import argparse, struct, time
+from binascii import hexlify
+from nacl.secret import SecretBox
+from wormhole import transit
+
+# Run this as 'python misc/bench-transit-records.py' to measure how fast the
+# transit record decoder can pull records out of TCP reads. Each scenario is
+# run twice: once through the old "self.buf += data, then slice records off
+# the front" algorithm (reimplemented here, since it no longer exists in
+# transit.py), and once through transit.RecordBuffer. The "copied" column
+# counts the bytes that were copied by the decoder itself (not counting the
+# copy the kernel makes, or the one SecretBox makes while decrypting).
+#
+# Use --decrypt to push the same reads through a real transit.Connection,
+# which measures the whole inbound path (framing, nonce check, decryption).
+# Add --framing=2 to use framing-v2 records, which leave the nonce out.
+
+class LegacyDecoder:
+    def __init__(self):
+        self.buf = b""
+        self.records = []
+        self.bytes_copied = 0
+
+    def feed(self, data):
+        self.buf += data
+        self.bytes_copied += len(self.buf)
+        while True:
+            if len(self.buf) < 4:
+                return
+            length = int(hexlify(self.buf[:4]), 16)
+            if len(self.buf) < 4 + length:
+                return
+            encrypted, self.buf = self.buf[4:4 + length], self.buf[4 + length:]
+            self.bytes_copied += len(encrypted) + len(self.buf)
+            self.records.append(encrypted)
+
+class NewDecoder:
+    def __init__(self):
+        self._rb = transit.RecordBuffer()
+        self.records = []
+
+    @property
+    def bytes_copied(self):
+        return self._rb.bytes_copied
+
+    def feed(self, data):
+        self._rb.feed(data)
+        while self._rb.records:
+            self.records.append(self._rb.records.popleft())
+
+class FakeOwner:
+    framing = 1
+    def _framing(self):
+        return self.framing
+    def _sender_record_key(self, stripe=0):
+        return b"s" * 32
+    def _receiver_record_key(self, stripe=0):
+        return b"r" * 32
+    def _max_record_size(self):
+        return None
+    def _crypto_runner(self):
+        return None
+    def _cipher_suite(self):
+        return transit.XSalsa20Poly1305
+
+class FakeTransport:
+    def write(self, data):
+        pass
+    def loseConnection(self):
+        pass
+
+class ConnectionDecoder:
+    # a real Connection, already past negotiation
+    def __init__(self):
+        owner = FakeOwner()
+        owner.framing = FRAMING
+        c = transit.Connection(owner, None, None, "bench")
+        c.transport = FakeTransport()
+        c._negotiation_d.addErrback(lambda f: None)
+        c._negotiationSuccessful()
+        self.records = []
+        c.recordReceived = self.records.append
+        self._c = c
+
+    @property
+    def bytes_copied(self):
+        return self._c._inbound.bytes_copied
+
+    def feed(self, data):
+        self._c.dataReceived(data)
+
+FRAMING = 1
+
+def build_stream(record_size, total):
+    box = SecretBox(b"r" * 32)
+    plaintext = b"\x00" * record_size
+    chunks = []
+    count = max(1, total // record_size)
+    for n in range(count):
+        nonce = b"\x00" * 16 + struct.pack(">Q", n)
+        encrypted = box.encrypt(plaintext, nonce)
+        if FRAMING == 2:
+            encrypted = encrypted.ciphertext
+        chunks.append(struct.pack(">L", len(encrypted)) + encrypted)
+    return b"".join(chunks), count
+
+def split(stream, read_size):
+    return [stream[i:i + read_size]
+            for i in range(0, len(stream), read_size)]
+
+def run(decoder_class, reads, expected):
+    d = decoder_class()
+    start = time.time()
+    for r in reads:
+        d.feed(r)
+    elapsed = time.time() - start
+    assert len(d.records) == expected, (len(d.records), expected)
+    return elapsed, d.bytes_copied
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--total", type=int, default=16,
+                   help="MiB of records per scenario")
+    p.add_argument("--decrypt", action="store_true",
+                   help="feed a real Connection, including decryption")
+    p.add_argument("--framing", type=int, choices=[1, 2], default=1,
+                   help="record format (framing-v2 omits the nonce)")
+    args = p.parse_args()
+    global FRAMING
+    FRAMING = args.framing
+    total = args.total * 1024 * 1024
+
+    scenarios = [
+        # (record size, read size, description)
+        (16 * 1024, 1448, "fragmented: 16KiB records, 1448B reads"),
+        (16 * 1024, 64 * 1024, "16KiB records, 64KiB reads"),
+        (16 * 1024, 4 * 1024 * 1024, "coalesced: 16KiB records, 4MiB reads"),
+        (1024, 4 * 1024 * 1024, "coalesced: 1KiB records, 4MiB reads"),
+        (1024 * 1024, 1448, "fragmented: 1MiB records, 1448B reads"),
+        ]
+    decoders = [("legacy", LegacyDecoder), ("RecordBuffer", NewDecoder)]
+    if args.decrypt:
+        decoders.append(("Connection", ConnectionDecoder))
+
+    for record_size, read_size, desc in scenarios:
+        stream, count = build_stream(record_size, total)
+        reads = split(stream, read_size)
+        print(desc)
+        for name, decoder_class in decoders:
+            elapsed, copied = run(decoder_class, reads, count)
+            print("  %-13s %10.0f records/s %8.1f MB/s  copied %.2fx (%d B)"
+                  % (name, count / elapsed, len(stream) / elapsed / 1e6,
+                     copied / float(len(stream)), copied))
+
+if __name__ == "__main__":
+    main()
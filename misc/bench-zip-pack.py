@@ -0,0 +1,100 @@
+from __future__ import print_function
+import argparse, os, shutil, tempfile, time, zipfile
+from binascii import hexlify
+from wormhole.cli import zipstream
+
+# Run this as 'python misc/bench-zip-pack.py' to measure how fast 'wormhole
+# send' can pack a directory into a zipfile. It builds a few synthetic trees
+# in a temporary directory (many small files, a few huge ones, and a mix),
+# then packs each of them with zipstream.ZipStream at several --jobs
+# settings, and once with the stdlib's ZipFile for comparison. Rates are in
+# files (and MB of uncompressed data) per second. The trees are built from
+# hex digits, which compress about 2:1, so zlib has real work to do.
+#
+# Use --scale to make the trees bigger or smaller, and --jobs to pick which
+# thread counts to try.
+
+def fill(fn, size):
+    with open(fn, "wb") as f:
+        while size:
+            n = min(size, 1024 * 1024)
+            f.write(hexlify(os.urandom((n + 1) // 2))[:n])
+            size -= n
+
+def build_tree(base, top, count, size):
+    files = []
+    for i in range(count):
+        subdir = os.path.join(base, top, "d%03d" % (i // 1000))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        fn = os.path.join(subdir, "f%d" % i)
+        fill(fn, size)
+        files.append((fn, os.path.relpath(fn, base)))
+    return files
+
+def pack_zipstream(files, jobs):
+    zs = zipstream.ZipStream(files, jobs=jobs)
+    while zs.read(zipstream.CHUNK_SIZE):
+        pass
+    return zs.tell()
+
+class Counter(object):
+    def __init__(self):
+        self.size = 0
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+    def flush(self):
+        pass
+
+def pack_zipfile(files):
+    # (unseekable output needs py3.6 or newer)
+    out = Counter()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+        for (localfilename, archivename) in files:
+            zf.write(localfilename, archivename)
+    return out.size
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--scale", type=float, default=1.0,
+                   help="multiply the size of each tree by this much")
+    p.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8],
+                   help="thread counts to try")
+    args = p.parse_args()
+
+    scenarios = [
+        # (description, [(count, size), ..])
+        ("many small files: 20000x 2KB", [(20000, 2000)]),
+        ("a few huge files: 4x 64MB", [(4, 64 * 1000 * 1000)]),
+        ("mixed: 5000x 10KB, 2x 32MB", [(5000, 10000), (2, 32000000)]),
+        ]
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for desc, parts in scenarios:
+            files = []
+            base = os.path.join(tmp, desc.split(":")[0].replace(" ", "-"))
+            for n, (count, size) in enumerate(parts):
+                files.extend(build_tree(base, str(n),
+                                        max(1, int(count * args.scale)),
+                                        size))
+            total = sum(os.stat(fn).st_size for (fn, _) in files)
+            print("%s (%d files, %.1f MB)" % (desc, len(files), total / 1e6))
+            runs = [("jobs=%d" % jobs, lambda jobs=jobs:
+                     pack_zipstream(files, jobs))
+                    for jobs in args.jobs]
+            runs.append(("ZipFile", lambda: pack_zipfile(files)))
+            for name, run in runs:
+                start = time.time()
+                zipsize = run()
+                elapsed = time.time() - start
+                print("  %-8s %10.1f files/s %8.1f MB/s  zipfile %.1f MB"
+                      % (name, len(files) / elapsed, total / elapsed / 1e6,
+                         zipsize / 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+
+from ..util import bytes_to_hexstr
+from .merkle import _leaf_hasher
+from .sparse import ExtentReader, ExtentWriter
+
+
+class ChunkCache(object):
+    """I keep chunks of received files in a directory, each named by its
+    hash (the leaf hash from a ChunkTree), so a later transfer of a file
+    that shares some of them can skip those. Using a chunk marks it as
+    recently used (by its mtime), and evict() removes the least recently
+    used ones until the rest fit in 'max_size' bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+
+    def _chunk_path(self, hash_alg, digest):
+        # (spread across subdirectories, so none of them gets too big)
+        hexdigest = bytes_to_hexstr(digest)
+        return os.path.join(self._path, hexdigest[:2],
+                            "%s-%s" % (hash_alg, hexdigest))
+
+    def fill(self, f, tree):
+        """Write each chunk of 'tree' that I have into 'f', where it
+        belongs, and return their indexes."""
+        held = []
+        for (index, leaf) in enumerate(tree.leaves):
+            path = self._chunk_path(tree.hash_alg, leaf)
+            try:
+                with open(path, "rb") as chunk:
+                    data = chunk.read()
+                os.utime(path, None)
+            except EnvironmentError:
+                continue
+            if len(data) != tree.chunk_length(index):
+                continue
+            f.seek(index * tree.chunk_size)
+            f.write(data)
+            held.append(index)
+        return held
+
+    def store(self, f, tree, skip=()):
+        """Add the chunks of 'f' (a whole file, described by 'tree') that
+        I don't have yet, except for the indexes in 'skip', then evict. A
+        chunk that doesn't match its hash is left out. Returns how many
+        chunks were added."""
+        skip = set(skip)
+        stored = 0
+        for (index, leaf) in enumerate(tree.leaves):
+            path = self._chunk_path(tree.hash_alg, leaf)
+            if index in skip or os.path.exists(path):
+                continue
+            f.seek(index * tree.chunk_size)
+            data = f.read(tree.chunk_length(index))
+            hasher = _leaf_hasher(tree.hash_alg)
+            hasher.update(data)
+            if hasher.digest() != leaf:
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # (written under another name, so nobody sees half a chunk)
+            (fd, tmp_path) = tempfile.mkstemp(
+                prefix=".tmp-", dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as chunk:
+                chunk.write(data)
+            os.rename(tmp_path, path)
+            stored += 1
+        self.evict()
+        return stored
+
+    def discard(self, hash_alg, digest):
+        path = self._chunk_path(hash_alg, digest)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        chunks = []
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(self._path):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except EnvironmentError:
+                    continue  # (evicted by someone else)
+                chunks.append((st.st_mtime, path, st.st_size))
+                total += st.st_size
+        chunks.sort()
+        for (mtime, path, size) in chunks:
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+            total -= size
+
+
+def _gaps(tree, skip):
+    # the (offset, length) of each run of chunks that aren't in 'skip'
+    gaps = []
+    for index in range(len(tree.leaves)):
+        if index in skip:
+            continue
+        offset = index * tree.chunk_size
+        length = tree.chunk_length(index)
+        if gaps and sum(gaps[-1]) == offset:
+            gaps[-1] = (gaps[-1][0], gaps[-1][1] + length)
+        else:
+            gaps.append((offset, length))
+    return gaps
+
+
+class ChunkSkipper(ExtentReader):
+    """I look like a file (enough for a FileSender), whose contents are
+    the chunks of 'f' (described by 'tree') that aren't in 'skip', one
+    after another."""
+
+    def __init__(self, f, tree, skip):
+        ExtentReader.__init__(self, f, _gaps(tree, set(skip)))
+
+
+class GapWriter(ExtentWriter):
+    """I am the other end of a ChunkSkipper: my write() is given the
+    chunks of the file that aren't in 'skip', in order, and writes each
+    one into 'f' where it belongs."""
+
+    def __init__(self, f, tree, skip):
+        ExtentWriter.__init__(self, f, _gaps(tree, set(skip)))
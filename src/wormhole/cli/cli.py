@@ -4,7 +4,7 @@ import os
 import time
 start = time.time()
 
-from sys import stderr, stdout  # noqa: E402
+from sys import stderr, stdin, stdout  # noqa: E402
 from textwrap import dedent, fill  # noqa: E402
 
 import click  # noqa: E402
@@ -35,6 +35,7 @@ class Config(object):
         # we're exercising the defaults.
         self.timing = DebugTiming()
         self.cwd = os.getcwd()
+        self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
         self.tor = False  # XXX?
@@ -185,6 +186,35 @@ CommonArgs = _compose(
         default=True,
         help="(debug) don't open a listening socket for Transit",
     ),
+    click.option(
+        "--crypto-threads",
+        default=0,
+        type=click.IntRange(0),
+        metavar="N",
+        help="encrypt/decrypt file data on N threads (0: in the main thread)",
+    ),
+    click.option(
+        "--spool-max-size",
+        default=10 * 1000 * 1000,
+        type=click.IntRange(1),
+        metavar="BYTES",
+        help="hold up to BYTES of a zipfile in memory, then move it to disk",
+    ),
+    click.option(
+        "--spool-dir",
+        default=None,
+        type=click.Path(exists=True, file_okay=False, path_type=type(u"")),
+        metavar="DIRNAME",
+        help="where to put zipfiles that don't fit in memory",
+    ),
+    click.option(
+        "--jobs",
+        "-j",
+        default=1,
+        type=click.IntRange(1),
+        metavar="N",
+        help="compress directories, or hash chunks, on N threads at once",
+    ),
 )
 
 TorArgs = _compose(
@@ -236,12 +266,63 @@ def help(context, **kwargs):
     default=False,
     is_flag=True,
     help="Don't raise an error if a file can't be read.")
-@click.argument("what", required=False, type=click.Path(path_type=type(u"")))
+@click.option(
+    "--compress",
+    default=False,
+    is_flag=True,
+    help="compress file data in transit (if the receiver can decompress it)",
+)
+@click.option(
+    "--stripes",
+    default=1,
+    type=click.IntRange(1, 8),
+    metavar="N",
+    help="spread file data across up to N connections at once",
+)
+@click.option(
+    "--prehash",
+    default=False,
+    is_flag=True,
+    help=("hash the file while waiting for the receiver, so it can check what"
+          " it gets (a big file takes longer to start sending)"),
+)
+@click.option(
+    "--chunk-hashes",
+    default=False,
+    is_flag=True,
+    help=("hash the file in chunks while waiting for the receiver, so it can"
+          " check each chunk as it arrives"),
+)
+@click.option(
+    "--sparse",
+    default=False,
+    is_flag=True,
+    help=("don't send blocks of zeros in a file, even where they take up"
+          " disk space (holes are always skipped)"),
+)
+@click.option(
+    "--manifest",
+    default=False,
+    is_flag=True,
+    help=("list a directory's files and their hashes in the offer, so a"
+          " receiver with an older copy can ask for just the changed files"),
+)
+@click.option(
+    "--stream",
+    default=False,
+    is_flag=True,
+    help=("send stdin as it arrives, without reading it all first, to a"
+          " 'wormhole receive --stream'"),
+)
+@click.argument("what", nargs=-1, type=click.Path(path_type=type(u"")))
 @click.pass_obj
-def send(cfg, **kwargs):
-    """Send a text message, file, or directory"""
+def send(cfg, what, **kwargs):
+    """Send a text message, file, directory, or several files"""
     for name, value in kwargs.items():
         setattr(cfg, name, value)
+    # several files are sent one after another, without a zipfile
+    cfg.what = what[0] if len(what) == 1 else None
+    cfg.files = list(what) if len(what) > 1 else None
     with cfg.timing.add("import", which="cmd_send"):
         from . import cmd_send
 
@@ -270,6 +351,33 @@ def go(f, cfg):
     is_flag=True,
     help="accept file transfer without asking for confirmation",
 )
+@click.option(
+    "--chunk-cache",
+    default=None,
+    type=click.Path(file_okay=False, path_type=type(u"")),
+    metavar="DIRNAME",
+    help=("keep chunks of received files here, and skip the ones it has"
+          " (when the sender uses --chunk-hashes)"),
+)
+@click.option(
+    "--chunk-cache-size",
+    default=10 * 1000 * 1000 * 1000,
+    type=click.IntRange(1),
+    metavar="BYTES",
+    help="evict the least recently used chunks beyond this many BYTES",
+)
+@click.option(
+    "--delta",
+    is_flag=True,
+    help=("update an existing file or directory of the same name, fetching"
+          " only the parts of it that changed"),
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help=("write what a 'wormhole send --stream' sends to stdout, as it"
+          " arrives (the code must be given here too)"),
+)
 @click.option(
     "--output-file",
     "-o",
@@ -301,6 +409,11 @@ def receive(cfg, code, **kwargs):
         raise SystemExit(1)
     else:
         cfg.code = None
+    if cfg.stream and not (cfg.code or cfg.zeromode):
+        # (the prompt would end up in the stream)
+        print("--stream writes to stdout, so pass the code as well",
+              file=cfg.stderr)
+        raise SystemExit(1)
 
     return go(cmd_receive.receive, cfg)
 
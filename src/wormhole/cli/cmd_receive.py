@@ -1,30 +1,39 @@
 from __future__ import print_function
 
+import base64
 import hashlib
+import json
 import os
 import shutil
 import sys
 import tempfile
-import zipfile
 
 import six
 from humanize import naturalsize
 from tqdm import tqdm
-from twisted.internet import reactor
+from twisted.internet import error, reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from wormhole import __version__, create, input_with_completion
 
 from ..errors import TransferError
-from ..transit import TransitReceiver
-from ..util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
-                    estimate_free_space)
+from ..transit import StripedFileConsumer, TransitReceiver
+from ..util import (SpoolFile, ThreadedHasher, bytes_to_dict,
+                    bytes_to_hexstr, choose_hash_algorithm, dict_to_bytes,
+                    estimate_free_space, hash_file_prefix, new_hasher)
+from . import chunkcache, delta, manifest, merkle, sparse
 from .welcome import handle_welcome
+from .zipstream import ZipExtractor
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 
 KEY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_KEY_TIMER", 1.0))
 VERIFY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_VERIFY_TIMER", 1.0))
+# the ways we can receive a directory, which senders see in our versions
+DIRECTORY_MODES = [u"zipfile/deflated", u"zipfile/stream"]
+# the biggest file we'll take inside the offer (senders see this in our
+# versions): it arrives through the mailbox, without a transit connection
+INLINE_MAX_SIZE = 32 * 1024
 
 
 class RespondError(Exception):
@@ -37,6 +46,10 @@ class TransferRejectedError(RespondError):
         RespondError.__init__(self, "transfer rejected")
 
 
+class ConnectionDroppedError(TransferError):
+    pass
+
+
 def receive(args, reactor=reactor, _debug_stash_wormhole=None):
     """I implement 'wormhole receive'. I return a Deferred that fires with
     None (for success), or signals one of the following errors:
@@ -59,6 +72,32 @@ class Receiver:
         self._reactor = reactor
         self._tor = None
         self._transit_receiver = None
+        self._record_pipe = None
+        self._striper = None
+        self._attempt = 0  # how many times the sender has reconnected
+        self._resumable = False
+        self._offset = 0  # everything before this is in place, and hashed
+        self._hash_alg = None  # None means sha256, for older senders
+        self._hasher = hashlib.sha256()
+        self._expected_hash = None  # hex, if the sender hashed it up front
+        self._identity = {}  # what tells the sender's file apart from others
+        self._wants_digest = False  # the sender's hash follows the data
+        self._chunk_tree = None  # if the sender hashed it in chunks
+        self._verifier = None
+        self._skips_chunks = False  # the sender can skip chunks we have
+        self._cached = None  # the chunks we found in the chunk cache
+        self._extents = None  # the data around the file's holes
+        self._sparse = False  # receiving just those
+        self._inline = None  # the file's data, if it came in the offer
+        self._files = None  # (path, name, size) of each of several files
+        self._updating = False  # the destination exists, and we'll update it
+        self._delta = False  # sending just the changes to a file
+        self._manifest = None  # the sender's list of a directory's files
+        self._wanted = None  # the ones we don't have
+        self._checkpoint_name = None
+        self._checkpoint = None
+        self._staging_dir = None
+        self._scratch = None
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stderr, **kwargs)
@@ -82,6 +121,12 @@ class Receiver:
             self.args.appid or APPID,
             self.args.relay_url,
             self._reactor,
+            versions={
+                u"directory-modes": DIRECTORY_MODES,
+                u"multiple-files": True,
+                u"stream": True,
+                u"inline-files": INLINE_MAX_SIZE,
+            },
             tor=self._tor,
             timing=self.args.timing)
         self._w = w  # so tests can wait on events too
@@ -110,6 +155,7 @@ class Receiver:
         # as the original one)
         @inlineCallbacks
         def _bad(f):
+            self._abort_transit()
             try:
                 yield w.close()  # might be an error too
             except Exception:
@@ -243,12 +289,22 @@ class Receiver:
             no_listen=(not self.args.listen),
             tor=self._tor,
             reactor=self._reactor,
-            timing=self.args.timing)
+            timing=self.args.timing,
+            crypto_threads=self.args.crypto_threads,
+            cipher_suites=True,
+            framing_v2=True,
+            accept_compressed=True,
+            stripes=TransitReceiver.MAX_STRIPES)
         self._transit_receiver = tr
-        transit_key = w.derive_key(APPID + u"/transit-key",
-                                   tr.TRANSIT_KEY_LENGTH)
+        purpose = APPID + u"/transit-key"
+        if self._attempt:
+            # record nonces start over on every connection, so every
+            # reconnection needs a key of its own
+            purpose += u"/%d" % self._attempt
+        transit_key = w.derive_key(purpose, tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
@@ -264,20 +320,64 @@ class Receiver:
         if "message" in them_d:
             self._handle_text(them_d, w)
             returnValue(None)
+        if self.args.stream and "stream" not in them_d:
+            self._msg(u"Error: --stream was given, but the sender isn't "
+                      u"sending a stream")
+            raise RespondError("the receiver only takes a stream "
+                               "('wormhole send --stream')")
         # transit will be created by this point, but not connected
         if "file" in them_d:
             f = self._handle_file(them_d)
+            if self._inline is not None:
+                self._write_inline(f, w)
+                returnValue(None)
+            yield self._resume_from_checkpoint(f)
+            if self._delta:
+                yield self._sign_basis()
+            elif (self._chunk_cache() is not None and self._skips_chunks and
+                  self._chunk_tree is not None and not self._offset):
+                yield self._fill_from_cache(f)
+            if (self._extents is not None and not self._delta and
+                    not self._cached and not self._offset):
+                # the sender can skip the file's holes. We don't keep track
+                # of which parts arrived, so this can't be resumed.
+                self._sparse = True
+                self._resumable = False
+            try:
+                self._send_permission(w)
+                rp, datahash = yield self._receive_data(w, f)
+            finally:
+                if self._verifier is not None:
+                    self._verifier.close()
+            yield self._check_datahash(rp, datahash, f)
+            if (self._chunk_cache() is not None and
+                    self._chunk_tree is not None):
+                yield self._store_in_cache(f)
+            self._write_file(f)
+            yield self._close_transit(rp, datahash)
+        elif "files" in them_d:
+            self._handle_files(them_d)
             self._send_permission(w)
             rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_file(f)
+            datahash = yield self._transfer_files(rp)
             yield self._close_transit(rp, datahash)
-        elif "directory" in them_d:
-            f = self._handle_directory(them_d)
+        elif "stream" in them_d:
+            self._handle_stream(them_d)
             self._send_permission(w)
             rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_directory(f)
+            datahash = yield self._transfer_stream(rp)
+            yield self._close_transit(rp, datahash)
+        elif "directory" in them_d:
+            f = self._handle_directory(them_d)
+            try:
+                if self._manifest is not None:
+                    yield self._compare_manifest()
+                self._send_permission(w)
+                rp, datahash = yield self._receive_data(w, f)
+                self._write_directory(f)
+            finally:
+                if os.path.exists(self._staging_dir):
+                    shutil.rmtree(self._staging_dir)
             yield self._close_transit(rp, datahash)
         else:
             self._msg(u"I don't know what they're offering\n")
@@ -292,9 +392,39 @@ class Receiver:
 
     def _handle_file(self, them_d):
         file_data = them_d["file"]
-        self.abs_destname = self._decide_destname("file",
-                                                  file_data["filename"])
+        formats = file_data.get("delta")
+        # (an inline file replaces the whole of our old copy)
+        update = bool(self.args.delta and (
+            "inline" in file_data or
+            (isinstance(formats, list) and delta.FORMAT in formats)))
+        self.abs_destname = self._decide_destname(
+            "file", file_data["filename"], update)
+        # (there's nothing to update if we don't have it yet)
+        self._delta = self._updating
         self.xfersize = file_data["filesize"]
+        if "inline" in file_data:
+            self._inline = self._decode_inline(file_data["inline"])
+        # a delta is built from the whole of our old copy, so it can't be
+        # resumed, and is checked by the final hash alone
+        self._resumable = bool(file_data.get("resumable")) and not self._delta
+        expected = file_data.get("sha256")
+        if isinstance(expected, type(u"")) and len(expected) == 64:
+            # we can check the file ourselves, before putting it in place
+            self._expected_hash = expected.lower()
+        if "merkle" in file_data and not self._delta:
+            try:
+                self._chunk_tree = merkle.ChunkTree.from_dict(
+                    file_data["merkle"], self.xfersize)
+            except ValueError as e:
+                # we'll still have the hash in the final ack
+                log.msg("ignoring the sender's chunk hashes: %s" % (e, ))
+            self._skips_chunks = file_data.get("cached_chunks") is True
+        if "extents" in file_data and not self._delta:
+            try:
+                self._extents = sparse.parse_extents(file_data["extents"],
+                                                     self.xfersize)
+            except ValueError as e:
+                log.msg("ignoring the sender's extents: %s" % (e, ))
         free = estimate_free_space(self.abs_destname)
         if free is not None and free < self.xfersize:
             self._msg(u"Error: insufficient free space (%sB) for file (%sB)" %
@@ -306,41 +436,278 @@ class Receiver:
                    os.path.basename(self.abs_destname)))
         self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
-        return open(tmp_destname, "wb")
+        self._checkpoint_name = tmp_destname + ".checkpoint"
+        self._identity = self._file_identity(file_data)
+        self._checkpoint = self._load_checkpoint()
+        self._pick_hash_alg(file_data)
+        # (a striped transfer reads back what it wrote, to hash it)
+        if self._checkpoint is not None:
+            return open(tmp_destname, "r+b")
+        if os.path.exists(self._checkpoint_name):
+            os.remove(self._checkpoint_name)  # about to be truncated
+        return open(tmp_destname, "w+b")
+
+    def _decode_inline(self, encoded):
+        # a small file can come in the offer itself
+        try:
+            data = base64.b64decode(encoded.encode("ascii"))
+        except (AttributeError, TypeError, ValueError):
+            raise RespondError("bad inline file")
+        if len(data) != self.xfersize or len(data) >= INLINE_MAX_SIZE:
+            raise RespondError("bad inline file")
+        return data
+
+    def _write_inline(self, f, w):
+        # the file came with the offer, so our answer is also the ack
+        hasher = new_hasher(self._hash_alg or u"sha256")
+        hasher.update(self._inline)
+        with self.args.timing.add("rx inline", bytes=len(self._inline)):
+            f.write(self._inline)
+            self._write_file(f)
+        answer = {"file_ack": "ok"}
+        answer.update(self._ack(hasher.digest()))
+        self._send_data({"answer": answer}, w)
+
+    def _file_identity(self, file_data):
+        # A checkpoint must come from the same file, not just one with the
+        # same name and size: its mtime, or (better) its hash, says which
+        # one it was. Without either, we can't resume a later transfer.
+        identity = {}
+        mtime = file_data.get("mtime")
+        if (isinstance(mtime, six.integer_types) and
+                not isinstance(mtime, bool)):
+            identity["mtime"] = mtime
+        if self._expected_hash is not None:
+            identity["file_sha256"] = self._expected_hash
+        return identity
+
+    def _load_checkpoint(self):
+        # a previous 'wormhole receive' of this file might have lost its
+        # connection, leaving the partial file behind, with a note of how
+        # much of it is good
+        if not self._resumable or not self._identity:
+            return None
+        try:
+            with open(self._checkpoint_name, "r") as f:
+                checkpoint = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+        if not isinstance(checkpoint, dict):
+            return None
+        offset = checkpoint.get("offset")
+        if (checkpoint.get("filesize") != self.xfersize or
+                not isinstance(offset, six.integer_types) or
+                not 0 < offset <= self.xfersize):
+            return None
+        shared = [key for key in self._identity if key in checkpoint]
+        if not shared or any(checkpoint[key] != self._identity[key]
+                             for key in shared):
+            # it isn't from this file, or the file has changed since
+            return None
+        return checkpoint
+
+    @inlineCallbacks
+    def _resume_from_checkpoint(self, f):
+        checkpoint = self._checkpoint
+        if checkpoint is None:
+            return
+        # we can't save a hasher's state, so rebuild it from the
+        # partial file, which also tells us if that file was changed. This
+        # reads the whole thing, so keep it off the reactor thread.
+        offset = checkpoint["offset"]
+        hasher = self._new_hasher()
+        with self.args.timing.add("rehash partial file"):
+            hashed = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                hash_file_prefix, f, offset, hasher)
+        digest = checkpoint.get("digest")
+        if hashed == offset and bytes_to_hexstr(hasher.digest()) == digest:
+            self._offset = offset
+            self._hasher = hasher
+            # the start of the file came from an earlier transfer, so unless
+            # the sender hashed the file up front, we ask for its hash at the
+            # end, to check the whole thing before we keep it
+            self._wants_digest = self._expected_hash is None
+            self._msg(u"Resuming, %s already received" % naturalsize(offset))
+            return
+        self._msg(u"Partial file doesn't match its checkpoint, starting over")
+        f.seek(0)
+        f.truncate()
+
+    def _pick_hash_alg(self, file_data):
+        # The sender lists the hashes it can check our ack with. Older ones
+        # don't, and only know sha256, which is also what a pre-hashed
+        # file needs. If we have a checkpoint, its hash (if offered) lets
+        # us resume it.
+        offered = file_data.get("hash_algs")
+        if isinstance(offered, list):
+            if self._expected_hash is not None:
+                offered = [a for a in offered if a == u"sha256"]
+            if self._checkpoint is not None:
+                old = self._checkpoint.get("hash_alg", u"sha256")
+                if old in offered:
+                    offered = [old]
+            self._hash_alg = choose_hash_algorithm(offered)
+        self._hasher = self._new_hasher()
+
+    def _new_hasher(self):
+        # when the sender hashed the file up front, we check the data
+        # against that, and hash it on a thread, out of the reactor's way
+        if self._hash_alg is None:
+            hasher = hashlib.sha256()
+        else:
+            hasher = new_hasher(self._hash_alg)
+        if self._expected_hash is not None:
+            return ThreadedHasher(hasher)
+        return hasher
+
+    @inlineCallbacks
+    def _check_datahash(self, record_pipe, datahash, f):
+        if self._expected_hash is None:
+            return
+        if isinstance(self._hasher, ThreadedHasher):
+            self._hasher.close()
+        if bytes_to_hexstr(datahash) == self._expected_hash:
+            return
+        self._discard_file(f)
+        yield self._close_transit(record_pipe, datahash)  # they'll see too
+        raise TransferError("received data doesn't match the sender's hash")
+
+    def _discard_file(self, f):
+        # don't keep it, or a checkpoint that would resume it
+        tmp_name = f.name
+        f.close()
+        os.remove(tmp_name)
+        if os.path.exists(self._checkpoint_name):
+            os.remove(self._checkpoint_name)
+
+    def _save_checkpoint(self):
+        checkpoint = {
+            "filesize": self.xfersize,
+            "offset": self._offset,
+            "hash_alg": self._hash_alg or u"sha256",
+            "digest": bytes_to_hexstr(self._hasher.digest()),
+        }
+        checkpoint.update(self._identity)
+        with open(self._checkpoint_name, "w") as f:
+            json.dump(checkpoint, f)
+
+    def _handle_files(self, them_d):
+        # several files, which are written one at a time, each with the
+        # same rules as a single file
+        files_data = them_d["files"]
+        entries = files_data.get("files")
+        if not isinstance(entries, list) or not entries:
+            raise RespondError("bad list of files")
+        if self.args.output_file:
+            self._msg(u"Error: can't write several files to --output-file")
+            raise TransferRejectedError()
+        self._files = []
+        for entry in entries:
+            if (not isinstance(entry, list) or len(entry) != 2 or
+                    not isinstance(entry[0], six.string_types) or
+                    not isinstance(entry[1], six.integer_types) or
+                    isinstance(entry[1], bool) or entry[1] < 0):
+                raise RespondError("bad list of files")
+            (name, size) = entry
+            path = self._decide_destname("file", name)
+            if path in [p for (p, n, s) in self._files]:
+                raise RespondError("more than one file named %r" % (name, ))
+            self._files.append((path, name, size))
+        self.xfersize = sum(size for (path, name, size) in self._files)
+        self.abs_destname = None
+        free = estimate_free_space(self.args.cwd)
+        if free is not None and free < self.xfersize:
+            self._msg(u"Error: insufficient free space (%sB) for files (%sB)"
+                      % (free, self.xfersize))
+            raise TransferRejectedError()
+
+        self._msg(u"Receiving %d files (%s): %s" %
+                  (len(self._files), naturalsize(self.xfersize),
+                   u", ".join(os.path.basename(path)
+                              for (path, name, size) in self._files)))
+        self._ask_permission()
+        offered = files_data.get("hash_algs")
+        if not isinstance(offered, list):
+            offered = []
+        # (the sender can always check a sha256)
+        self._hash_alg = choose_hash_algorithm(offered) or u"sha256"
+        self._hasher = new_hasher(self._hash_alg)
+
+    def _handle_stream(self, them_d):
+        # stdin from the sender, of unknown size, which goes to our stdout
+        # as it arrives. Asking for --stream was the permission (and a
+        # prompt would land in the stream), and nothing is written to disk.
+        if not self.args.stream:
+            self._msg(u"Error: the sender is sending a stream, which needs "
+                      u"'wormhole receive --stream'")
+            raise RespondError("the receiver didn't ask for a stream "
+                               "('wormhole receive --stream')")
+        self._msg(u"Receiving a stream, to stdout")
+        offered = them_d["stream"].get("hash_algs")
+        if not isinstance(offered, list):
+            offered = []
+        # (the sender can always check a sha256)
+        self._hash_alg = choose_hash_algorithm(offered) or u"sha256"
+        self._hasher = new_hasher(self._hash_alg)
 
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
         zipmode = file_data["mode"]
-        if zipmode != "zipfile/deflated":
+        if zipmode not in DIRECTORY_MODES:
             self._msg(u"Error: unknown directory-transfer mode '%s'" %
                       (zipmode, ))
             raise RespondError("unknown mode")
-        self.abs_destname = self._decide_destname("directory",
-                                                  file_data["dirname"])
-        self.xfersize = file_data["zipsize"]
+        if (self.args.delta and "manifest" in file_data and
+                zipmode == u"zipfile/stream"):
+            try:
+                self._manifest = manifest.Manifest.from_dict(
+                    file_data["manifest"])
+            except ValueError as e:
+                log.msg("ignoring the sender's manifest: %s" % (e, ))
+        self.abs_destname = self._decide_destname(
+            "directory", file_data["dirname"], self._manifest is not None)
+        if not self._updating:
+            self._manifest = None
+        # a zipfile/stream is built as it is sent, so its size isn't known
+        # until it ends
+        self.xfersize = file_data.get("zipsize")
+        # the zipfile only lives as long as the sender does, so this can be
+        # resumed on a new connection, but not by a new 'wormhole receive'
+        self._resumable = bool(file_data.get("resumable"))
+        # (when updating, we don't know how much of it we'll need yet)
         free = estimate_free_space(self.abs_destname)
-        if free is not None and free < file_data["numbytes"]:
+        if (free is not None and free < file_data["numbytes"] and
+                not self._updating):
             self._msg(
                 u"Error: insufficient free space (%sB) for directory (%sB)" %
                 (free, file_data["numbytes"]))
             raise TransferRejectedError()
 
-        self._msg(u"Receiving directory (%s) into: %s/" %
-                  (naturalsize(self.xfersize),
-                   os.path.basename(self.abs_destname)))
+        if self.xfersize is None:
+            self._msg(u"Receiving directory into: %s/" %
+                      (os.path.basename(self.abs_destname), ))
+        else:
+            self._msg(u"Receiving directory (%s) into: %s/" %
+                      (naturalsize(self.xfersize),
+                       os.path.basename(self.abs_destname)))
         self._msg(u"%d files, %s (uncompressed)" %
                   (file_data["numfiles"], naturalsize(file_data["numbytes"])))
         self._ask_permission()
-        f = tempfile.SpooledTemporaryFile()
-        # workaround for https://bugs.python.org/issue26175 (STF doesn't
-        # fully implement IOBase abstract class), which breaks the new
-        # zipfile in py3.7.0 that expects .seekable
-        if not hasattr(f, "seekable"):
-            # AFAICT all the filetypes that STF wraps can seek
-            f.seekable = lambda: True
-        return f
-
-    def _decide_destname(self, mode, destname):
+        self._pick_hash_alg(file_data)
+        # Unpack each file as it arrives, into a directory that gets renamed
+        # into place once the whole zipfile has arrived. It lives in a
+        # private staging directory, next to the destination (so the rename
+        # won't cross filesystems), and is created with the usual
+        # permissions.
+        self._staging_dir = tempfile.mkdtemp(
+            prefix=".wormhole-", dir=os.path.dirname(self.abs_destname))
+        extract_dir = os.path.join(self._staging_dir,
+                                   os.path.basename(self.abs_destname))
+        os.mkdir(extract_dir)
+        return ZipExtractor(extract_dir, self._extract_path)
+
+    def _decide_destname(self, mode, destname, update=False):
         # the basename() is intended to protect us against
         # "~/.ssh/authorized_keys" and other attacks
         destname = os.path.basename(destname)
@@ -350,7 +717,12 @@ class Receiver:
 
         # get confirmation from the user before writing to the local directory
         if os.path.exists(abs_destname):
-            if self.args.output_file:  # overwrite is intentional
+            same_kind = os.path.isfile if mode == "file" else os.path.isdir
+            if update and same_kind(abs_destname):
+                # (changed only once the new version has arrived)
+                self._updating = True
+                self._msg(u"Updating '%s'" % destname)
+            elif self.args.output_file:  # overwrite is intentional
                 self._msg(u"Overwriting '%s'" % destname)
                 if self.args.accept_file:
                     self._remove_existing(abs_destname)
@@ -371,7 +743,9 @@ class Receiver:
             while True and not self.args.accept_file:
                 ok = six.moves.input("ok? (y/N): ")
                 if ok.lower().startswith("y"):
-                    if os.path.exists(self.abs_destname):
+                    if (self.abs_destname is not None and
+                            os.path.exists(self.abs_destname) and
+                            not self._updating):
                         self._remove_existing(self.abs_destname)
                     break
                 print(u"transfer rejected", file=sys.stderr)
@@ -380,83 +754,635 @@ class Receiver:
             t.detail(answer="yes")
 
     def _send_permission(self, w):
-        self._send_data({"answer": {"file_ack": "ok"}}, w)
+        answer = {"file_ack": "ok"}
+        if self._hash_alg is not None:
+            # the hash our ack will use
+            answer["hash_alg"] = self._hash_alg
+        if self._resumable:
+            # tell the sender where to start
+            answer["offset"] = self._offset
+        if self._wants_digest:
+            # and to follow the data with its hash
+            answer["send_digest"] = True
+        if self._delta:
+            # ask for just the changes
+            answer["delta"] = {
+                "format": delta.FORMAT,
+                "block_size": self._block_size,
+                "blocks": len(self._signatures) // delta.DIGEST_SIZE,
+            }
+        if self._wanted is not None:
+            # the files (by their place in the manifest) that we need
+            answer["files"] = self._wanted
+        if self._cached:
+            # the chunks (by their place in the tree) that we don't need
+            answer["cached_chunks"] = self._cached
+        if self._sparse:
+            # we'll leave the holes out
+            answer["sparse"] = True
+        self._send_data({"answer": answer}, w)
+
+    def _chunk_cache(self):
+        path = getattr(self.args, "chunk_cache", None)
+        if path is None:
+            return None
+        return chunkcache.ChunkCache(path, self.args.chunk_cache_size)
+
+    @inlineCallbacks
+    def _fill_from_cache(self, f):
+        # copy the chunks that we already have into place, so the sender
+        # can skip them. This can't be resumed, since we won't know which
+        # parts of the file arrived.
+        tree = self._chunk_tree
+        with self.args.timing.add("fill from cache") as t:
+            held = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                self._chunk_cache().fill, f, tree)
+            t.detail(cached_chunks=len(held))
+        if held:
+            self._cached = held
+            self._resumable = False
+            self._msg(u"%d of %d chunks were in the chunk cache" %
+                      (len(held), len(tree.leaves)))
+
+    @inlineCallbacks
+    def _store_in_cache(self, f):
+        with self.args.timing.add("store in cache") as t:
+            stored = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                self._chunk_cache().store, f, self._chunk_tree,
+                self._cached or ())
+            t.detail(stored_chunks=stored)
+
+    @inlineCallbacks
+    def _compare_manifest(self):
+        # find the files that we don't have, or have a different version of
+        with self.args.timing.add("compare manifest") as t:
+            self._wanted = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                manifest.missing, self._manifest, self.abs_destname,
+                self._extract_path, self.args.jobs)
+            t.detail(wanted=len(self._wanted))
+        self._msg(u"%d of %d files are new or changed" %
+                  (len(self._wanted), len(self._manifest.entries)))
+
+    @inlineCallbacks
+    def _sign_basis(self):
+        # hash each block of our old copy, so the sender can leave out
+        # the ones we already have
+        self._basis_size = os.stat(self.abs_destname).st_size
+        self._block_size = delta.block_size_for(self._basis_size)
+        with self.args.timing.add("sign old file"):
+            self._signatures = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                delta.signatures, self.abs_destname, self._block_size,
+                self._hash_alg or u"sha256")
+
+    @inlineCallbacks
+    def _receive_data(self, w, f):
+        # (a delta, a file with holes or cached chunks, or one followed by
+        # its hash, comes in order on a single connection)
+        striped = not (self._delta or self._cached or self._sparse or
+                       self._wants_digest)
+        while True:
+            rp = yield self._establish_transit(striped)
+            try:
+                datahash = yield self._transfer_data(rp, f)
+            except ConnectionDroppedError:
+                if not self._resumable:
+                    raise
+            else:
+                returnValue((rp, datahash))
+            self._msg(u"Waiting for the sender to reconnect..")
+            yield self._reconnect_transit(w)
+            self._send_permission(w)
+
+    @inlineCallbacks
+    def _reconnect_transit(self, w):
+        # the sender starts again with a new transit message. If it gives
+        # up instead, it sends an error, and _get_data raises TransferError.
+        while True:
+            them_d = yield self._get_data(w)
+            if u"transit" in them_d and u"reconnect" in them_d:
+                attempt = them_d[u"reconnect"].get(u"attempt")
+                if (not isinstance(attempt, six.integer_types) or
+                        attempt <= self._attempt):
+                    raise TransferError("bad reconnect attempt %r" %
+                                        (attempt, ))
+                self._attempt = attempt
+                self._abort_transit()
+                yield self._build_transit(w, them_d[u"transit"])
+                return
+            log.msg("unrecognized message %r" % (them_d, ))
 
     @inlineCallbacks
-    def _establish_transit(self):
-        record_pipe = yield self._transit_receiver.connect()
+    def _establish_transit(self, striped=False):
+        # Unless the transfer is striped, it only uses the first connection,
+        # and the rest are closed as they arrive. The transfer must
+        # _finish_transit() when it's done with it, whether or not it worked.
+        tr = self._transit_receiver
+        record_pipe = yield tr.connect()
+        self._record_pipe = record_pipe
         self.args.timing.add("transit connected")
+        if not striped:
+            tr.stop_striping()
+            tr.observe_stripes(lambda p: p.close())
         returnValue(record_pipe)
 
+    def _abort_transit(self):
+        # we're giving up on this connection (and any stripes of it), and on
+        # listening for more
+        record_pipe, self._record_pipe = self._record_pipe, None
+        striper, self._striper = self._striper, None
+        if record_pipe is not None:
+            record_pipe.close()
+        if striper is not None:
+            striper.close()
+        if self._transit_receiver is not None:
+            self._transit_receiver.stop_listening()
+
+    def _progress(self, **kwargs):
+        return tqdm(
+            file=self.args.stderr,
+            disable=self.args.hide_progress,
+            unit="B",
+            unit_scale=True,
+            **kwargs)
+
+    def _finish_transit(self, record_pipe, event):
+        # We're done with listening for more connections. The one we have
+        # stays open for our ack (or is closed once we give up).
+        self._transit_receiver.stop_listening()
+        stats = record_pipe.compression_stats()
+        if stats:
+            event.detail(**stats)
+
     @inlineCallbacks
     def _transfer_data(self, record_pipe, f):
+        if self._delta:
+            datahash = yield self._transfer_delta(record_pipe, f)
+            returnValue(datahash)
+        if self._cached:
+            datahash = yield self._transfer_uncached(record_pipe, f)
+            returnValue(datahash)
+        if self._sparse:
+            datahash = yield self._transfer_sparse(record_pipe, f)
+            returnValue(datahash)
         # now receive the rest of the owl
         self._msg(u"Receiving (%s).." % record_pipe.describe())
+        # after a reconnection, the sender picks up where we left off. A
+        # stream (of unknown size) marks its own end.
+        remaining = None
+        if self.xfersize is not None:
+            remaining = self.xfersize - self._offset
 
-        with self.args.timing.add("rx file"):
-            progress = tqdm(
-                file=self.args.stderr,
-                disable=self.args.hide_progress,
-                unit="B",
-                unit_scale=True,
-                total=self.xfersize)
-            hasher = hashlib.sha256()
-            with progress:
-                received = yield record_pipe.writeToFile(
-                    f, self.xfersize, progress.update, hasher.update)
-            datahash = hasher.digest()
+        t = self.args.timing.add("rx file")
+        try:
+            with t:
+                (received, dropped) = yield self._receive_file(
+                    record_pipe, f, remaining, t)
+                self._offset += received
+                if self._verifier is not None:
+                    self._verifier.flush()
+                    t.detail(chunks_checked=self._verifier.checked)
+        finally:
+            self._finish_transit(record_pipe, t)
 
-        # except TransitError
-        if received < self.xfersize:
+        if self._verifier is not None and self._verifier.bad_chunk is not None:
+            self._discard_file(f)
+            raise RespondError("chunk %d of the file doesn't match the "
+                               "sender's hash" % self._verifier.bad_chunk)
+        if dropped:
+            f.seek(self._offset)
+            if self._checkpoint_name and self._identity:
+                self._save_checkpoint()
             self._msg()
             self._msg(u"Connection dropped before full file received")
-            self._msg(u"got %d bytes, wanted %d" % (received, self.xfersize))
-            raise TransferError("Connection dropped before full file received")
-        assert received == self.xfersize
+            if self.xfersize is None:
+                self._msg(u"got %d bytes" % (self._offset, ))
+            else:
+                self._msg(u"got %d bytes, wanted %d" %
+                          (self._offset, self.xfersize))
+            raise ConnectionDroppedError(
+                "Connection dropped before full file received")
+        assert remaining is None or received == remaining
+        if self._wants_digest:
+            yield self._receive_digest(record_pipe)
+        returnValue(self._hasher.digest())
+
+    @inlineCallbacks
+    def _receive_digest(self, record_pipe):
+        # the sender's hash of the whole file, which _check_datahash()
+        # compares with ours before the file is put in place
+        try:
+            record = yield record_pipe.receive_record()
+        except error.ConnectionClosed:
+            raise ConnectionDroppedError(
+                "Connection dropped before the sender's hash arrived")
+        try:
+            digest = bytes_to_dict(record).get("digest")
+        except (AttributeError, ValueError):
+            digest = None
+        if not isinstance(digest, type(u"")):
+            record_pipe.close()
+            raise RespondError("bad hash record from sender")
+        self._expected_hash = digest.lower()
+
+    @inlineCallbacks
+    def _receive_file(self, record_pipe, f, remaining, t):
+        # this fires with (received, dropped): how much arrived, and
+        # whether the connection was lost before the end
+        progress = self._progress(initial=self._offset, total=self.xfersize)
+        hasher = self._hasher
+        striper = None
+        dropped = False
+        if self._chunk_tree is None:
+            hash_data = hasher.update
+        else:
+            if self._verifier is None:
+                # (this lasts across reconnections, like the hasher)
+                self._verifier = merkle.ChunkVerifier(
+                    self._chunk_tree, self._offset, self.args.jobs)
+
+            def on_bad(index):
+                # stop receiving: there's no point
+                record_pipe.close()
+                if striper is not None:
+                    striper.close()
+
+            self._verifier.on_bad = on_bad
+
+            def hash_data(data):
+                hasher.update(data)
+                self._verifier.update(data)
+
+        tr = self._transit_receiver
+        with progress:
+            if tr.get_stripe_count() > 1 and not self._wants_digest:
+                # the sender is spreading the file across several
+                # connections: stripe 0 is record_pipe
+                if isinstance(f, ZipExtractor):
+                    # records can arrive out of order, so they land in a
+                    # scratch file, and the extractor gets them in order,
+                    # along with the hasher (and the verifier)
+                    target = self._get_scratch_file()
+
+                    def hash_and_write(data):
+                        hash_data(data)
+                        f.write(data)
+                else:
+                    target, hash_and_write = f, hash_data
+                striper = StripedFileConsumer(
+                    target, remaining, progress.update, hash_and_write,
+                    offset=self._offset)
+                self._striper = striper
+                striper.add_stripe(record_pipe)
+                tr.observe_stripes(striper.add_stripe)
+                try:
+                    received = yield striper.when_done()
+                except error.ConnectionClosed:
+                    # data that arrived ahead of a gap will be sent again
+                    dropped = True
+                    received = striper.get_offset() - self._offset
+                    striper.close()
+                tr.stop_striping()
+                t.detail(stripes=len(striper.stripes))
+                if self._scratch is not None:
+                    t.detail(
+                        spool_peak_memory=self._scratch.peak_memory,
+                        spooled_to_disk=self._scratch.rolled)
+            else:
+                if tr.get_stripe_count() > 1:
+                    # (we asked for the data on a single connection)
+                    t.detail(stripes=1)
+                try:
+                    received = yield record_pipe.writeToFile(
+                        f, remaining, progress.update, hash_data)
+                except error.ConnectionClosed:
+                    dropped = True
+                    received = f.tell() - self._offset
+        returnValue((received, dropped))
+
+    def _transfer_uncached(self, record_pipe, f):
+        # the sender skips the chunks that we got from the cache
+        writer = chunkcache.GapWriter(f, self._chunk_tree, self._cached)
+        return self._transfer_extents(record_pipe, f, writer,
+                                      cached_chunks=len(self._cached))
+
+    def _transfer_sparse(self, record_pipe, f):
+        # the sender skips the holes, which we leave as holes
+        writer = sparse.ExtentWriter(f, self._extents)
+        return self._transfer_extents(record_pipe, f, writer,
+                                      hole_bytes=self.xfersize - writer.size)
+
+    @inlineCallbacks
+    def _transfer_extents(self, record_pipe, f, writer, **details):
+        # The sender sends the parts of the file that 'writer' puts in
+        # place, in order, on a single connection. Once they're all there,
+        # the whole file is hashed, and checked a chunk at a time if we have
+        # the chunk hashes (which also catches a cached chunk that went
+        # bad).
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        tree = self._chunk_tree
+        # (whatever we don't write is left as a hole, where we can)
+        f.truncate(self.xfersize)
+
+        t = self.args.timing.add("rx file")
+        try:
+            with t:
+                with self._progress(total=writer.size) as progress:
+                    try:
+                        yield record_pipe.writeToFile(writer, writer.size,
+                                                      progress.update)
+                    except error.ConnectionClosed:
+                        raise ConnectionDroppedError(
+                            "Connection dropped before full file received")
+                if tree is not None:
+                    self._verifier = merkle.ChunkVerifier(
+                        tree, jobs=self.args.jobs)
+                yield threads.deferToThreadPool(
+                    self._reactor, self._reactor.getThreadPool(),
+                    self._check_whole_file, f)
+                t.detail(**details)
+                if self._verifier is not None:
+                    t.detail(chunks_checked=self._verifier.checked)
+        finally:
+            self._finish_transit(record_pipe, t)
+
+        bad = None if self._verifier is None else self._verifier.bad_chunk
+        if bad is not None:
+            if bad in (self._cached or ()):
+                # (so it won't fool us again)
+                self._chunk_cache().discard(tree.hash_alg, tree.leaves[bad])
+            self._discard_file(f)
+            err = "chunk %d of the file doesn't match the sender's hash" % bad
+            # the sender is waiting for our ack, and would otherwise see the
+            # connection close before our error reaches it
+            yield record_pipe.send_record(
+                dict_to_bytes({"ack": "error", "error": err}))
+            raise RespondError(err)
+        returnValue(self._hasher.digest())
+
+    def _check_whole_file(self, f, chunk_size=256 * 1024):
+        # (this reads the whole file, so it belongs on a thread)
+        f.seek(0)
+        remaining = self.xfersize
+        while remaining:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            self._hasher.update(data)
+            if self._verifier is not None:
+                self._verifier.update(data)
+            remaining -= len(data)
+        if self._verifier is not None:
+            self._verifier.flush()
+
+    @inlineCallbacks
+    def _transfer_files(self, record_pipe):
+        # The sender sends each file in turn, on a single connection: a
+        # record with its name and size, then its data, then a record with
+        # its hash. Each file is renamed into place once its hash matches,
+        # so the ones that arrived are kept even if a later one doesn't.
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        overall = self._hasher
+
+        t = self.args.timing.add("rx file")
+        try:
+            with t:
+                with self._progress(total=self.xfersize) as progress:
+                    try:
+                        for (path, name, size) in self._files:
+                            yield self._receive_one_file(
+                                record_pipe, path, name, size, progress)
+                    except RespondError:
+                        # stop the sender: there's no point
+                        record_pipe.close()
+                        raise
+                t.detail(files=len(self._files))
+        finally:
+            self._finish_transit(record_pipe, t)
+        returnValue(overall.digest())
+
+    @inlineCallbacks
+    def _receive_one_file(self, record_pipe, path, name, size, progress):
+        hasher = new_hasher(self._hash_alg)
+
+        def hash_data(data):
+            hasher.update(data)
+            self._hasher.update(data)
+
+        tmp_name = path + ".tmp"
+        try:
+            try:
+                header = yield record_pipe.receive_record()
+                if bytes_to_dict(header) != {"filename": name,
+                                             "filesize": size}:
+                    raise RespondError("expected %r, got something else" %
+                                       (name, ))
+                with open(tmp_name, "wb") as f:
+                    yield record_pipe.writeToFile(f, size, progress.update,
+                                                  hash_data)
+                trailer = bytes_to_dict((yield record_pipe.receive_record()))
+            except error.ConnectionClosed:
+                raise ConnectionDroppedError(
+                    "Connection dropped before full file received")
+            except ValueError:
+                raise RespondError("bad record for %r" % (name, ))
+            digest = bytes_to_hexstr(hasher.digest())
+            if not isinstance(trailer, dict) or trailer.get(
+                    "digest") != digest:
+                raise RespondError("%s doesn't match the sender's hash" %
+                                   (name, ))
+        except Exception:
+            # (the files before this one are kept)
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        os.rename(tmp_name, path)
+        self._msg(u"Received file written to %s" % os.path.basename(path))
+
+    @inlineCallbacks
+    def _transfer_stream(self, record_pipe):
+        # The sender sends the stream as it arrives, on a single
+        # connection, then an empty record, then a record with the hash of
+        # everything before it. The writes to stdout happen on a thread,
+        # and the sender is held back while they can't keep up. What was
+        # written can't be taken back, so a bad hash is reported (and
+        # makes us fail) after the fact.
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        stdout = self.args.stdout
+        out = getattr(stdout, "buffer", stdout)
+
+        t = self.args.timing.add("rx stream")
+        try:
+            with t:
+                with self._progress() as progress:
+                    try:
+                        received = yield record_pipe.writeToStream(
+                            out, progress.update, self._hasher.update)
+                        trailer = yield record_pipe.receive_record()
+                    except error.ConnectionClosed:
+                        raise ConnectionDroppedError(
+                            "Connection dropped before the end of the "
+                            "stream")
+                    except EnvironmentError as e:
+                        raise RespondError("can't write to stdout: %s" %
+                                           (e, ))
+                t.detail(stream_bytes=received)
+        finally:
+            self._finish_transit(record_pipe, t)
+        datahash = self._hasher.digest()
+        try:
+            trailer = bytes_to_dict(trailer)
+        except ValueError:
+            trailer = None
+        if (not isinstance(trailer, dict) or
+                trailer.get("digest") != bytes_to_hexstr(datahash)):
+            record_pipe.close()
+            raise RespondError("the stream doesn't match the sender's hash")
+        self._msg(u"Received %s, written to stdout" % naturalsize(received))
         returnValue(datahash)
 
+    @inlineCallbacks
+    def _transfer_delta(self, record_pipe, f):
+        # the sender builds the file from our old copy, in order, on a
+        # single connection
+        self._msg(u"Receiving changes (%s).." % record_pipe.describe())
+        signatures = self._signatures
+        size = delta.SIGNATURE_RECORD_SIZE
+        record_pipe.send_records([
+            signatures[i:i + size] for i in range(0, len(signatures), size)
+        ])
+
+        t = self.args.timing.add("rx delta")
+        try:
+            with t:
+                with open(self.abs_destname, "rb") as basis:
+                    patcher = delta.DeltaPatcher(basis, self._basis_size, f,
+                                                 self.xfersize)
+                    (expected, datahash) = yield self._apply_delta(
+                        record_pipe, f, patcher)
+                t.detail(
+                    literal_bytes=patcher.literal_bytes,
+                    copied_bytes=patcher.copied_bytes)
+        finally:
+            self._finish_transit(record_pipe, t)
+        if self._expected_hash is None:
+            # (checked before the old copy is replaced)
+            self._expected_hash = bytes_to_hexstr(expected)
+        returnValue(datahash)
+
+    @inlineCallbacks
+    def _apply_delta(self, record_pipe, f, patcher):
+        # this fires with (the hash the sender expects, the one we got)
+        try:
+            # the hash of the whole new file comes first
+            expected = yield record_pipe.receive_record()
+            with self._progress() as progress:
+                yield record_pipe.writeToFile(patcher, None, progress.update)
+        except error.ConnectionClosed:
+            raise ConnectionDroppedError(
+                "Connection dropped before full file received")
+        try:
+            datahash = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(), patcher.finish,
+                self._hasher)
+        except TransferError as e:
+            record_pipe.close()
+            self._discard_file(f)
+            raise RespondError(str(e))
+        returnValue((expected, datahash))
+
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
+        if self._delta:
+            os.remove(self.abs_destname)  # (rename won't replace on windows)
         os.rename(tmp_name, self.abs_destname)
+        if os.path.exists(self._checkpoint_name):
+            os.remove(self._checkpoint_name)
         self._msg(u"Received file written to %s" % os.path.basename(
             self.abs_destname))
 
-    def _extract_file(self, zf, info, extract_dir):
-        """
-        the zipfile module does not restore file permissions
-        so we'll do it manually
-        """
-        out_path = os.path.join(extract_dir, info.filename)
-        out_path = os.path.abspath(out_path)
-        if not out_path.startswith(extract_dir):
+    def _get_scratch_file(self):
+        # this lasts across reconnections, since the striper writes at
+        # offsets from the start of the zipfile
+        if self._scratch is None:
+            self._scratch = SpoolFile(self.args.spool_max_size,
+                                      self.args.spool_dir)
+        return self._scratch
+
+    def _extract_path(self, extract_dir, filename):
+        # where to unpack a member of the zipfile. realpath() follows any
+        # symlinks that are already there, so one (e.g. in a directory we're
+        # updating) can't lead us outside of extract_dir.
+        root = os.path.realpath(extract_dir)
+        out_path = os.path.realpath(os.path.join(root, filename))
+        if not out_path.startswith(os.path.join(root, "")):
             raise ValueError(
                 "malicious zipfile, %s outside of extract_dir %s" %
-                (info.filename, extract_dir))
-
-        zf.extract(info.filename, path=extract_dir)
-
-        # not sure why zipfiles store the perms 16 bits away but they do
-        perm = info.external_attr >> 16
-        os.chmod(out_path, perm)
+                (filename, extract_dir))
+        return out_path
 
     def _write_directory(self, f):
+        # everything has been unpacked already, as it arrived
+        with self.args.timing.add("finish unpacking"):
+            if self._scratch is not None:
+                self._scratch.close()
+            f.close()  # raises if the zipfile was bad or incomplete
+            extract_dir = os.path.join(self._staging_dir,
+                                       os.path.basename(self.abs_destname))
+            if self._wanted is not None:
+                self._merge_directory(extract_dir)
+                shutil.rmtree(self._staging_dir)
+            else:
+                os.rename(extract_dir, self.abs_destname)
+                os.rmdir(self._staging_dir)
+
+        self._msg(u"Received files written to %s/" % os.path.basename(
+            self.abs_destname))
 
-        self._msg(u"Unpacking zipfile..")
-        with self.args.timing.add("unpack zip"):
-            with zipfile.ZipFile(f, "r", zipfile.ZIP_DEFLATED) as zf:
-                for info in zf.infolist():
-                    self._extract_file(zf, info, self.abs_destname)
+    def _merge_directory(self, extract_dir):
+        # move each file we asked for over our old copy, with the sender's
+        # mtime, so next time it can be recognized without hashing it
+        for index in self._wanted:
+            (name, size, mtime, digest) = self._manifest.entries[index]
+            source = self._extract_path(extract_dir, name)
+            if not os.path.isfile(source):
+                continue  # (the sender couldn't read it after all)
+            target = self._extract_path(self.abs_destname, name)
+            parent = os.path.dirname(target)
+            # (a local file where they have a directory is left alone)
+            ancestor = parent
+            while not os.path.isdir(ancestor):
+                if os.path.lexists(ancestor):
+                    raise TransferError(
+                        "refusing to replace '%s' with a directory" %
+                        ancestor)
+                ancestor = os.path.dirname(ancestor)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            self._remove_existing(target)
+            os.rename(source, target)
+            os.utime(target, (mtime, mtime))
 
-            self._msg(u"Received files written to %s/" % os.path.basename(
-                self.abs_destname))
-            f.close()
+    def _ack(self, datahash):
+        datahash_hex = bytes_to_hexstr(datahash)
+        if self._hash_alg is None:
+            return {u"ack": u"ok", u"sha256": datahash_hex}
+        return {
+            u"ack": u"ok",
+            u"hash_alg": self._hash_alg,
+            u"digest": datahash_hex,
+        }
 
     @inlineCallbacks
     def _close_transit(self, record_pipe, datahash):
-        datahash_hex = bytes_to_hexstr(datahash)
-        ack = {u"ack": u"ok", u"sha256": datahash_hex}
-        ack_bytes = dict_to_bytes(ack)
+        ack_bytes = dict_to_bytes(self._ack(datahash))
         with self.args.timing.add("send ack"):
             yield record_pipe.send_record(ack_bytes)
             yield record_pipe.close()
+            if self._striper:
+                self._striper.close()
+        self._record_pipe = self._striper = None
@@ -1,27 +1,35 @@
 from __future__ import print_function
 
+import base64
 import hashlib
 import os
 import sys
-import tempfile
-import zipfile
 
 import six
 from humanize import naturalsize
 from tqdm import tqdm
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.protocols import basic
+from twisted.internet import error, reactor, threads
+from twisted.internet.defer import (FirstError, gatherResults,
+                                    inlineCallbacks, returnValue, succeed)
 from twisted.python import log
+from twisted.python.threadable import isInIOThread
 from wormhole import __version__, create
 
 from ..errors import TransferError, UnsendableFileError
-from ..transit import TransitSender
-from ..util import bytes_to_dict, bytes_to_hexstr, dict_to_bytes
+from ..transit import StripedFileSender, TransitClosed, TransitSender
+from ..util import (SpoolFile, available_hash_algorithms, bytes_to_dict,
+                    bytes_to_hexstr, dict_to_bytes, hash_file_prefix,
+                    new_hasher)
+from . import chunkcache, delta, manifest, merkle, sparse, zipstream
 from .welcome import handle_welcome
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 VERIFY_TIMER = float(os.environ.get("_MAGIC_WORMHOLE_TEST_VERIFY_TIMER", 1.0))
+# how many times we'll reconnect after losing the transit connection
+MAX_RECONNECTS = 5
+# a file smaller than this (and than the receiver's limit) goes in the offer
+# itself, without a transit connection
+INLINE_MAX_SIZE = 32 * 1024
 
 
 def send(args, reactor=reactor):
@@ -44,6 +52,19 @@ class Sender:
         self._timing = args.timing
         self._fd_to_send = None
         self._transit_sender = None
+        self._attempt = 0  # how many times we've reconnected
+        self._streaming = False  # sending a directory as a ZipStream
+        self._dir_files = None
+        self._file_list = None  # (path, name, size) of each of several files
+        self._from_stdin = False  # sending stdin, as it arrives
+        self._inline = None  # the file's data, if it went in the offer
+        self._manifest = None  # offered along with a streamed directory
+        self._chunk_tree = None  # offered along with a file
+        self._extents = None  # the data around a file's holes, if offered
+        self._prehash = None  # the file's sha256, if we hashed it up front
+        self._send_digest = False  # the receiver wants our hash at the end
+        self._hash_algs = available_hash_algorithms()
+        self._hash_alg = None  # None means sha256, for older receivers
 
     @inlineCallbacks
     def go(self):
@@ -81,6 +102,7 @@ class Sender:
         # as the original one)
         @inlineCallbacks
         def _bad(f):
+            self._abort_transit()
             try:
                 yield w.close()  # might be an error too
             except Exception:
@@ -94,20 +116,72 @@ class Sender:
         data_bytes = dict_to_bytes(data)
         w.send_message(data_bytes)
 
+    def _msg(self, msg):
+        # the offer is built on a thread, whose messages are printed by the
+        # reactor, so they can't land in the middle of the code (tests build
+        # offers without a reactor)
+        if self._reactor is None or isInIOThread():
+            print(msg, file=self._args.stderr)
+        else:
+            self._reactor.callFromThread(print, msg, file=self._args.stderr)
+
+    def _check_what(self):
+        # Before we get a code, make sure there's something there to send:
+        # only finding (and hashing) its contents happens on a thread.
+        args = self._args
+        if args.stream or args.text is not None or not args.what:
+            return
+        what = os.path.realpath(os.path.join(args.cwd, args.what))
+        self._check_path(what, args.what)
+
+    def _check_path(self, what, path):
+        # 'what' is where the 'path' the user gave us really leads
+        if not os.path.exists(what):
+            raise TransferError(
+                "Cannot send: no file/directory named '%s'" % path)
+        if not (os.path.isfile(what) or os.path.isdir(what)):
+            raise TypeError("'%s' is neither file nor directory" % path)
+        if not os.access(what, os.R_OK):
+            raise TransferError("Cannot send: '%s' is not readable" % path)
+
+    def _start_offer(self):
+        # Finding (and maybe zipping) the files to send can take a while,
+        # so that happens on a thread, while we get a code and wait for the
+        # receiver. A text message might have to be read from stdin, and a
+        # list of files only needs to be statted, so those happen right
+        # away.
+        args = self._args
+        if args.text is not None or not args.what:
+            return succeed(self._build_offer(stream=True))
+        # directories are zipped as they are sent, if the receiver can take
+        # a zipfile of unknown size
+        ev = self._timing.add("build offer")
+        d = threads.deferToThreadPool(self._reactor,
+                                      self._reactor.getThreadPool(),
+                                      self._build_offer, stream=True)
+
+        def _built(res):
+            ev.finish()
+            return res
+
+        d.addBoth(_built)
+        return d
+
     @inlineCallbacks
     def _go(self, w):
         welcome = yield w.get_welcome()
         handle_welcome(welcome, self._args.relay_url, __version__,
                        self._args.stderr)
 
-        # TODO: run the blocking zip-the-directory IO in a thread, let the
-        # wormhole exchange happen in parallel
-        offer, self._fd_to_send = self._build_offer()
+        self._check_what()
+        offer_d = self._start_offer()
         args = self._args
 
         other_cmd = u"wormhole receive"
         if args.verify:
             other_cmd = u"wormhole receive --verify"
+        if args.stream:
+            other_cmd += u" --stream"
         if args.zeromode:
             assert not args.code
             args.code = u"0-"
@@ -133,8 +207,13 @@ class Sender:
         # even though we do that in cmd_receive.py, because it's not at all
         # surprising to we waiting here for a long time. We'll sit in
         # get_unverified_key() until the receiver has typed in the code and
-        # their PAKE message makes it to us.
-        yield w.get_unverified_key()
+        # their PAKE message makes it to us. The offer is being built in the
+        # meantime, and if that fails, we give up right away.
+        try:
+            (_, (offer, self._fd_to_send)) = yield gatherResults(
+                [w.get_unverified_key(), offer_d], consumeErrors=True)
+        except FirstError as e:
+            e.subFailure.raiseException()
 
         # TODO: don't stall on w.get_verifier() unless they want it
         def on_slow_connection():
@@ -161,30 +240,54 @@ class Sender:
             self._check_verifier(w,
                                  verifier_bytes)  # blocks, can TransferError
 
-        if self._fd_to_send:
-            ts = TransitSender(
-                args.transit_helper,
-                no_listen=(not args.listen),
-                tor=self._tor,
-                reactor=self._reactor,
-                timing=self._timing)
-            self._transit_sender = ts
-
-            # for now, send this before the main offer
-            sender_abilities = ts.get_connection_abilities()
-            sender_hints = yield ts.get_connection_hints()
-            sender_transit = {
-                "abilities-v1": sender_abilities,
-                "hints-v1": sender_hints,
-            }
+        if self._file_list is not None:
+            them_versions = yield w.get_versions()
+            if not them_versions.get(u"multiple-files"):
+                err = ("the receiver can't take several files at once: send "
+                       "them one at a time, or as a directory")
+                self._send_data({"error": err}, w)
+                raise TransferError(err)
+
+        if self._from_stdin:
+            them_versions = yield w.get_versions()
+            if not them_versions.get(u"stream"):
+                err = ("the receiver can't take a stream: send a file "
+                       "instead")
+                self._send_data({"error": err}, w)
+                raise TransferError(err)
+
+        if self._fd_to_send and u"file" in offer:
+            them_versions = yield w.get_versions()
+            offer = self._inline_file(offer,
+                                      them_versions.get(u"inline-files"))
+
+        if ((self._fd_to_send and self._inline is None) or
+                self._file_list is not None):
+            # for now, send this before the main offer (the receiver can
+            # start connecting while we build a zipfile, if we need one)
+            sender_transit = yield self._build_transit(w)
             self._send_data({u"transit": sender_transit}, w)
 
-            # TODO: move this down below w.get_message()
-            transit_key = w.derive_key(APPID + "/transit-key",
-                                       ts.TRANSIT_KEY_LENGTH)
-            ts.set_transit_key(transit_key)
+        if self._streaming:
+            # their versions arrive along with the verifier
+            them_versions = yield w.get_versions()
+            modes = them_versions.get(u"directory-modes", [])
+            if u"zipfile/stream" not in modes:
+                self._streaming = False
+                # (it couldn't ask for just some of the files anyway)
+                offer["directory"].pop("manifest", None)
+                self._manifest = None
+                offer, self._fd_to_send = yield threads.deferToThreadPool(
+                    self._reactor, self._reactor.getThreadPool(),
+                    self._build_zipfile, offer, self._dir_files)
 
+        for kind in (u"file", u"directory", u"files", u"stream"):
+            if kind in offer:
+                # the receiver picks the hash for its ack from these
+                offer[kind][u"hash_algs"] = self._hash_algs
         self._send_data({"offer": offer}, w)
+        if self._inline is not None:
+            print(u"File sent.. waiting for confirmation", file=args.stderr)
 
         want_answer = True
 
@@ -206,11 +309,48 @@ class Sender:
                 if not want_answer:
                     raise TransferError("duplicate answer")
                 want_answer = True
-                yield self._handle_answer(them_d[u"answer"])
-                returnValue(None)
+                done = yield self._handle_answer(them_d[u"answer"], w)
+                if done:
+                    returnValue(None)
+                # we lost the transit connection, and have asked the
+                # receiver to make a new one: wait for their answer again
             if not recognized:
                 log.msg("unrecognized message %r" % (them_d, ))
 
+    @inlineCallbacks
+    def _build_transit(self, w):
+        args = self._args
+        ts = TransitSender(
+            args.transit_helper,
+            no_listen=(not args.listen),
+            tor=self._tor,
+            reactor=self._reactor,
+            timing=self._timing,
+            crypto_threads=args.crypto_threads,
+            cipher_suites=True,
+            framing_v2=True,
+            compress=args.compress,
+            accept_compressed=True,
+            stripes=args.stripes)
+        self._transit_sender = ts
+
+        sender_abilities = ts.get_connection_abilities()
+        sender_hints = yield ts.get_connection_hints()
+        sender_transit = {
+            "abilities-v1": sender_abilities,
+            "hints-v1": sender_hints,
+        }
+
+        # TODO: move this down below w.get_message()
+        purpose = APPID + u"/transit-key"
+        if self._attempt:
+            # record nonces start over on every connection, so every
+            # reconnection needs a key of its own
+            purpose += u"/%d" % self._attempt
+        transit_key = w.derive_key(purpose, ts.TRANSIT_KEY_LENGTH)
+        ts.set_transit_key(transit_key)
+        returnValue(sender_transit)
+
     def _check_verifier(self, w, verifier_bytes):
         verifier = bytes_to_hexstr(verifier_bytes)
         while True:
@@ -225,17 +365,23 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
 
-    def _build_offer(self):
+    def _build_offer(self, stream=False):
         offer = {}
 
         args = self._args
+        if args.stream:
+            if args.text is not None or args.what or args.files:
+                raise TransferError("Cannot send: --stream sends stdin, "
+                                    "and nothing else")
+            return self._build_stream_offer()
         text = args.text
         if text == "-":
             print(u"Reading text message from stdin..", file=args.stderr)
             text = sys.stdin.read()
-        if not text and not args.what:
+        if not text and not (args.what or args.files):
             text = six.moves.input("Text to send: ")
 
         if text is not None:
@@ -246,6 +392,9 @@ class Sender:
             fd_to_send = None
             return offer, fd_to_send
 
+        if args.files:
+            return self._build_files_offer(args.files), None
+
         # click.Path (with resolve_path=False, the default) does not do path
         # resolution, so we must join it to cwd ourselves. We could use
         # resolve_path=True, but then it would also do os.path.realpath(),
@@ -291,147 +440,718 @@ class Sender:
         # environments.
 
         what = os.path.realpath(what)
-        if not os.path.exists(what):
-            raise TransferError(
-                "Cannot send: no file/directory named '%s'" % args.what)
+        self._check_path(what, args.what)
 
         if os.path.isfile(what):
             # we're sending a file
-            filesize = os.stat(what).st_size
+            st = os.stat(what)
+            filesize = st.st_size
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                "resumable": True,
+                # so a checkpoint of this file isn't mistaken for another's
+                "mtime": int(st.st_mtime),
+                # a receiver with an older copy can ask for just the changes
+                "delta": [delta.FORMAT],
             }
-            print(
-                u"Sending %s file named '%s'" % (naturalsize(filesize),
-                                                 basename),
-                file=args.stderr)
+            self._msg(u"Sending %s file named '%s'" % (naturalsize(filesize),
+                                                       basename))
             fd_to_send = open(what, "rb")
+            if args.prehash:
+                # (we're on a thread, waiting for the receiver anyway)
+                hasher = hashlib.sha256()
+                self._msg(u"Hashing file..")
+                progress = self._progress(total=filesize)
+                with self._timing.add("prehash"), progress:
+                    hash_file_prefix(fd_to_send, filesize, hasher,
+                                     progress=progress.update)
+                    fd_to_send.seek(0)
+                self._prehash = hasher.digest()
+                offer["file"]["sha256"] = bytes_to_hexstr(self._prehash)
+            if args.chunk_hashes:
+                # so the receiver can check each chunk as it arrives
+                hash_alg = self._hash_algs[0]
+                self._msg(u"Hashing chunks..")
+                progress = self._progress(total=filesize)
+                with self._timing.add("chunk hashes", jobs=args.jobs), \
+                        progress:
+                    self._chunk_tree = merkle.hash_file(
+                        what, filesize, hash_alg, jobs=args.jobs,
+                        progress=progress.update)
+                offer["file"]["merkle"] = self._chunk_tree.to_dict()
+                # and the receiver can tell us which ones it already has
+                offer["file"]["cached_chunks"] = True
+            with self._timing.add("find holes") as t:
+                self._extents = sparse.find_extents(fd_to_send, filesize,
+                                                    zeros=args.sparse)
+            if self._extents is not None:
+                # a receiver can leave the holes out, and we won't send them
+                offer["file"]["extents"] = [list(extent)
+                                            for extent in self._extents]
+                t.detail(extents=len(self._extents))
             return offer, fd_to_send
 
         if os.path.isdir(what):
-            print(u"Building zipfile..", file=args.stderr)
-            # We're sending a directory. Create a zipfile in a tempdir and
-            # send that.
-            fd_to_send = tempfile.SpooledTemporaryFile()
-            # workaround for https://bugs.python.org/issue26175 (STF doesn't
-            # fully implement IOBase abstract class), which breaks the new
-            # zipfile in py3.7.0 that expects .seekable
-            if not hasattr(fd_to_send, "seekable"):
-                # AFAICT all the filetypes that STF wraps can seek
-                fd_to_send.seekable = lambda: True
-            num_files = 0
-            num_bytes = 0
-            tostrip = len(what.split(os.sep))
-            with zipfile.ZipFile(
-                    fd_to_send,
-                    "w",
-                    compression=zipfile.ZIP_DEFLATED,
-                    allowZip64=True) as zf:
-                for path, dirs, files in os.walk(what):
-                    # path always starts with args.what, then sometimes might
-                    # have "/subdir" appended. We want the zipfile to contain
-                    # "" or "subdir"
-                    localpath = list(path.split(os.sep)[tostrip:])
-                    for fn in files:
-                        archivename = os.path.join(*tuple(localpath + [fn]))
-                        localfilename = os.path.join(path, fn)
-                        try:
-                            zf.write(localfilename, archivename)
-                            num_bytes += os.stat(localfilename).st_size
-                            num_files += 1
-                        except OSError as e:
-                            errmsg = u"{}: {}".format(fn, e.strerror)
-                            if self._args.ignore_unsendable_files:
-                                print(
-                                    u"{} (ignoring error)".format(errmsg),
-                                    file=args.stderr)
-                            else:
-                                raise UnsendableFileError(errmsg)
-            fd_to_send.seek(0, 2)
-            filesize = fd_to_send.tell()
-            fd_to_send.seek(0, 0)
+            files, num_bytes = self._walk_directory(what)
             offer["directory"] = {
-                "mode": "zipfile/deflated",
                 "dirname": basename,
-                "zipsize": filesize,
                 "numbytes": num_bytes,
-                "numfiles": num_files,
+                "numfiles": len(files),
             }
-            print(
-                u"Sending directory (%s compressed) named '%s'" %
-                (naturalsize(filesize), basename),
-                file=args.stderr)
-            return offer, fd_to_send
+            self._dir_files = files
+            if not stream:
+                return self._build_zipfile(offer, files)
+            # We're sending a directory, and will zip it as we go. We can't
+            # resume this, since we can't start partway into the zipfile.
+            self._streaming = True
+            offer["directory"]["mode"] = "zipfile/stream"
+            self._msg(u"Sending directory (%d files, %s) named '%s'" %
+                      (len(files), naturalsize(num_bytes), basename))
+            if args.manifest:
+                # so a receiver with an older copy can ask for just the
+                # files that changed
+                hash_alg = self._hash_algs[0]
+                with self._timing.add("manifest", jobs=args.jobs):
+                    self._manifest = manifest.build(files, hash_alg,
+                                                    jobs=args.jobs)
+                offer["directory"]["manifest"] = self._manifest.to_dict()
+            return offer, zipstream.ZipStream(files, jobs=args.jobs)
 
         raise TypeError("'%s' is neither file nor directory" % args.what)
 
+    def _walk_directory(self, what):
+        # Find the files to send (with their names in the zipfile), and how
+        # big they are. Any that we can't read are reported (or skipped)
+        # here, before we start sending.
+        files = []
+        num_bytes = 0
+        tostrip = len(what.split(os.sep))
+        for path, dirs, filenames in os.walk(what):
+            # path always starts with args.what, then sometimes might have
+            # "/subdir" appended. We want the zipfile to contain "" or
+            # "subdir"
+            localpath = list(path.split(os.sep)[tostrip:])
+            for fn in filenames:
+                archivename = os.path.join(*tuple(localpath + [fn]))
+                localfilename = os.path.join(path, fn)
+                try:
+                    size = os.stat(localfilename).st_size
+                    open(localfilename, "rb").close()
+                except EnvironmentError as e:
+                    errmsg = u"{}: {}".format(fn, e.strerror)
+                    if self._args.ignore_unsendable_files:
+                        self._msg(u"{} (ignoring error)".format(errmsg))
+                        continue
+                    raise UnsendableFileError(errmsg)
+                files.append((localfilename, archivename))
+                num_bytes += size
+        return files, num_bytes
+
+    def _build_files_offer(self, paths):
+        # Several files are sent one after another, as they are, so they
+        # must all be regular files, with different names
+        files = []
+        names = set()
+        for path in paths:
+            what = os.path.join(self._args.cwd, path)
+            name = os.path.basename(os.path.normpath(what))
+            what = os.path.realpath(what)
+            if not os.path.isfile(what):
+                raise TransferError(
+                    "Cannot send: no file named '%s' (only files can be "
+                    "sent together)" % path)
+            if not os.access(what, os.R_OK):
+                raise TransferError("Cannot send: '%s' is not readable" % path)
+            if name in names:
+                raise TransferError(
+                    "Cannot send: more than one file named '%s'" % name)
+            names.add(name)
+            files.append((what, name, os.stat(what).st_size))
+        self._file_list = files
+        num_bytes = sum(size for (what, name, size) in files)
+        self._msg(u"Sending %d files (%s)" %
+                  (len(files), naturalsize(num_bytes)))
+        return {
+            "files": {
+                "files": [[name, size] for (what, name, size) in files],
+                "numbytes": num_bytes,
+            }
+        }
+
+    def _build_stream_offer(self):
+        # stdin is sent as it arrives, so nobody knows how big it is until
+        # it ends
+        self._from_stdin = True
+        self._msg(u"Sending stdin as a stream")
+        stdin = self._args.stdin
+        return {"stream": {}}, getattr(stdin, "buffer", stdin)
+
+    def _inline_file(self, offer, limit):
+        # A file that's small enough (for both of us) goes in the offer
+        # itself, which saves setting up a transit connection, and the
+        # receiver's answer is the ack. 'limit' is the receiver's, from its
+        # versions (older receivers don't have one).
+        filesize = offer["file"]["filesize"]
+        if (not isinstance(limit, six.integer_types) or
+                isinstance(limit, bool) or
+                filesize >= min(limit, INLINE_MAX_SIZE)):
+            return offer
+        self._fd_to_send.seek(0)
+        data = self._fd_to_send.read(filesize + 1)
+        self._fd_to_send.seek(0)
+        if len(data) != filesize:
+            return offer  # (it changed: send it the usual way)
+        self._inline = data
+        self._fd_to_send.close()
+        return {
+            "file": {
+                "filename": offer["file"]["filename"],
+                "filesize": filesize,
+                "inline": base64.b64encode(data).decode("ascii"),
+            }
+        }
+
+    def _build_zipfile(self, offer, files):
+        args = self._args
+        self._msg(u"Building zipfile..")
+        # Create a zipfile in memory (or, once it gets too big, in a tempdir)
+        # and send that.
+        fd_to_send = SpoolFile(args.spool_max_size, args.spool_dir)
+        progress = self._progress(total=offer["directory"]["numbytes"])
+        with self._timing.add("build zipfile", jobs=args.jobs) as t:
+            zs = zipstream.ZipStream(files, jobs=args.jobs)
+            packed = 0
+            with progress:
+                while True:
+                    data = zs.read(zipstream.CHUNK_SIZE)
+                    if not data:
+                        break
+                    fd_to_send.write(data)
+                    # (this counts the files' bytes, not the zipfile's)
+                    done = zs.stored_bytes + zs.deflated_bytes
+                    progress.update(done - packed)
+                    packed = done
+            zs.close()
+            t.detail(
+                spool_peak_memory=fd_to_send.peak_memory,
+                spooled_to_disk=fd_to_send.rolled,
+                stored_bytes=zs.stored_bytes,
+                deflated_bytes=zs.deflated_bytes)
+        fd_to_send.seek(0, 2)
+        filesize = fd_to_send.tell()
+        fd_to_send.seek(0, 0)
+        offer["directory"].update({
+            "mode": "zipfile/deflated",
+            "zipsize": filesize,
+            "storedbytes": zs.stored_bytes,
+            "deflatedbytes": zs.deflated_bytes,
+            "resumable": True,
+        })
+        self._msg(u"Sending directory (%s compressed) named '%s'" %
+                  (naturalsize(filesize), offer["directory"]["dirname"]))
+        return offer, fd_to_send
+
     @inlineCallbacks
-    def _handle_answer(self, them_answer):
+    def _handle_answer(self, them_answer, w):
+        # this fires with True when we're done, or False if we've asked the
+        # receiver to reconnect
+        if self._inline is not None:
+            self._check_inline_answer(them_answer)
+            returnValue(True)
+        if self._file_list is not None or self._from_stdin:
+            if them_answer.get("file_ack") != "ok":
+                raise TransferError("ambiguous response from remote, "
+                                    "transfer abandoned: %s" % (them_answer, ))
+            hash_alg = them_answer.get("hash_alg")
+            if hash_alg not in self._hash_algs:
+                raise TransferError("unknown hash algorithm from remote: %r" %
+                                    (hash_alg, ))
+            self._hash_alg = hash_alg
+            try:
+                if self._from_stdin:
+                    yield self._send_stream()
+                else:
+                    yield self._send_files()
+            except (TransitClosed, error.ConnectionClosed):
+                raise TransferError("transit connection lost, "
+                                    "transfer abandoned")
+            returnValue(True)
         if self._fd_to_send is None:
             if them_answer["message_ack"] == "ok":
                 print(u"text message sent", file=self._args.stderr)
-                returnValue(None)  # terminates this function
+                returnValue(True)  # terminates this function
             raise TransferError("error sending text: %r" % (them_answer, ))
 
         if them_answer.get("file_ack") != "ok":
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer, ))
 
-        yield self._send_file()
+        hash_alg = them_answer.get("hash_alg")
+        if hash_alg is not None and hash_alg not in self._hash_algs:
+            raise TransferError("unknown hash algorithm from remote: %r" %
+                                (hash_alg, ))
+        self._hash_alg = hash_alg
+
+        if "delta" in them_answer:
+            yield self._send_delta(them_answer["delta"])
+            returnValue(True)
+        if "files" in them_answer:
+            self._send_only(them_answer["files"])
+        if "cached_chunks" in them_answer:
+            yield self._send_uncached(them_answer["cached_chunks"])
+            returnValue(True)
+        if them_answer.get("sparse") is True:
+            yield self._send_sparse()
+            returnValue(True)
+
+        # receivers that can resume always tell us where to start
+        offset = them_answer.get("offset")
+        self._send_digest = them_answer.get("send_digest") is True
+        try:
+            yield self._send_file(offset or 0)
+        except (TransitClosed, error.ConnectionClosed):
+            if offset is None:
+                raise
+            if self._attempt >= MAX_RECONNECTS:
+                err = "transit connection lost too many times, abandoned"
+                self._send_data({"error": err}, w)
+                raise TransferError(err)
+        else:
+            returnValue(True)
+
+        self._attempt += 1
+        print(u"Connection dropped, reconnecting..", file=self._args.stderr)
+        sender_transit = yield self._build_transit(w)
+        self._send_data({
+            u"transit": sender_transit,
+            u"reconnect": {
+                u"attempt": self._attempt
+            },
+        }, w)
+        returnValue(False)
+
+    def _check_inline_answer(self, them_answer):
+        # the file went in the offer, so the answer is also the ack
+        if them_answer.get("file_ack") != "ok":
+            raise TransferError("ambiguous response from remote, "
+                                "transfer abandoned: %s" % (them_answer, ))
+        hash_alg = them_answer.get("hash_alg")
+        if hash_alg is not None and hash_alg not in self._hash_algs:
+            raise TransferError("unknown hash algorithm from remote: %r" %
+                                (hash_alg, ))
+        self._hash_alg = hash_alg
+        hasher = new_hasher(hash_alg or u"sha256")
+        hasher.update(self._inline)
+        with self._timing.add("get ack") as t:
+            self._check_ack(them_answer, hasher.digest(), t)
 
     @inlineCallbacks
-    def _send_file(self):
+    def _send_file(self, offset):
         ts = self._transit_sender
 
-        self._fd_to_send.seek(0, 2)
-        filesize = self._fd_to_send.tell()
-        self._fd_to_send.seek(0, 0)
+        if self._streaming:
+            # we'll know how big it is when we get to the end
+            filesize = None
+            upper = 0
+        else:
+            self._fd_to_send.seek(0, 2)
+            filesize = upper = self._fd_to_send.tell()
+        if not isinstance(offset, six.integer_types) or not (
+                0 <= offset <= upper):
+            raise TransferError("bad resume offset from remote: %r" %
+                                (offset, ))
 
-        record_pipe = yield ts.connect()
-        self._timing.add("transit connected")
+        if offset:
+            print(u"Resuming, %s already received" % naturalsize(offset),
+                  file=self._args.stderr)
+        hash_alg = self._hash_alg or u"sha256"
+        hasher = None
+        if self._prehash is None or hash_alg != u"sha256":
+            hasher = new_hasher(hash_alg)
+        if offset and hasher is not None:
+            # the receiver already has the start of the file, but the ack
+            # covers all of it. This reads the whole prefix, so keep it off
+            # the reactor thread.
+            with self._timing.add("rehash sent data"):
+                yield threads.deferToThreadPool(
+                    self._reactor, self._reactor.getThreadPool(),
+                    hash_file_prefix, self._fd_to_send, offset, hasher)
+        if not self._streaming:
+            self._fd_to_send.seek(offset, 0)
+
+        # (if the receiver already has all of the file, it may close the
+        # connection before a striper could use it)
+        striped = (ts.get_stripe_count() > 1 and not self._send_digest and
+                   (self._streaming or filesize > offset))
+        record_pipe = yield self._connect_transit(striped)
         # record_pipe should implement IConsumer, chunks are just records
         stderr = self._args.stderr
         print(u"Sending (%s).." % record_pipe.describe(), file=stderr)
+        progress = self._progress(initial=offset, total=filesize)
 
-        hasher = hashlib.sha256()
-        progress = tqdm(
-            file=stderr,
-            disable=self._args.hide_progress,
-            unit="B",
-            unit_scale=True,
-            total=filesize)
+        def _count_and_hash(data):
+            if hasher is not None:
+                hasher.update(data)
+            progress.update(len(data))
+            return data
+
+        striper = None
+        tx = self._timing.add("tx file", hash_alg=hash_alg)
+        try:
+            with tx:
+                if ts.get_stripe_count() > 1:
+                    # (unless the striper says otherwise, only one was used)
+                    tx.detail(stripes=1)
+                with progress:
+                    if striped:
+                        # stripe 0 is record_pipe, and the rest are added
+                        # as they finish connecting
+                        striper = StripedFileSender(
+                            self._fd_to_send,
+                            transform=_count_and_hash,
+                            stream=self._streaming)
+                        striper.add_stripe(record_pipe)
+                        ts.observe_stripes(striper.add_stripe)
+                        yield striper.when_done()
+                        ts.stop_striping()
+                        tx.detail(stripes=len(striper.stripes))
+                    elif self._streaming:
+                        yield record_pipe.sendFile(
+                            self._fd_to_send, transform=_count_and_hash)
+                        record_pipe.send_record(b"")  # the end marker
+                    elif filesize > offset:
+                        # don't send zero-length files (or nothing, when
+                        # resuming)
+                        yield record_pipe.sendFile(
+                            self._fd_to_send, transform=_count_and_hash)
+                if self._streaming:
+                    # (the offer went out before any of this was known)
+                    tx.detail(
+                        stored_bytes=self._fd_to_send.stored_bytes,
+                        deflated_bytes=self._fd_to_send.deflated_bytes)
+
+            expected_hash = self._prehash
+            if hasher is not None:
+                expected_hash = hasher.digest()
+            if self._send_digest:
+                # the receiver resumed from an earlier transfer, and checks
+                # the whole file before it keeps it
+                record_pipe.send_record(dict_to_bytes({
+                    "digest": bytes_to_hexstr(expected_hash),
+                }))
+            yield self._get_ack(record_pipe, expected_hash)
+        finally:
+            self._finish_transit(record_pipe, tx, striper)
+
+    def _send_only(self, wanted):
+        # the receiver already has the rest of the directory, so start
+        # again with a ZipStream of just these (from our manifest)
+        count = len(self._dir_files)
+        if (self._manifest is None or not isinstance(wanted, list) or any(
+                not isinstance(i, six.integer_types) or isinstance(i, bool) or
+                not 0 <= i < count for i in wanted)):
+            raise TransferError("bad list of files from remote: %r" %
+                                (wanted, ))
+        wanted = sorted(set(wanted))
+        self._fd_to_send.close()
+        self._fd_to_send = zipstream.ZipStream(
+            [self._dir_files[i] for i in wanted], jobs=self._args.jobs)
+        self._msg(u"Sending %d of %d files (the receiver has the rest)" %
+                  (len(wanted), count))
+
+    @inlineCallbacks
+    def _send_files(self):
+        # Each file goes in turn, on a single connection: a record with its
+        # name and size, then its data, then a record with its hash. The
+        # ack covers all of them, one after another.
+        hash_alg = self._hash_alg
+        record_pipe = yield self._connect_transit()
+        stderr = self._args.stderr
+        print(u"Sending (%s).." % record_pipe.describe(), file=stderr)
+        progress = self._progress(
+            total=sum(size for (what, name, size) in self._file_list))
+        overall = new_hasher(hash_alg)
+
+        tx = self._timing.add("tx file", hash_alg=hash_alg)
+        try:
+            with tx:
+                with progress:
+                    for (what, name, size) in self._file_list:
+                        yield self._send_one_file(record_pipe, what, name,
+                                                  size, overall, progress)
+                tx.detail(files=len(self._file_list))
+            yield self._get_ack(record_pipe, overall.digest())
+        finally:
+            self._finish_transit(record_pipe, tx)
+
+    @inlineCallbacks
+    def _send_one_file(self, record_pipe, what, name, size, overall,
+                       progress):
+        hasher = new_hasher(self._hash_alg)
 
         def _count_and_hash(data):
             hasher.update(data)
+            overall.update(data)
             progress.update(len(data))
             return data
 
-        fs = basic.FileSender()
+        record_pipe.send_record(dict_to_bytes({
+            "filename": name,
+            "filesize": size,
+        }))
+        if size:
+            with open(what, "rb") as f:
+                # (no more than we offered)
+                reader = sparse.ExtentReader(f, [(0, size)])
+                yield record_pipe.sendFile(reader, transform=_count_and_hash)
+        record_pipe.send_record(dict_to_bytes({
+            "digest": bytes_to_hexstr(hasher.digest()),
+        }))
 
-        with self._timing.add("tx file"):
-            with progress:
-                if filesize:
-                    # don't send zero-length files
-                    yield fs.beginFileTransfer(
-                        self._fd_to_send,
-                        record_pipe,
-                        transform=_count_and_hash)
-
-        expected_hash = hasher.digest()
-        expected_hex = bytes_to_hexstr(expected_hash)
-        print(u"File sent.. waiting for confirmation", file=stderr)
+    @inlineCallbacks
+    def _send_stream(self):
+        # stdin goes as it arrives, on a single connection, and no faster
+        # than the connection takes it. An empty record marks the end, and
+        # a record with the hash of everything before it follows, so the
+        # receiver can check what it passed along. The ack has that hash
+        # too.
+        hash_alg = self._hash_alg
+        record_pipe = yield self._connect_transit()
+        stderr = self._args.stderr
+        print(u"Sending (%s).." % record_pipe.describe(), file=stderr)
+        progress = self._progress()
+        hasher = new_hasher(hash_alg)
+        sent = [0]
+
+        def _count_and_hash(data):
+            hasher.update(data)
+            sent[0] += len(data)
+            progress.update(len(data))
+            return data
+
+        tx = self._timing.add("tx stream", hash_alg=hash_alg)
+        try:
+            with tx:
+                with progress:
+                    yield record_pipe.sendStream(self._fd_to_send,
+                                                 transform=_count_and_hash)
+                digest = bytes_to_hexstr(hasher.digest())
+                record_pipe.send_records([
+                    b"",  # the end marker
+                    dict_to_bytes({"digest": digest}),
+                ])
+                tx.detail(stream_bytes=sent[0])
+            yield self._get_ack(record_pipe, hasher.digest())
+        finally:
+            self._finish_transit(record_pipe, tx)
+
+    def _send_uncached(self, cached):
+        # The receiver found some of the file's chunks (by their hash) in
+        # its cache, so we send the rest
+        tree = self._chunk_tree
+        if (tree is None or not isinstance(cached, list) or any(
+                not isinstance(i, six.integer_types) or isinstance(i, bool) or
+                not 0 <= i < len(tree.leaves) for i in cached)):
+            raise TransferError("bad list of cached chunks from remote: %r"
+                                % (cached, ))
+        skipper = chunkcache.ChunkSkipper(self._fd_to_send, tree, cached)
+        count = len(set(cached))
+        return self._send_extents(
+            skipper, tree.filesize,
+            u"%d of %d chunks were cached" % (count, len(tree.leaves)),
+            cached_chunks=count)
+
+    def _send_sparse(self):
+        # the receiver will leave the file's holes as holes, so we send
+        # just the data around them
+        extents = self._extents
+        if extents is None:
+            raise TransferError("remote asked for a sparse file, but we "
+                                "didn't offer one")
+        reader = sparse.ExtentReader(self._fd_to_send, extents)
+        filesize = os.fstat(self._fd_to_send.fileno()).st_size
+        holes = filesize - reader.size
+        return self._send_extents(
+            reader, filesize, u"skipping %s of holes" % naturalsize(holes),
+            hole_bytes=holes)
+
+    @inlineCallbacks
+    def _send_extents(self, reader, filesize, note, **details):
+        # Send the parts of the file that 'reader' gives us, in order, on a
+        # single connection. The ack still covers the whole file, which we
+        # hash on a thread (with a file of its own) as we go.
+        hash_alg = self._hash_alg or u"sha256"
+        hash_d = succeed(self._prehash)
+        if self._prehash is None or hash_alg != u"sha256":
+            hasher = new_hasher(hash_alg)
+
+            def _hash_file():
+                with open(self._fd_to_send.name, "rb") as f:
+                    hash_file_prefix(f, filesize, hasher)
+                return hasher.digest()
+
+            hash_d = threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(), _hash_file)
+
+        record_pipe = yield self._connect_transit()
+        stderr = self._args.stderr
+        print(u"Sending (%s), %s.." % (record_pipe.describe(), note),
+              file=stderr)
+        progress = self._progress(total=reader.size)
+
+        def _count(data):
+            progress.update(len(data))
+            return data
+
+        tx = self._timing.add("tx file", hash_alg=hash_alg)
+        try:
+            with tx:
+                with progress:
+                    if reader.size:
+                        yield record_pipe.sendFile(reader, transform=_count)
+                tx.detail(**details)
+                expected_hash = yield hash_d
+            yield self._get_ack(record_pipe, expected_hash)
+        finally:
+            self._finish_transit(record_pipe, tx)
+
+    @inlineCallbacks
+    def _send_delta(self, request):
+        # The receiver has an older copy of the file, and sends the hash of
+        # each of its blocks. We send the blocks it doesn't have, and where
+        # to find the ones it does, in order, on a single connection.
+        block_size = request.get("block_size")
+        blocks = request.get("blocks")
+        for value in (block_size, blocks):
+            if (not isinstance(value, six.integer_types) or
+                    isinstance(value, bool) or value < 0):
+                raise TransferError("bad delta request from remote: %r" %
+                                    (request, ))
+        if request.get("format") != delta.FORMAT or not block_size:
+            raise TransferError("bad delta request from remote: %r" %
+                                (request, ))
+
+        record_pipe = yield self._connect_transit()
+        stderr = self._args.stderr
+        print(u"Sending changes (%s).." % record_pipe.describe(), file=stderr)
+
+        hash_alg = self._hash_alg or u"sha256"
+        tx = self._timing.add("tx delta", hash_alg=hash_alg)
+        try:
+            with tx:
+                signatures = yield self._receive_signatures(record_pipe,
+                                                            blocks)
+                # this reads (and hashes) the whole file
+                self._fd_to_send.seek(0, 2)
+                filesize = self._fd_to_send.tell()
+                hasher = new_hasher(hash_alg)
+                with self._timing.add("plan delta"):
+                    ops = yield threads.deferToThreadPool(
+                        self._reactor, self._reactor.getThreadPool(),
+                        delta.plan, self._fd_to_send, filesize, block_size,
+                        signatures, hash_alg, hasher)
+                expected_hash = hasher.digest()
+                # so the receiver can check what it builds, before keeping
+                # it
+                record_pipe.send_record(expected_hash)
+                reader = delta.DeltaReader(self._fd_to_send, ops)
+                progress = self._progress(total=reader.size)
+
+                def _count(data):
+                    progress.update(len(data))
+                    return data
+
+                with progress:
+                    yield record_pipe.sendFile(reader, transform=_count)
+                record_pipe.send_record(b"")  # the end marker
+                tx.detail(
+                    literal_bytes=reader.literal_bytes,
+                    copied_bytes=reader.copied_bytes)
+            yield self._get_ack(record_pipe, expected_hash)
+        finally:
+            self._finish_transit(record_pipe, tx)
+
+    @inlineCallbacks
+    def _receive_signatures(self, record_pipe, blocks):
+        # the hash of each block of the receiver's old copy
+        wanted = blocks * delta.DIGEST_SIZE
+        signatures = []
+        received = 0
+        while received < wanted:
+            record = yield record_pipe.receive_record()
+            signatures.append(record)
+            received += len(record)
+        if received != wanted:
+            raise TransferError("bad delta request from remote: "
+                                "too many block hashes")
+        returnValue(b"".join(signatures))
+
+    @inlineCallbacks
+    def _connect_transit(self, striped=False):
+        # Unless the transfer is striped, it only uses the first connection,
+        # and the rest are closed as they arrive. Whatever happens after
+        # this, the caller must _finish_transit().
+        ts = self._transit_sender
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected")
+        if not striped:
+            ts.stop_striping()
+            ts.observe_stripes(lambda p: p.close())
+        returnValue(record_pipe)
+
+    def _abort_transit(self):
+        # we're giving up: a reconnection (or a transfer that never got
+        # going) might still be listening for the receiver
+        if self._transit_sender is not None:
+            self._transit_sender.stop_listening()
+
+    def _progress(self, **kwargs):
+        return tqdm(
+            file=self._args.stderr,
+            disable=self._args.hide_progress,
+            unit="B",
+            unit_scale=True,
+            **kwargs)
+
+    def _finish_transit(self, record_pipe, event, striper=None):
+        # whether or not the transfer worked, we're done with every
+        # connection, and with listening for more
+        self._transit_sender.stop_listening()
+        record_pipe.close()
+        if striper is not None:
+            striper.close()
+        # only now has every record been compressed and written
+        stats = record_pipe.compression_stats()
+        if stats:
+            event.detail(**stats)
+
+    @inlineCallbacks
+    def _get_ack(self, record_pipe, expected_hash):
+        print(u"File sent.. waiting for confirmation", file=self._args.stderr)
         with self._timing.add("get ack") as t:
             ack_bytes = yield record_pipe.receive_record()
-            record_pipe.close()
-            ack = bytes_to_dict(ack_bytes)
-            ok = ack.get(u"ack", u"")
-            if ok != u"ok":
-                t.detail(ack="failed")
-                raise TransferError("Transfer failed (remote says: %r)" % ack)
-            if u"sha256" in ack:
-                if ack[u"sha256"] != expected_hex:
-                    t.detail(datahash="failed")
-                    raise TransferError("Transfer failed (bad remote hash)")
-            print(u"Confirmation received. Transfer complete.", file=stderr)
-            t.detail(ack="ok")
+            self._check_ack(bytes_to_dict(ack_bytes), expected_hash, t)
+
+    def _check_ack(self, ack, expected_hash, t):
+        expected_hex = bytes_to_hexstr(expected_hash)
+        ok = ack.get(u"ack", u"")
+        if ok == u"error" and u"error" in ack:
+            t.detail(ack="failed")
+            raise TransferError(
+                "remote error, transfer abandoned: %s" % ack[u"error"])
+        if ok != u"ok":
+            t.detail(ack="failed")
+            raise TransferError("Transfer failed (remote says: %r)" % ack)
+        if self._hash_alg is not None:
+            theirs = (ack.get(u"hash_alg"), ack.get(u"digest"))
+            if theirs != (self._hash_alg, expected_hex):
+                t.detail(datahash="failed")
+                raise TransferError("Transfer failed (bad remote hash)")
+        elif u"sha256" in ack:
+            if ack[u"sha256"] != expected_hex:
+                t.detail(datahash="failed")
+                raise TransferError("Transfer failed (bad remote hash)")
+        print(u"Confirmation received. Transfer complete.",
+              file=self._args.stderr)
+        t.detail(ack="ok")
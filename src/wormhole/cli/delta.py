@@ -0,0 +1,220 @@
+import struct
+from collections import deque
+
+from ..errors import TransferError
+from ..util import hash_file_prefix, new_hasher
+
+# the name of this protocol, in the offer and the answer
+FORMAT = u"blocks-v1"
+
+# The receiver sends the hash of each block of the copy it already has, and
+# the sender looks up each block of its file in those. A block is
+# identified by the first DIGEST_SIZE bytes of its hash (with the hash that
+# covers the whole transfer), so a lucky collision can only cost a failed
+# transfer, which the final hash will catch.
+DIGEST_SIZE = 16
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+# how much of the receiver's signatures to send in each record
+SIGNATURE_RECORD_SIZE = 16 * 1024
+
+# The delta is a stream of operations, in the order that they fill the new
+# file. LITERAL is followed by that many bytes of data, and COPY names a
+# range of the receiver's old copy.
+LITERAL = struct.Struct(">cQ")  # b"L", length
+COPY = struct.Struct(">cQQ")  # b"C", offset in the old copy, length
+
+
+def block_size_for(size):
+    """Pick a block size for a file of 'size' bytes: about the square root
+    of its size (as rsync does), as a power of two."""
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def _digest(hash_alg, data):
+    hasher = new_hasher(hash_alg)
+    hasher.update(data)
+    return hasher.digest()[:DIGEST_SIZE]
+
+
+def signatures(filename, block_size, hash_alg):
+    """Return the digests of each block of a file, all run together."""
+    digests = []
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            digests.append(_digest(hash_alg, data))
+    return b"".join(digests)
+
+
+def plan(f, filesize, block_size, signatures, hash_alg, hasher):
+    """Compare each block of 'f' with the receiver's 'signatures', and
+    return the operations that rebuild 'f' from the receiver's copy, as a
+    list of (LITERAL, offset in 'f', length) and (COPY, offset in their
+    copy, length). Neighbouring blocks that need the same operation are
+    merged. The whole file is fed to 'hasher' on the way."""
+    blocks = {}
+    for i in range(len(signatures) // DIGEST_SIZE):
+        digest = signatures[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        blocks.setdefault(digest, i * block_size)
+    ops = []
+    f.seek(0)
+    offset = 0
+    while offset < filesize:
+        data = f.read(min(block_size, filesize - offset))
+        if not data:
+            raise EnvironmentError("file changed while it was being read")
+        hasher.update(data)
+        old_offset = blocks.get(_digest(hash_alg, data))
+        if old_offset is None:
+            op = (LITERAL, offset, len(data))
+        else:
+            op = (COPY, old_offset, len(data))
+        last = ops[-1] if ops else None
+        if (last is not None and last[0] is op[0] and
+                last[1] + last[2] == op[1]):
+            ops[-1] = (last[0], last[1], last[2] + op[2])
+        else:
+            ops.append(op)
+        offset += len(data)
+    return ops
+
+
+class DeltaReader(object):
+    """I look like a file (enough for a FileSender), whose contents are
+    the delta stream for 'ops', with each literal read from 'f' as it is
+    needed."""
+
+    def __init__(self, f, ops):
+        self._f = f
+        self._ops = deque(ops)
+        self._literal_left = 0
+        self.size = 0
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+        for (kind, offset, length) in ops:
+            if kind is LITERAL:
+                self.size += LITERAL.size + length
+                self.literal_bytes += length
+            else:
+                self.size += COPY.size
+                self.copied_bytes += length
+
+    def read(self, size):
+        pieces = []
+        while size:
+            if self._literal_left:
+                data = self._f.read(min(size, self._literal_left))
+                if not data:
+                    raise EnvironmentError("file changed while it was sent")
+                self._literal_left -= len(data)
+            elif self._ops and self._header_size() <= size:
+                (kind, offset, length) = self._ops.popleft()
+                if kind is LITERAL:
+                    data = LITERAL.pack(b"L", length)
+                    self._f.seek(offset)
+                    self._literal_left = length
+                else:
+                    data = COPY.pack(b"C", offset, length)
+            else:
+                break
+            pieces.append(data)
+            size -= len(data)
+        return b"".join(pieces)
+
+    def _header_size(self):
+        return LITERAL.size if self._ops[0][0] is LITERAL else COPY.size
+
+
+class DeltaPatcher(object):
+    """I rebuild a file from a delta stream, which my write() is given in
+    order. Literal data goes straight into 'out' (where it belongs in the
+    new file), and the ranges to copy from 'basis' (the old copy, which is
+    'basis_size' bytes long) are saved up, so finish() can copy them
+    without holding up the caller of write().
+    """
+
+    def __init__(self, basis, basis_size, out, filesize):
+        self._basis = basis
+        self._basis_size = basis_size
+        self._out = out
+        self._filesize = filesize
+        self._offset = 0  # where the next operation goes in the new file
+        self._header = b""
+        self._literal_left = 0
+        self._copies = []  # (offset in out, offset in basis, length)
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+        self.error = None
+
+    def write(self, data):
+        pos = 0
+        while pos < len(data) and self.error is None:
+            if self._literal_left:
+                piece = data[pos:pos + self._literal_left]
+                self._out.seek(self._offset)
+                self._out.write(piece)
+                self._offset += len(piece)
+                self._literal_left -= len(piece)
+                self.literal_bytes += len(piece)
+                pos += len(piece)
+                continue
+            if not self._header:
+                kind = data[pos:pos + 1]
+                if kind not in (b"L", b"C"):
+                    self.error = "unknown delta operation %r" % (kind, )
+                    return
+            else:
+                kind = self._header[:1]
+            header_size = LITERAL.size if kind == b"L" else COPY.size
+            piece = data[pos:pos + header_size - len(self._header)]
+            self._header += piece
+            pos += len(piece)
+            if len(self._header) == header_size:
+                self._operation(self._header)
+                self._header = b""
+
+    def _operation(self, header):
+        if header[:1] == b"L":
+            (_, length) = LITERAL.unpack(header)
+        else:
+            (_, basis_offset, length) = COPY.unpack(header)
+        if self._offset + length > self._filesize:
+            self.error = "delta is bigger than the file"
+            return
+        if header[:1] == b"L":
+            self._literal_left = length
+            return
+        if basis_offset + length > self._basis_size:
+            self.error = "delta copies from outside the old file"
+            return
+        self._copies.append((self._offset, basis_offset, length))
+        self._offset += length
+        self.copied_bytes += length
+
+    def finish(self, hasher, chunk_size=1024 * 1024):
+        """Copy the saved-up ranges into place, then feed the whole new file
+        to 'hasher', and return its digest. This reads and writes a lot, so
+        it belongs on a thread."""
+        if self.error is None and (self._header or self._literal_left or
+                                   self._offset != self._filesize):
+            self.error = "delta ended early"
+        if self.error is not None:
+            raise TransferError("bad delta from sender: %s" % self.error)
+        for (offset, basis_offset, length) in self._copies:
+            self._basis.seek(basis_offset)
+            self._out.seek(offset)
+            while length:
+                data = self._basis.read(min(chunk_size, length))
+                if not data:
+                    raise TransferError("old file changed while it was read")
+                self._out.write(data)
+                length -= len(data)
+        self._out.flush()
+        hash_file_prefix(self._out, self._filesize, hasher)
+        return hasher.digest()
@@ -0,0 +1,128 @@
+import os
+
+import six
+
+from ..util import (WorkerPool, available_hash_algorithms, bytes_to_hexstr,
+                    new_hasher)
+
+READ_SIZE = 256 * 1024
+
+
+def _hash_file(hash_alg, filename):
+    hasher = new_hasher(hash_alg)
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return bytes_to_hexstr(hasher.digest())
+
+
+def _zip_name(archivename):
+    # (the name a ZipStream gives the file)
+    name = archivename.replace(os.sep, "/")
+    if os.altsep:
+        name = name.replace(os.altsep, "/")
+    return name
+
+
+class Manifest(object):
+    """I list the files of a directory. Each entry is the file's name in the
+    zipfile (with '/' separators), its size, its mtime (in whole seconds),
+    and the hex hash of its contents."""
+
+    def __init__(self, hash_alg, entries):
+        self.hash_alg = hash_alg
+        self.entries = entries
+
+    def to_dict(self):
+        return {
+            "hash_alg": self.hash_alg,
+            "files": [list(entry) for entry in self.entries],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Build a Manifest from an offer's dict. Raises ValueError if we
+        can't use it."""
+        if not isinstance(d, dict):
+            raise ValueError("not a dict")
+        hash_alg = d.get("hash_alg")
+        if hash_alg not in available_hash_algorithms():
+            raise ValueError("unknown hash algorithm %r" % (hash_alg, ))
+        files = d.get("files")
+        if not isinstance(files, list):
+            raise ValueError("no list of files")
+        digest_size = len(new_hasher(hash_alg).digest())
+        entries = []
+        for entry in files:
+            if not isinstance(entry, list) or len(entry) != 4:
+                raise ValueError("bad entry %r" % (entry, ))
+            (name, size, mtime, digest) = entry
+            if (not isinstance(name, six.string_types) or
+                    not isinstance(digest, six.string_types) or
+                    len(digest) != 2 * digest_size):
+                raise ValueError("bad entry %r" % (entry, ))
+            for value in (size, mtime):
+                if (not isinstance(value, six.integer_types) or
+                        isinstance(value, bool) or value < 0):
+                    raise ValueError("bad entry %r" % (entry, ))
+            parts = name.split("/")
+            if any(part in ("", ".", "..") for part in parts):
+                raise ValueError("bad name %r" % (name, ))
+            entries.append((name, size, mtime, digest.lower()))
+        return cls(hash_alg, entries)
+
+
+def build(files, hash_alg, jobs=1):
+    """Hash each of 'files' (a list of (localfilename, archivename), as
+    for a ZipStream), on 'jobs' threads at once, and return a Manifest."""
+    pool = WorkerPool(jobs)
+    try:
+        pending = []
+        for (localfilename, archivename) in files:
+            st = os.stat(localfilename)
+            task = pool.submit(_hash_file, hash_alg, localfilename)
+            pending.append((_zip_name(archivename), st.st_size,
+                            int(st.st_mtime), task))
+        entries = [(name, size, mtime, task.result())
+                   for (name, size, mtime, task) in pending]
+    finally:
+        pool.close()
+    return Manifest(hash_alg, entries)
+
+
+def missing(manifest, dest_dir, extract_path, jobs=1):
+    """Return the indexes of the entries in 'manifest' that 'dest_dir'
+    doesn't have, or has a different version of. extract_path(dest_dir,
+    name) says where each one lives. A file with the right size and mtime
+    is taken to be the same (as rsync does), and one with just the right
+    size is hashed, on 'jobs' threads at once."""
+    pool = WorkerPool(jobs)
+    try:
+        wanted = []
+        pending = []
+        for (index, (name, size, mtime, digest)) in enumerate(
+                manifest.entries):
+            path = extract_path(dest_dir, name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                wanted.append(index)
+                continue
+            if not os.path.isfile(path) or st.st_size != size:
+                wanted.append(index)
+            elif int(st.st_mtime) != mtime:
+                task = pool.submit(_hash_file, manifest.hash_alg, path)
+                pending.append((index, digest, task))
+        for (index, digest, task) in pending:
+            try:
+                if task.result() == digest:
+                    continue
+            except EnvironmentError:
+                pass
+            wanted.append(index)
+    finally:
+        pool.close()
+    return sorted(wanted)
@@ -0,0 +1,215 @@
+from binascii import unhexlify
+from collections import deque
+
+import six
+
+from ..util import (ThreadedHasher, WorkerPool, available_hash_algorithms,
+                    bytes_to_hexstr, new_hasher)
+
+# A file is hashed in chunks of at least this size, with more than this many
+# of them only when the file is too big for that: a bigger file gets bigger
+# chunks, so the list of chunk hashes (which goes in the offer) stays small.
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNKS = 1024
+
+# Leaves and interior nodes are hashed with different prefixes, so one
+# can't be passed off as the other.
+LEAF = b"\x00"
+NODE = b"\x01"
+
+
+def chunk_size_for(filesize):
+    chunk_size = CHUNK_SIZE
+    while filesize > chunk_size * MAX_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+
+def _leaf_hasher(hash_alg):
+    hasher = new_hasher(hash_alg)
+    hasher.update(LEAF)
+    return hasher
+
+
+def _hash_chunk(hash_alg, filename, offset, length):
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise EnvironmentError("%s changed while it was being hashed" %
+                               (filename, ))
+    hasher = _leaf_hasher(hash_alg)
+    hasher.update(data)
+    return hasher.digest()
+
+
+def merkle_root(hash_alg, leaves):
+    """Return the root of the tree over 'leaves' (a list of leaf hashes).
+    Each node hashes the pair below it, and the odd one out at the end of a
+    level moves up unchanged. A file with no chunks has the hash of an
+    empty leaf as its root."""
+    if not leaves:
+        return _leaf_hasher(hash_alg).digest()
+    level = list(leaves)
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            hasher = new_hasher(hash_alg)
+            hasher.update(NODE + level[i] + level[i + 1])
+            parents.append(hasher.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+class ChunkTree(object):
+    """I hold the hashes of each chunk of a file, and their Merkle root."""
+
+    def __init__(self, hash_alg, chunk_size, filesize, leaves):
+        self.hash_alg = hash_alg
+        self.chunk_size = chunk_size
+        self.filesize = filesize
+        self.leaves = leaves
+        self.root = merkle_root(hash_alg, leaves)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.filesize - index * self.chunk_size)
+
+    def to_dict(self):
+        return {
+            "hash_alg": self.hash_alg,
+            "chunk_size": self.chunk_size,
+            "root": bytes_to_hexstr(self.root),
+            "leaves": [bytes_to_hexstr(leaf) for leaf in self.leaves],
+        }
+
+    @classmethod
+    def from_dict(cls, d, filesize):
+        """Build a ChunkTree from an offer's dict, for a file of 'filesize'
+        bytes. Raises ValueError if we can't use it."""
+        if not isinstance(d, dict):
+            raise ValueError("not a dict")
+        hash_alg = d.get("hash_alg")
+        if hash_alg not in available_hash_algorithms():
+            raise ValueError("unknown hash algorithm %r" % (hash_alg, ))
+        chunk_size = d.get("chunk_size")
+        if not isinstance(chunk_size, six.integer_types) or chunk_size < 1:
+            raise ValueError("bad chunk size %r" % (chunk_size, ))
+        leaves = d.get("leaves")
+        if (not isinstance(leaves, list) or
+                len(leaves) != -(-filesize // chunk_size)):
+            raise ValueError("wrong number of chunk hashes")
+        digest_size = len(new_hasher(hash_alg).digest())
+        try:
+            leaves = [unhexlify(leaf.encode("ascii")) for leaf in leaves]
+            root = unhexlify(d.get("root").encode("ascii"))
+        except (AttributeError, TypeError, ValueError, UnicodeError):
+            raise ValueError("chunk hashes aren't hex")
+        if any(len(leaf) != digest_size for leaf in leaves):
+            raise ValueError("chunk hashes are the wrong size")
+        tree = cls(hash_alg, chunk_size, filesize, leaves)
+        if tree.root != root:
+            raise ValueError("chunk hashes don't match their root")
+        return tree
+
+
+def hash_file(filename, filesize, hash_alg, jobs=1, progress=None):
+    """Hash each chunk of a file, on 'jobs' threads at once, and return a
+    ChunkTree. If given, progress() is called with the size of each chunk
+    once it has been hashed."""
+    chunk_size = chunk_size_for(filesize)
+    pool = WorkerPool(jobs)
+    try:
+        tasks = [
+            pool.submit(_hash_chunk, hash_alg, filename, offset,
+                        min(chunk_size, filesize - offset))
+            for offset in range(0, filesize, chunk_size)
+        ]
+        leaves = []
+        for (offset, task) in zip(range(0, filesize, chunk_size), tasks):
+            leaves.append(task.result())
+            if progress:
+                progress(min(chunk_size, filesize - offset))
+    finally:
+        pool.close()
+    return ChunkTree(hash_alg, chunk_size, filesize, leaves)
+
+
+class ChunkVerifier(object):
+    """I check a file against a ChunkTree as it arrives. Give my update()
+    the file's data in order, starting at 'offset'. Each chunk is hashed on
+    a thread of its own, with up to 'jobs' of them at once (or right away,
+    if 'jobs' is 1), and I call on_bad() with the index of the first chunk
+    that doesn't match, after which I ignore any more data. A chunk that
+    'offset' lands in the middle of isn't checked. on_bad can be replaced
+    between calls, e.g. when the data starts coming from a new connection.
+    """
+
+    def __init__(self, tree, offset=0, jobs=1, on_bad=None):
+        self._tree = tree
+        self._jobs = jobs
+        self.on_bad = on_bad
+        self._index = -(-offset // tree.chunk_size)
+        self._skip = self._index * tree.chunk_size - offset
+        self._hasher = None  # for the chunk that's arriving
+        self._needed = 0  # how much more of it there is
+        self._pending = deque()  # (index, hasher) of chunks being hashed
+        self.checked = 0
+        self.bad_chunk = None
+
+    def update(self, data):
+        if self.bad_chunk is not None:
+            return
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        while data and self._index < len(self._tree.leaves):
+            if self._hasher is None:
+                self._hasher = _leaf_hasher(self._tree.hash_alg)
+                if self._jobs > 1:
+                    self._hasher = ThreadedHasher(self._hasher)
+                self._needed = self._tree.chunk_length(self._index)
+            piece = data[:self._needed]
+            data = data[len(piece):]
+            self._hasher.update(piece)
+            self._needed -= len(piece)
+            if not self._needed:
+                self._pending.append((self._index, self._hasher))
+                self._hasher = None
+                self._index += 1
+                while len(self._pending) >= self._jobs:
+                    self._check()
+                if self.bad_chunk is not None:
+                    return
+
+    def flush(self):
+        """Check every whole chunk I've been given."""
+        while self._pending:
+            self._check()
+
+    def _check(self):
+        index, hasher = self._pending.popleft()
+        digest = hasher.digest()
+        if isinstance(hasher, ThreadedHasher):
+            hasher.close()
+        if self.bad_chunk is not None:
+            return
+        if digest != self._tree.leaves[index]:
+            self.bad_chunk = index
+            self.close()
+            if self.on_bad:
+                self.on_bad(index)
+            return
+        self.checked += 1
+
+    def close(self):
+        """Stop any hashing threads, without checking their chunks."""
+        for (index, hasher) in self._pending:
+            if isinstance(hasher, ThreadedHasher):
+                hasher.close()
+        self._pending.clear()
+        if isinstance(self._hasher, ThreadedHasher):
+            self._hasher.close()
+        self._hasher = None
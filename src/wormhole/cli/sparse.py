@@ -0,0 +1,179 @@
+import errno
+import os
+
+import six
+
+# A file is scanned for zeros in aligned blocks of this size, and a hole
+# shorter than this (from the filesystem, or a run of zero blocks) is sent
+# as data, since it isn't worth a place in the offer.
+BLOCK_SIZE = 64 * 1024
+# the most extents that an offer lists: beyond that, the smallest holes are
+# sent as data
+MAX_EXTENTS = 1024
+
+
+def _filesystem_extents(f, filesize):
+    # the (offset, length) of each run of data that the filesystem knows
+    # about, or None if it can't tell us
+    seek_data = getattr(os, "SEEK_DATA", None)
+    seek_hole = getattr(os, "SEEK_HOLE", None)
+    if seek_data is None or seek_hole is None:
+        return None
+    fd = f.fileno()
+    extents = []
+    offset = 0
+    try:
+        while offset < filesize:
+            try:
+                start = os.lseek(fd, offset, seek_data)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # there's nothing but a hole from here on
+                raise
+            end = min(os.lseek(fd, start, seek_hole), filesize)
+            if start >= end:
+                break  # (the file grew)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return None
+    finally:
+        f.seek(0)
+    return extents
+
+
+def _zero_free(f, extents):
+    # split 'extents' around each aligned block that is all zeros
+    zeros = b"\x00" * BLOCK_SIZE
+    found = []
+    for (offset, length) in extents:
+        end = offset + length
+        f.seek(offset)
+        while offset < end:
+            # (the first and last blocks may be partial, and are kept)
+            block_end = min(end, (offset // BLOCK_SIZE + 1) * BLOCK_SIZE)
+            data = f.read(block_end - offset)
+            if not data:
+                raise EnvironmentError("file changed while it was read")
+            if data != zeros:
+                if found and sum(found[-1]) == offset:
+                    found[-1] = (found[-1][0], found[-1][1] + len(data))
+                else:
+                    found.append((offset, len(data)))
+            offset += len(data)
+    f.seek(0)
+    return found
+
+
+def _coalesce(extents):
+    # send the short holes as data, and the smallest ones until there are
+    # few enough extents
+    merged = []
+    for (offset, length) in extents:
+        if merged and offset - sum(merged[-1]) < BLOCK_SIZE:
+            merged[-1] = (merged[-1][0], offset + length - merged[-1][0])
+        else:
+            merged.append((offset, length))
+    while len(merged) > MAX_EXTENTS:
+        holes = sorted(
+            (merged[i + 1][0] - sum(merged[i]), i)
+            for i in range(len(merged) - 1))
+        fill = set(i for (size, i) in holes[:len(merged) - MAX_EXTENTS])
+        coalesced = []
+        for (i, (offset, length)) in enumerate(merged):
+            if i - 1 in fill:
+                coalesced[-1] = (coalesced[-1][0],
+                                 offset + length - coalesced[-1][0])
+            else:
+                coalesced.append((offset, length))
+        merged = coalesced
+    return merged
+
+
+def find_extents(f, filesize, zeros=False):
+    """Return the (offset, length) of each run of data in 'f', leaving out
+    the holes that the filesystem knows about, and (if 'zeros') the aligned
+    blocks that are all zeros, or None if the file has no holes worth
+    skipping. Looking for zeros reads the whole file, so this belongs on a
+    thread."""
+    extents = _filesystem_extents(f, filesize)
+    if extents is None:
+        if not zeros:
+            return None
+        extents = [(0, filesize)] if filesize else []
+    if zeros:
+        extents = _zero_free(f, extents)
+    extents = _coalesce(extents)
+    if sum(length for (offset, length) in extents) == filesize:
+        return None
+    return extents
+
+
+def parse_extents(extents, filesize):
+    """Check a list of [offset, length] from an offer. Raises ValueError if
+    we can't use it."""
+    if not isinstance(extents, list):
+        raise ValueError("not a list")
+    parsed = []
+    end = 0
+    for extent in extents:
+        if not isinstance(extent, list) or len(extent) != 2:
+            raise ValueError("bad extent %r" % (extent, ))
+        for value in extent:
+            if (not isinstance(value, six.integer_types) or
+                    isinstance(value, bool)):
+                raise ValueError("bad extent %r" % (extent, ))
+        (offset, length) = extent
+        if offset < end or length < 1 or offset + length > filesize:
+            raise ValueError("extent %r is out of place" % (extent, ))
+        parsed.append((offset, length))
+        end = offset + length
+    return parsed
+
+
+class ExtentReader(object):
+    """I look like a file (enough for a FileSender), whose contents are
+    the 'extents' of 'f' (a list of (offset, length)), one after
+    another."""
+
+    def __init__(self, f, extents):
+        self._f = f
+        self._extents = list(extents)
+        self._left = 0  # in the extent we're reading
+        self.size = sum(length for (offset, length) in self._extents)
+
+    def read(self, size):
+        if not self._left:
+            if not self._extents:
+                return b""
+            (offset, self._left) = self._extents.pop(0)
+            self._f.seek(offset)
+        data = self._f.read(min(size, self._left))
+        if not data:
+            raise EnvironmentError("file changed while it was sent")
+        self._left -= len(data)
+        return data
+
+
+class ExtentWriter(object):
+    """I am the other end of an ExtentReader: my write() is given the
+    'extents' of the file, in order, and writes each one into 'f' where it
+    belongs."""
+
+    def __init__(self, f, extents):
+        self._f = f
+        self._extents = list(extents)
+        self._left = 0
+        self.size = sum(length for (offset, length) in self._extents)
+
+    def write(self, data):
+        while data:
+            if not self._left:
+                if not self._extents:
+                    return  # (more than we asked for)
+                (offset, self._left) = self._extents.pop(0)
+                self._f.seek(offset)
+            piece = data[:self._left]
+            self._f.write(piece)
+            self._left -= len(piece)
+            data = data[len(piece):]
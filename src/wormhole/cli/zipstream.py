@@ -0,0 +1,579 @@
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+from collections import deque
+
+from twisted.python import log
+
+from ..util import WorkerPool
+
+CHUNK_SIZE = 256 * 1024
+# past this, sizes and offsets need the zip64 extensions
+ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+
+# files that are compressed already, and won't shrink any further
+COMPRESSED_EXTENSIONS = frozenset([
+    ".7z", ".aac", ".apk", ".avi", ".br", ".bz2", ".deb", ".docx", ".epub",
+    ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz4", ".lzma",
+    ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".opus",
+    ".png", ".pptx", ".rar", ".rpm", ".tgz", ".txz", ".webm", ".webp",
+    ".whl", ".woff2", ".xlsx", ".xz", ".zip", ".zst",
+])
+# how much of each chunk to try compressing, and how much smaller it has to
+# get for the whole chunk to be worth compressing
+SAMPLE_SIZE = 16 * 1024
+WORTHWHILE = 0.9
+
+
+def is_compressed_name(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def _worth_compressing(data):
+    # a quick (level 1) trial run on the start of the data
+    sample = data[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * WORTHWHILE
+
+
+def _compress_chunk(filename, offset, length, last, compressible):
+    # Each chunk of a file gets its own compressor, so chunks can be
+    # compressed in parallel. Every chunk but the last ends with a sync
+    # flush (leaving the output on a byte boundary), and the last one ends
+    # the deflate stream, so their concatenation is one ordinary stream.
+    # Returns (data, compressed, stored).
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    stored = not (compressible and _worth_compressing(data))
+    if stored and offset == 0 and last:
+        # this is the whole file, which can be ZIP_STORED
+        return data, data, True
+    # Otherwise, deflate level 0 just wraps the data in stored blocks,
+    # which costs about as much as copying it, but still marks where the
+    # member ends (which ZIP_STORED with a data descriptor doesn't).
+    level = 0 if stored else zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, compressed, stored
+
+
+def _dos_date_time(mtime):
+    # zipfile timestamps are local time, and only cover 1980-2107
+    t = time.localtime(mtime)[:6]
+    t = max(min(t, (2107, 12, 31, 23, 59, 59)), (1980, 1, 1, 0, 0, 0))
+    date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+    dostime = t[3] << 11 | t[4] << 5 | t[5] // 2
+    return dostime, date
+
+
+class ZipStream(object):
+    """I am a read-only file that contains a zipfile of 'files' (a list of
+    (localfilename, archivename) pairs). The archive is built as I am read:
+    each read() compresses just enough of the files to satisfy it, so the
+    first bytes are available right away, and the archive is never held
+    anywhere in its entirety. The result is an ordinary zipfile, which
+    ZipFile can read once all of it has arrived.
+
+    Files are compressed in chunks of 'chunk_size' bytes, on 'jobs'
+    threads, a few chunks ahead of what has been read. The archive doesn't
+    depend on 'jobs': it is put together in the same order, from the same
+    chunks, however many threads compressed them. A file that fits in one
+    chunk has its sizes in its local header. Larger files are followed by
+    a data descriptor, since their header goes out before the rest of them
+    has been compressed.
+
+    Chunks that won't compress (judging by their file's extension, or by
+    trying a sample of them) are stored instead: a small file as a
+    ZIP_STORED member, and a chunk of a larger one as uncompressed deflate
+    blocks. .stored_bytes and .deflated_bytes count how much of the
+    (uncompressed) data went each way.
+
+    Files that can't be opened by the time we get to them are left out
+    (and logged), and a file that can't be read all the way through is
+    truncated. I can't seek, and I don't know how big I will be until
+    read() returns b"".
+    """
+
+    def __init__(self, files, chunk_size=CHUNK_SIZE, jobs=1):
+        self._chunk_size = chunk_size
+        self._packer = WorkerPool(jobs)
+        # how many chunks to compress ahead of the reader
+        self._window = 4 * jobs
+        self._buffer = deque()
+        self._buffered = 0
+        self._pieces = self._generate(files)
+        self._offset = 0
+        self.skipped = []
+        self.stored_bytes = 0
+        self.deflated_bytes = 0
+
+    def tell(self):
+        return self._offset
+
+    def read(self, size=-1):
+        while (size < 0 or self._buffered < size) and self._pieces is not None:
+            try:
+                piece = next(self._pieces)
+            except StopIteration:
+                self._pieces = None
+                break
+            self._buffer.append(piece)
+            self._buffered += len(piece)
+        if size < 0:
+            size = self._buffered
+        pieces = []
+        wanted = size
+        while wanted and self._buffer:
+            piece = self._buffer.popleft()
+            if len(piece) > wanted:
+                self._buffer.appendleft(piece[wanted:])
+                piece = piece[:wanted]
+            pieces.append(piece)
+            wanted -= len(piece)
+        data = b"".join(pieces)
+        self._buffered -= len(data)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if self._pieces is not None:
+            self._pieces.close()
+            self._pieces = None
+        self._packer.close()  # (in case nothing was read)
+
+    def _skip(self, localfilename, archivename, e):
+        log.msg("skipping %s: %s" % (localfilename, e))
+        self.skipped.append(archivename)
+
+    def _plan(self, files):
+        # yields (member, chunknum, task) for each chunk of each file, and
+        # starts compressing it
+        cs = self._chunk_size
+        for (localfilename, archivename) in files:
+            try:
+                st = os.stat(localfilename)
+            except EnvironmentError as e:
+                self._skip(localfilename, archivename, e)
+                continue
+            name = archivename.replace(os.sep, "/")
+            if os.altsep:
+                name = name.replace(os.altsep, "/")
+            chunks = max(1, (st.st_size + cs - 1) // cs)
+            compressible = not is_compressed_name(name)
+            member = {
+                "localfilename": localfilename,
+                "archivename": archivename,
+                "name": name,
+                "date_time": _dos_date_time(st.st_mtime),
+                "mode": st.st_mode & 0xffff,
+                "chunks": chunks,
+                # (the same allowance ZipFile.write() makes for growth)
+                "zip64": st.st_size * 1.05 > ZIP64_LIMIT,
+                "descriptor": chunks > 1,
+                "method": zipfile.ZIP_DEFLATED,
+                "failed": False,
+                "offset": None,
+                "crc": 0,
+                "csize": 0,
+                "usize": 0,
+            }
+            for n in range(chunks):
+                last = n == chunks - 1
+                length = st.st_size - n * cs if last else cs
+                task = self._packer.submit(_compress_chunk, localfilename,
+                                           n * cs, length, last, compressible)
+                yield (member, n, task)
+
+    def _generate(self, files):
+        # each step of this generator adds a little to the archive
+        plan = self._plan(files)
+        pending = deque()
+        members = []
+        offset = 0
+        try:
+            while True:
+                while len(pending) < self._window:
+                    try:
+                        pending.append(next(plan))
+                    except StopIteration:
+                        break
+                if not pending:
+                    break
+                (m, n, task) = pending.popleft()
+                if m["failed"]:
+                    continue
+                last = n == m["chunks"] - 1
+                try:
+                    (data, compressed, stored) = task.result()
+                except EnvironmentError as e:
+                    m["failed"] = True
+                    if n == 0:
+                        self._skip(m["localfilename"], m["archivename"], e)
+                        continue
+                    # its header has already gone out, so end it here
+                    log.msg("truncating %s: %s" % (m["localfilename"], e))
+                    data = b""
+                    compressed = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                        -15).flush()
+                    stored = False
+                    last = True
+                if stored:
+                    self.stored_bytes += len(data)
+                    if m["chunks"] == 1:
+                        m["method"] = zipfile.ZIP_STORED
+                else:
+                    self.deflated_bytes += len(data)
+                m["crc"] = zlib.crc32(data, m["crc"]) & 0xffffffff
+                m["csize"] += len(compressed)
+                m["usize"] += len(data)
+                if n == 0:
+                    m["offset"] = offset
+                    header = self._local_header(m)
+                    offset += len(header)
+                    yield header
+                offset += len(compressed)
+                yield compressed
+                if last:
+                    if m["descriptor"]:
+                        descriptor = struct.pack(
+                            "<4sLQQ" if m["zip64"] else "<4sLLL",
+                            DESCRIPTOR_SIG, m["crc"], m["csize"], m["usize"])
+                        offset += len(descriptor)
+                        yield descriptor
+                    members.append(m)
+            cd_offset = offset
+            for m in members:
+                header = self._central_header(m)
+                offset += len(header)
+                yield header
+            yield self._end_records(len(members), cd_offset,
+                                    offset - cd_offset)
+        finally:
+            plan.close()
+            self._packer.close()
+
+    def _encode_name(self, m):
+        try:
+            return m["name"].encode("ascii"), 0
+        except UnicodeError:
+            return m["name"].encode("utf-8"), FLAG_UTF8
+
+    def _local_header(self, m):
+        name, flags = self._encode_name(m)
+        extra = b""
+        if m["descriptor"]:
+            # the sizes come later, in the data descriptor
+            flags |= FLAG_DESCRIPTOR
+            crc = csize = usize = 0
+        else:
+            (crc, csize, usize) = (m["crc"], m["csize"], m["usize"])
+        if m["zip64"]:
+            extra = struct.pack("<HHQQ", ZIP64_EXTRA, 16, usize, csize)
+            csize = usize = 0xffffffff
+        (dostime, date) = m["date_time"]
+        return LOCAL_HEADER.pack(
+            b"PK\x03\x04", 45 if m["zip64"] else 20, flags, m["method"],
+            dostime, date, crc, csize, usize, len(name),
+            len(extra)) + name + extra
+
+    def _central_header(self, m):
+        name, flags = self._encode_name(m)
+        if m["descriptor"]:
+            flags |= FLAG_DESCRIPTOR
+        (csize, usize, offset) = (m["csize"], m["usize"], m["offset"])
+        extra = []
+        if usize > ZIP64_LIMIT:
+            extra.append(usize)
+            usize = 0xffffffff
+        if csize > ZIP64_LIMIT:
+            extra.append(csize)
+            csize = 0xffffffff
+        if offset > ZIP64_LIMIT:
+            extra.append(offset)
+            offset = 0xffffffff
+        if extra:
+            extra = struct.pack("<HH%dQ" % len(extra), ZIP64_EXTRA,
+                                8 * len(extra), *extra)
+        else:
+            extra = b""
+        version = 45 if extra or m["zip64"] else 20
+        create_system = 0 if sys.platform == "win32" else 3
+        (dostime, date) = m["date_time"]
+        return CENTRAL_HEADER.pack(
+            b"PK\x01\x02", create_system << 8 | version, version, flags,
+            m["method"], dostime, date, m["crc"], csize, usize,
+            len(name), len(extra), 0, 0, 0, m["mode"] << 16,
+            offset) + name + extra
+
+    def _end_records(self, count, cd_offset, cd_size):
+        records = b""
+        if (count >= 0xffff or cd_offset > ZIP64_LIMIT or
+                cd_size > ZIP64_LIMIT):
+            zip64_offset = cd_offset + cd_size
+            records += struct.pack("<4sQ2H2L4Q", b"PK\x06\x06", 44, 45, 45,
+                                   0, 0, count, count, cd_size, cd_offset)
+            records += struct.pack("<4sLQL", b"PK\x06\x07", 0, zip64_offset,
+                                   1)
+            count = min(count, 0xffff)
+            cd_offset = min(cd_offset, 0xffffffff)
+            cd_size = min(cd_size, 0xffffffff)
+        records += struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, count, count,
+                               cd_size, cd_offset, 0)
+        return records
+
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+DESCRIPTOR_SIG = b"PK\x07\x08"
+ZIP64_EXTRA = 0x0001
+END_SIGS = (b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+FLAG_ENCRYPTED = 0x01
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+class ZipExtractor(object):
+    """I am a write-only file: write() the bytes of a zipfile to me, in
+    order, and I extract each member into 'extract_dir' as soon as its data
+    arrives, so nothing needs to hold the whole archive. This works for
+    both ordinary zipfiles and ZipStreams, as long as each member is either
+    deflated, or stored with its size in its local header.
+
+    Each member's name is given to extract_path(extract_dir, name), which
+    returns where to write it, or raises ValueError if the name would
+    escape 'extract_dir'. Permissions are applied from the central
+    directory, at the end of the zipfile. Problems are remembered (and
+    later writes ignored) until close(), which raises them, or raises
+    BadZipfile if the zipfile was incomplete.
+    """
+
+    def __init__(self, extract_dir, extract_path, chunk_size=CHUNK_SIZE):
+        self._extract_dir = extract_dir
+        self._extract_path = extract_path
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()  # received, but not yet parsed
+        self._offset = 0
+        self._state = self._signature
+        self._member = None
+        self._paths = {}  # member name -> where we wrote it
+        self._modes = []  # (member name, mode) from the central directory
+        self._error = None
+        self.done = False
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        # (only so a resumed transfer can say where it starts again)
+        if offset != self._offset:
+            raise ValueError("ZipExtractor can't seek")
+
+    def write(self, data):
+        self._offset += len(data)
+        if self._error is not None or self.done:
+            return
+        self._buffer += data
+        try:
+            while self._state():
+                pass
+        except (zipfile.BadZipfile, ValueError, EnvironmentError,
+                zlib.error) as e:
+            self._error = e
+            self._close_member()
+
+    def close(self):
+        if self._error is None and not self.done:
+            self._error = zipfile.BadZipfile("incomplete zipfile")
+        self._close_member()
+        if self._error is not None:
+            raise self._error
+        for (name, mode) in self._modes:
+            if mode and name in self._paths:
+                os.chmod(self._paths[name], mode)
+
+    def _close_member(self):
+        if self._member is not None and self._member["f"] is not None:
+            self._member["f"].close()
+        self._member = None
+
+    # each state returns True if it made progress, or False if it needs
+    # more data
+
+    def _signature(self):
+        if len(self._buffer) < 4:
+            return False
+        sig = bytes(self._buffer[:4])
+        if sig == b"PK\x03\x04":
+            self._state = self._local_header
+        elif sig == b"PK\x01\x02":
+            self._state = self._central_header
+        elif sig in END_SIGS:
+            # the end-of-central-directory records tell us nothing new
+            self.done = True
+            del self._buffer[:]
+            return False
+        else:
+            raise zipfile.BadZipfile("bad zipfile signature %r" % (sig, ))
+        return True
+
+    def _local_header(self):
+        if len(self._buffer) < LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, csize, usize, namelen,
+         extralen) = LOCAL_HEADER.unpack_from(bytes(
+             self._buffer[:LOCAL_HEADER.size]))
+        end = LOCAL_HEADER.size + namelen + extralen
+        if len(self._buffer) < end:
+            return False
+        name = bytes(self._buffer[LOCAL_HEADER.size:
+                                  LOCAL_HEADER.size + namelen])
+        extra = bytes(self._buffer[LOCAL_HEADER.size + namelen:end])
+        del self._buffer[:end]
+
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        zip64 = False
+        while len(extra) >= 4:
+            (kind, size) = struct.unpack("<HH", extra[:4])
+            if kind == ZIP64_EXTRA and size >= 16:
+                zip64 = True
+                (usize, csize) = struct.unpack("<QQ", extra[4:20])
+            extra = extra[4 + size:]
+        if flags & FLAG_ENCRYPTED:
+            raise zipfile.BadZipfile("%s is encrypted" % name)
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipfile(
+                "%s uses unknown compression %d" % (name, method))
+        descriptor = bool(flags & FLAG_DESCRIPTOR)
+        if descriptor and method == zipfile.ZIP_STORED:
+            # there's no telling where its data ends
+            raise zipfile.BadZipfile(
+                "%s is stored without its size" % name)
+
+        out_path = self._extract_path(self._extract_dir, name)
+        f = None
+        if name.endswith("/"):
+            if not os.path.isdir(out_path):
+                os.makedirs(out_path)
+        else:
+            parent = os.path.dirname(out_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            f = open(out_path, "wb")
+            self._paths[name] = out_path
+        self._member = {
+            "name": name,
+            "f": f,
+            "zip64": zip64,
+            "descriptor": descriptor,
+            "crc": crc,
+            "csize": csize,
+            "usize": usize,
+            "remaining": None if descriptor else csize,
+            "decompressor": (zlib.decompressobj(-15)
+                             if method == zipfile.ZIP_DEFLATED else None),
+            "got_crc": 0,
+            "got_csize": 0,
+            "got_usize": 0,
+        }
+        self._state = self._data
+        return True
+
+    def _output(self, data):
+        m = self._member
+        if data and m["f"] is not None:
+            m["f"].write(data)
+        m["got_crc"] = zlib.crc32(data, m["got_crc"])
+        m["got_usize"] += len(data)
+
+    def _data(self):
+        m = self._member
+        d = m["decompressor"]
+        data = bytes(self._buffer)
+        if m["remaining"] is not None:
+            data = data[:m["remaining"]]
+        if not data and m["remaining"] != 0:
+            return False
+        del self._buffer[:len(data)]
+        finished = False
+        if d is None:
+            self._output(data)
+        else:
+            # limit each piece of output, so a small record can't
+            # decompress into a huge string
+            out = d.decompress(data, self._chunk_size)
+            self._output(out)
+            while d.unconsumed_tail and not d.unused_data:
+                out = d.decompress(d.unconsumed_tail, self._chunk_size)
+                self._output(out)
+            if d.unused_data:
+                # that was the end of the member's data
+                self._buffer[0:0] = d.unused_data
+                data = data[:len(data) - len(d.unused_data)]
+                finished = True
+        m["got_csize"] += len(data)
+        if m["remaining"] is not None:
+            m["remaining"] -= len(data)
+            finished = m["remaining"] == 0
+        if finished:
+            if d is not None:
+                self._output(d.flush())
+            self._member_done()
+        return True
+
+    def _member_done(self):
+        m = self._member
+        if m["f"] is not None:
+            m["f"].close()
+            m["f"] = None
+        if m["descriptor"]:
+            self._state = self._descriptor
+        else:
+            self._check_member(m["crc"], m["csize"], m["usize"])
+
+    def _descriptor(self):
+        if len(self._buffer) < 4:
+            return False
+        start = 4 if bytes(self._buffer[:4]) == DESCRIPTOR_SIG else 0
+        fmt = "<LQQ" if self._member["zip64"] else "<LLL"
+        end = start + struct.calcsize(fmt)
+        if len(self._buffer) < end:
+            return False
+        (crc, csize, usize) = struct.unpack(fmt,
+                                            bytes(self._buffer[start:end]))
+        del self._buffer[:end]
+        self._check_member(crc, csize, usize)
+        return True
+
+    def _check_member(self, crc, csize, usize):
+        m = self._member
+        if (m["got_crc"] & 0xffffffff, m["got_csize"],
+                m["got_usize"]) != (crc, csize, usize):
+            raise zipfile.BadZipfile("bad CRC or size for %s" % m["name"])
+        self._member = None
+        self._state = self._signature
+
+    def _central_header(self):
+        if len(self._buffer) < CENTRAL_HEADER.size:
+            return False
+        fields = CENTRAL_HEADER.unpack_from(bytes(
+            self._buffer[:CENTRAL_HEADER.size]))
+        (flags, namelen, extralen, commentlen) = (fields[3], fields[10],
+                                                  fields[11], fields[12])
+        external_attr = fields[15]
+        end = CENTRAL_HEADER.size + namelen + extralen + commentlen
+        if len(self._buffer) < end:
+            return False
+        name = bytes(self._buffer[CENTRAL_HEADER.size:
+                                  CENTRAL_HEADER.size + namelen])
+        del self._buffer[:end]
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        # not sure why zipfiles store the perms 16 bits away but they do
+        self._modes.append((name, external_attr >> 16))
+        self._state = self._signature
+        return True
@@ -1,10 +1,12 @@
 import os
 import sys
 
+from click.testing import CliRunner
 from twisted.trial import unittest
 
 import mock
 
+from ..cli import cli
 from ..cli.public_relay import RENDEZVOUS_RELAY, TRANSIT_RELAY
 from .common import config
 
@@ -17,7 +19,15 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.code_length, 2)
         self.assertEqual(cfg.dump_timing, None)
         self.assertEqual(cfg.hide_progress, False)
+        self.assertEqual(cfg.jobs, 1)
+        self.assertEqual(cfg.prehash, False)
+        self.assertEqual(cfg.chunk_hashes, False)
+        self.assertEqual(cfg.sparse, False)
+        self.assertEqual(cfg.manifest, False)
+        self.assertEqual(cfg.stream, False)
         self.assertEqual(cfg.listen, True)
+        self.assertEqual(cfg.spool_max_size, 10 * 1000 * 1000)
+        self.assertEqual(cfg.spool_dir, None)
         self.assertEqual(cfg.appid, None)
         self.assertEqual(cfg.relay_url, RENDEZVOUS_RELAY)
         self.assertEqual(cfg.transit_helper, TRANSIT_RELAY)
@@ -35,11 +45,25 @@ class Send(unittest.TestCase):
     def test_file(self):
         cfg = config("send", "fn")
         self.assertEqual(cfg.what, u"fn")
+        self.assertEqual(cfg.files, None)
         self.assertEqual(cfg.text, None)
 
+    def test_files(self):
+        cfg = config("send", "fn1", "fn2", "fn3")
+        self.assertEqual(cfg.what, None)
+        self.assertEqual(cfg.files, [u"fn1", u"fn2", u"fn3"])
+
+    def test_stream(self):
+        cfg = config("send", "--stream")
+        self.assertEqual(cfg.stream, True)
+        self.assertEqual(cfg.what, None)
+        self.assertEqual(cfg.files, None)
+        self.assertEqual(cfg.stdin, sys.stdin)
+
     def test_text(self):
         cfg = config("send", "--text", "hi")
         self.assertEqual(cfg.what, None)
+        self.assertEqual(cfg.files, None)
         self.assertEqual(cfg.text, u"hi")
 
     def test_nolisten(self):
@@ -66,6 +90,44 @@ class Send(unittest.TestCase):
         cfg = config("send", "--tor", "fn")
         self.assertEqual(cfg.tor, True)
 
+    def test_prehash(self):
+        cfg = config("send", "--prehash", "fn")
+        self.assertEqual(cfg.prehash, True)
+
+    def test_chunk_hashes(self):
+        cfg = config("send", "--chunk-hashes", "fn")
+        self.assertEqual(cfg.chunk_hashes, True)
+
+    def test_sparse(self):
+        cfg = config("send", "--sparse", "fn")
+        self.assertEqual(cfg.sparse, True)
+
+    def test_manifest(self):
+        cfg = config("send", "--manifest", "dn")
+        self.assertEqual(cfg.manifest, True)
+
+    def test_jobs(self):
+        cfg = config("send", "--jobs", "4", "fn")
+        self.assertEqual(cfg.jobs, 4)
+        cfg = config("send", "-j", "2", "fn")
+        self.assertEqual(cfg.jobs, 2)
+
+    def test_crypto_threads(self):
+        cfg = config("send", "--crypto-threads", "4", "fn")
+        self.assertEqual(cfg.crypto_threads, 4)
+        res = CliRunner().invoke(cli.wormhole,
+                                 ["send", "--crypto-threads", "-1", "fn"])
+        self.assertEqual(res.exit_code, 2)
+        self.assertIn("--crypto-threads", res.output)
+
+    def test_spool(self):
+        spool_dir = self.mktemp()
+        os.mkdir(spool_dir)
+        cfg = config("send", "--spool-max-size", "1000", "--spool-dir",
+                     spool_dir, "fn")
+        self.assertEqual(cfg.spool_max_size, 1000)
+        self.assertEqual(cfg.spool_dir, spool_dir)
+
     def test_verify(self):
         cfg = config("send", "--verify", "fn")
         self.assertEqual(cfg.verify, True)
@@ -103,13 +165,20 @@ class Receive(unittest.TestCase):
     def test_baseline(self):
         cfg = config("receive")
         self.assertEqual(cfg.accept_file, False)
+        self.assertEqual(cfg.chunk_cache, None)
+        self.assertEqual(cfg.chunk_cache_size, 10 * 1000 * 1000 * 1000)
         self.assertEqual(cfg.code, None)
         self.assertEqual(cfg.code_length, 2)
+        self.assertEqual(cfg.delta, False)
         self.assertEqual(cfg.dump_timing, None)
         self.assertEqual(cfg.hide_progress, False)
+        self.assertEqual(cfg.jobs, 1)
         self.assertEqual(cfg.listen, True)
         self.assertEqual(cfg.only_text, False)
         self.assertEqual(cfg.output_file, None)
+        self.assertEqual(cfg.spool_max_size, 10 * 1000 * 1000)
+        self.assertEqual(cfg.spool_dir, None)
+        self.assertEqual(cfg.stream, False)
         self.assertEqual(cfg.appid, None)
         self.assertEqual(cfg.relay_url, RENDEZVOUS_RELAY)
         self.assertEqual(cfg.transit_helper, TRANSIT_RELAY)
@@ -167,6 +236,33 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--output-file", "fn")
         self.assertEqual(cfg.output_file, u"fn")
 
+    def test_delta(self):
+        cfg = config("receive", "--delta")
+        self.assertEqual(cfg.delta, True)
+
+    def test_chunk_cache(self):
+        cfg = config("receive", "--chunk-cache", "cachedir",
+                     "--chunk-cache-size", "1000000")
+        self.assertEqual(cfg.chunk_cache, u"cachedir")
+        self.assertEqual(cfg.chunk_cache_size, 1000000)
+
+    def test_stream(self):
+        cfg = config("receive", "--stream", "1-abc")
+        self.assertEqual(cfg.stream, True)
+        cfg = config("receive", "--stream", "-0")
+        self.assertEqual(cfg.stream, True)
+
+    def test_jobs(self):
+        cfg = config("receive", "-j", "4")
+        self.assertEqual(cfg.jobs, 4)
+
+    def test_crypto_threads(self):
+        cfg = config("receive", "--crypto-threads", "2")
+        self.assertEqual(cfg.crypto_threads, 2)
+        res = CliRunner().invoke(cli.wormhole,
+                                 ["receive", "--crypto-threads", "-1"])
+        self.assertEqual(res.exit_code, 2)
+
     def test_relay_env_var(self):
         relay_url = str(mock.sentinel.relay_url)
         with mock.patch.dict(os.environ, WORMHOLE_RELAY_URL=relay_url):
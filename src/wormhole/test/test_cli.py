@@ -1,6 +1,8 @@
 from __future__ import print_function
 
+import hashlib
 import io
+import json
 import os
 import re
 import stat
@@ -12,7 +14,8 @@ import six
 from click.testing import CliRunner
 from humanize import naturalsize
 from twisted.internet import endpoints, reactor
-from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.defer import (gatherResults, inlineCallbacks,
+                                    returnValue, succeed)
 from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.utils import getProcessOutputAndValue
 from twisted.python import log, procutils
@@ -21,17 +24,18 @@ from zope.interface import implementer
 
 import mock
 
-from .. import __version__
+from .. import __version__, transit, util
 from .._interfaces import ITorManager
-from ..cli import cli, cmd_receive, cmd_send, welcome
+from ..cli import (chunkcache, cli, cmd_receive, cmd_send, delta, manifest,
+                   merkle, sparse, welcome, zipstream)
 from ..errors import (ServerConnectionError, TransferError,
                       UnsendableFileError, WelcomeError, WrongPasswordError)
 from .common import ServerBase, config
 
 
-def build_offer(args):
+def build_offer(args, stream=False):
     s = cmd_send.Sender(args, None)
-    return s._build_offer()
+    return s._build_offer(stream=stream)
 
 
 class OfferData(unittest.TestCase):
@@ -74,6 +78,68 @@ class OfferData(unittest.TestCase):
         self.assertNotIn("directory", d)
         self.assertEqual(d["file"]["filesize"], len(message))
         self.assertEqual(d["file"]["filename"], filename)
+        self.assertEqual(d["file"]["resumable"], True)
+        self.assertEqual(d["file"]["delta"], [delta.FORMAT])
+        self.assertNotIn("sha256", d["file"])
+        self.assertNotIn("extents", d["file"])
+        self.assertEqual(fd_to_send.tell(), 0)
+        self.assertEqual(fd_to_send.read(), message)
+
+    def test_file_sparse(self):
+        self.cfg.what = filename = "my file"
+        self.cfg.sparse = True
+        block = sparse.BLOCK_SIZE
+        message = b"yay ponies\n" + b"\x00" * (3 * block) + b"yay\n"
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, filename), "wb") as f:
+            f.write(message)
+
+        self.cfg.cwd = send_dir
+        d, fd_to_send = build_offer(self.cfg)
+
+        # (the first block isn't all zeros)
+        self.assertEqual(d["file"]["extents"],
+                         [[0, block], [3 * block, len(message) - 3 * block]])
+        self.assertEqual(fd_to_send.tell(), 0)
+        self.assertEqual(fd_to_send.read(), message)
+
+    def test_file_prehash(self):
+        self.cfg.what = filename = "my file"
+        self.cfg.prehash = True
+        message = b"yay ponies\n" * 1000
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, filename), "wb") as f:
+            f.write(message)
+
+        self.cfg.cwd = send_dir
+        d, fd_to_send = build_offer(self.cfg)
+
+        self.assertEqual(d["file"]["sha256"],
+                         hashlib.sha256(message).hexdigest())
+        self.assertEqual(fd_to_send.tell(), 0)
+        self.assertEqual(fd_to_send.read(), message)
+
+    def test_file_chunk_hashes(self):
+        self.cfg.what = filename = "my file"
+        self.cfg.chunk_hashes = True
+        self.cfg.jobs = 2
+        message = b"yay ponies\n" * 1000
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, filename), "wb") as f:
+            f.write(message)
+
+        self.cfg.cwd = send_dir
+        with mock.patch.object(merkle, "CHUNK_SIZE", 1000):
+            d, fd_to_send = build_offer(self.cfg)
+
+        tree = merkle.ChunkTree.from_dict(d["file"]["merkle"], len(message))
+        self.assertEqual(tree.hash_alg, util.available_hash_algorithms()[0])
+        self.assertEqual(tree.chunk_size, 1000)
+        self.assertEqual(len(tree.leaves), 11)
+        self.assertEqual(d["file"]["cached_chunks"], True)
         self.assertEqual(fd_to_send.tell(), 0)
         self.assertEqual(fd_to_send.read(), message)
 
@@ -121,6 +187,65 @@ class OfferData(unittest.TestCase):
         self.assertEqual(
             str(e), "Cannot send: no file/directory named '%s'" % filename)
 
+    def test_files(self):
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        os.mkdir(os.path.join(send_dir, "sub"))
+        for (name, data) in [("a", b"aaa"), ("b", b""),
+                             (os.path.join("sub", "c"), b"cc")]:
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(data)
+        self.cfg.files = [u"a", u"b", os.path.join(u"sub", u"c")]
+        self.cfg.cwd = send_dir
+
+        d, fd_to_send = build_offer(self.cfg)
+
+        self.assertEqual(d, {
+            "files": {
+                "files": [[u"a", 3], [u"b", 0], [u"c", 2]],
+                "numbytes": 5,
+            }
+        })
+        self.assertEqual(fd_to_send, None)
+        self.assertIn(u"Sending 3 files (5 Bytes)", self.cfg.stderr.getvalue())
+
+    def test_files_errors(self):
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        os.mkdir(os.path.join(send_dir, "sub"))
+        for name in ["a", os.path.join("sub", "a")]:
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(b"a")
+        self.cfg.cwd = send_dir
+
+        self.cfg.files = [u"a", u"missing"]
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertEqual(str(e), "Cannot send: no file named 'missing' "
+                         "(only files can be sent together)")
+        self.cfg.files = [u"a", u"sub"]
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertEqual(str(e), "Cannot send: no file named 'sub' "
+                         "(only files can be sent together)")
+        self.cfg.files = [u"a", os.path.join(u"sub", u"a")]
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertEqual(str(e), "Cannot send: more than one file named 'a'")
+
+    def test_stream(self):
+        self.cfg.stream = True
+        self.cfg.stdin = stdin = io.BytesIO(b"data")
+        d, fd_to_send = build_offer(self.cfg)
+
+        self.assertEqual(d, {"stream": {}})
+        # (nothing is read until it's sent)
+        self.assertIs(fd_to_send, stdin)
+        self.assertEqual(stdin.tell(), 0)
+        self.assertIn("Sending stdin as a stream", self.cfg.stderr.getvalue())
+
+        self.cfg.what = u"fn"
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertEqual(str(e), "Cannot send: --stream sends stdin, and "
+                         "nothing else")
+
     def _do_test_directory(self, addslash):
         parent_dir = self.mktemp()
         os.mkdir(parent_dir)
@@ -147,6 +272,9 @@ class OfferData(unittest.TestCase):
         self.assertEqual(d["directory"]["numfiles"], 5)
         self.assertIn("numbytes", d["directory"])
         self.assertIsInstance(d["directory"]["numbytes"], six.integer_types)
+        self.assertEqual(
+            d["directory"]["storedbytes"] + d["directory"]["deflatedbytes"],
+            d["directory"]["numbytes"])
 
         self.assertEqual(fd_to_send.tell(), 0)
         zdata = fd_to_send.read()
@@ -163,9 +291,81 @@ class OfferData(unittest.TestCase):
     def test_directory(self):
         return self._do_test_directory(addslash=False)
 
+    def test_directory_stream(self):
+        parent_dir = self.mktemp()
+        os.mkdir(parent_dir)
+        os.mkdir(os.path.join(parent_dir, "dirname"))
+        os.mkdir(os.path.join(parent_dir, "dirname", "sub"))
+        contents = {
+            "0": b"0 ponies\n",
+            os.path.join("sub", "1"): os.urandom(1000 * 1000),
+        }
+        for name, data in contents.items():
+            with open(os.path.join(parent_dir, "dirname", name), "wb") as f:
+                f.write(data)
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+
+        d, fd_to_send = build_offer(self.cfg, stream=True)
+
+        self.assertEqual(d["directory"]["dirname"], "dirname")
+        self.assertEqual(d["directory"]["mode"], "zipfile/stream")
+        self.assertEqual(d["directory"]["numfiles"], 2)
+        self.assertEqual(d["directory"]["numbytes"], 1000 * 1000 + 9)
+        self.assertNotIn("zipsize", d["directory"])
+        self.assertNotIn("resumable", d["directory"])
+        self.assertNotIn("manifest", d["directory"])
+
+        # the zipfile is built as it is read
+        first = fd_to_send.read(1000)
+        self.assertEqual(len(first), 1000)
+        self.assertEqual(fd_to_send.tell(), 1000)
+        zdata = first + fd_to_send.read()
+        self.assertEqual(fd_to_send.read(1000), b"")
+        with zipfile.ZipFile(io.BytesIO(zdata), "r") as zf:
+            self.assertEqual(sorted(zf.namelist()),
+                             sorted(n.replace(os.sep, "/") for n in contents))
+            for name, data in contents.items():
+                self.assertEqual(zf.read(name.replace(os.sep, "/")), data)
+
     def test_directory_addslash(self):
         return self._do_test_directory(addslash=True)
 
+    def test_directory_manifest(self):
+        parent_dir = self.mktemp()
+        os.mkdir(parent_dir)
+        os.mkdir(os.path.join(parent_dir, "dirname"))
+        os.mkdir(os.path.join(parent_dir, "dirname", "sub"))
+        contents = {
+            "0": b"0 ponies\n",
+            os.path.join("sub", "1"): b"1 ponies\n",
+        }
+        for name, data in contents.items():
+            path = os.path.join(parent_dir, "dirname", name)
+            with open(path, "wb") as f:
+                f.write(data)
+            os.utime(path, (1500000000, 1500000000))
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        self.cfg.manifest = True
+
+        d, fd_to_send = build_offer(self.cfg, stream=True)
+
+        m = d["directory"]["manifest"]
+        hash_alg = util.available_hash_algorithms()[0]
+        self.assertEqual(m["hash_alg"], hash_alg)
+
+        def digest(data):
+            hasher = util.new_hasher(hash_alg)
+            hasher.update(data)
+            return util.bytes_to_hexstr(hasher.digest())
+
+        self.assertEqual(
+            sorted(m["files"]),
+            sorted([n.replace(os.sep, "/"), len(data), 1500000000,
+                    digest(data)] for n, data in contents.items()))
+        fd_to_send.close()
+
     def test_unknown(self):
         self.cfg.what = filename = "unknown"
         send_dir = self.mktemp()
@@ -398,6 +598,346 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         self._env = yield self.is_runnable()
         yield ServerBase.setUp(self)
 
+    def _setup_features(self, send_cfg, recv_cfg, message, compress, jobs,
+                        prehash, chunk_hashes, sparse_file, update, inline,
+                        stripes):
+        # configure both sides for the optional features, and return the
+        # message to send (some of them need a bigger one)
+        if compress:
+            send_cfg.compress = True
+            message = message * 1000
+        send_cfg.jobs = recv_cfg.jobs = jobs
+        send_cfg.prehash = prehash
+        send_cfg.chunk_hashes = chunk_hashes
+        send_cfg.sparse = sparse_file
+        recv_cfg.delta = bool(update)
+        if not inline:
+            # (so a small file still goes through transit)
+            self.patch(cmd_send, "INLINE_MAX_SIZE", 0)
+        elif inline == "older":
+            # a receiver that doesn't list 'inline-files' in its versions
+            create = cmd_receive.create
+
+            def create_older(*args, **kwargs):
+                kwargs["versions"] = dict(kwargs["versions"])
+                del kwargs["versions"][u"inline-files"]
+                return create(*args, **kwargs)
+
+            self.patch(cmd_receive, "create", create_older)
+        if chunk_hashes:
+            # (the offer is built on a thread, some time later)
+            self.patch(merkle, "CHUNK_SIZE", 1000)
+        if stripes > 1:
+            send_cfg.stripes = stripes
+        if stripes > 1 and not update:
+            # enough for several records on each stripe (a delta only uses
+            # one, and a bigger file would have a copy of the changed block
+            # somewhere else in it)
+            message = message * 100000
+        return message
+
+    def _make_file(self, send_cfg, recv_cfg, send_dir, receive_dir, message,
+                   override_filename, overwrite, update, sparse_file,
+                   chunk_cache, partial, stripes):
+        # the file to send (a different one for some of the features), and
+        # whatever the receiver already has of it. Returns the file's
+        # contents, its names on each side, and the block size of a delta.
+        send_filename = u"testfil\u00EB"  # e-with-diaeresis
+        send_path = os.path.join(send_dir, send_filename)
+        with open(send_path, "w") as f:
+            f.write(message)
+        send_cfg.what = send_filename
+        receive_filename = send_filename
+
+        if override_filename:
+            recv_cfg.output_file = receive_filename = u"outfile"
+        if overwrite:
+            recv_cfg.output_file = receive_filename
+            existing_file = os.path.join(receive_dir, receive_filename)
+            with open(existing_file, 'w') as f:
+                f.write('pls overwrite me')
+        receive_path = os.path.join(receive_dir, receive_filename)
+        block_size = None
+        if update:
+            message, block_size = self._write_update(message, send_path,
+                                                     receive_path, update)
+        if sparse_file:
+            # 'wormhole send --sparse', with a run of zeros that covers
+            # two whole blocks
+            message = (message * 100 + "\0" * 200000 + message * 100)
+            with open(send_path, "w") as f:
+                f.write(message)
+        if chunk_cache:
+            message = self._write_chunk_cache(message, send_path, recv_cfg,
+                                              chunk_cache)
+        if partial:
+            message = self._write_partial(message, send_path, receive_path,
+                                          partial, stripes)
+        return message, send_filename, receive_filename, block_size
+
+    def _write_update(self, message, send_path, receive_path, update):
+        # 'wormhole receive --delta', with an older copy of the file ("old",
+        # or "small" enough to go inline), or without one ("none")
+        if update != "small":
+            message = message * 2000
+        with open(send_path, "w") as f:
+            f.write(message)
+        if update == "old":
+            with open(receive_path, "w") as f:
+                f.write(message[:5000] + "x" * 10 + message[5010:])
+        elif update == "small":
+            with open(receive_path, "w") as f:
+                f.write("an older copy")
+        return message, delta.block_size_for(len(message))
+
+    def _write_chunk_cache(self, message, send_path, recv_cfg, chunk_cache):
+        # 'wormhole receive --chunk-cache', with a cache that has the chunks
+        # of an older version of the file ("old"), or nothing ("empty")
+        message = message * 1000
+        with open(send_path, "w") as f:
+            f.write(message)
+        recv_cfg.chunk_cache = os.path.abspath(self.mktemp())
+        recv_cfg.chunk_cache_size = 10**9
+        if chunk_cache == "old":
+            old = (message[:5000] + "x" * 10 + message[5010:]).encode("ascii")
+            old_file = self.mktemp()
+            with open(old_file, "w+b") as f:
+                f.write(old)
+                tree = merkle.hash_file(old_file, len(old),
+                                        util.available_hash_algorithms()[0])
+                cache = chunkcache.ChunkCache(recv_cfg.chunk_cache,
+                                              recv_cfg.chunk_cache_size)
+                cache.store(f, tree)
+        return message
+
+    def _write_partial(self, message, send_path, receive_path, partial,
+                       stripes):
+        # an earlier receive got this far before the connection dropped. A
+        # "stale" checkpoint describes some other file.
+        if stripes == 1:
+            message = message * 1000
+        with open(send_path, "w") as f:
+            f.write(message)
+        partial_size = len(message) // 3
+        tmp_file = receive_path + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(message[:partial_size])
+        prefix = message[:partial_size].encode("ascii")
+        if partial == "stale":
+            prefix = b"x" + prefix[1:]
+        checkpoint = {
+            "filesize": len(message),
+            "offset": partial_size,
+            "hash_alg": u"sha256",
+            "digest": hashlib.sha256(prefix).hexdigest(),
+            "mtime": int(os.stat(send_path).st_mtime),
+        }
+        with open(tmp_file + ".checkpoint", "w") as f:
+            json.dump(checkpoint, f)
+        return message
+
+    def _make_directory(self, send_cfg, recv_cfg, send_dir, receive_dir,
+                        addslash, override_filename, overwrite, update):
+        # $send_dir/
+        # $send_dir/middle/
+        # $send_dir/middle/$dirname/
+        # $send_dir/middle/$dirname/[12345]
+        # cd $send_dir && wormhole send middle/$dirname
+        # cd $receive_dir && wormhole receive
+        # expect: $receive_dir/$dirname/[12345]
+        #
+        # Returns the function that makes each file's contents, where they
+        # are, their modes, and the name of the received directory.
+
+        send_dirname = u"testdir"
+
+        def message(i):
+            return "test message %d\n" % i
+
+        os.mkdir(os.path.join(send_dir, u"middle"))
+        source_dir = os.path.join(send_dir, u"middle", send_dirname)
+        os.mkdir(source_dir)
+        modes = {}
+        for i in range(5):
+            path = os.path.join(source_dir, str(i))
+            with open(path, "w") as f:
+                f.write(message(i))
+            if i == 3:
+                os.chmod(path, 0o755)
+            modes[i] = stat.S_IMODE(os.stat(path).st_mode)
+        send_dirname_arg = os.path.join(u"middle", send_dirname)
+        if addslash:
+            send_dirname_arg += os.sep
+        send_cfg.what = send_dirname_arg
+        receive_dirname = send_dirname
+
+        if override_filename:
+            recv_cfg.output_file = receive_dirname = u"outdir"
+        if overwrite:
+            recv_cfg.output_file = receive_dirname
+            os.mkdir(os.path.join(receive_dir, receive_dirname))
+        if update:
+            # 'wormhole receive --delta' of a directory that we already
+            # have some of ("old"), or none of ("none")
+            send_cfg.manifest = True
+        if update == "old":
+            self._write_old_directory(
+                os.path.join(receive_dir, receive_dirname), message)
+        return message, source_dir, modes, receive_dirname
+
+    def _write_old_directory(self, old_dir, message):
+        os.mkdir(old_dir)
+        for i in range(3):
+            with open(os.path.join(old_dir, str(i)), "w") as f:
+                f.write(message(i) if i < 2 else "old message\n")
+        # (the mtime doesn't match, so it's hashed)
+        os.utime(os.path.join(old_dir, "1"), (1500000000, 1500000000))
+        with open(os.path.join(old_dir, "extra"), "w") as f:
+            f.write("not in the manifest\n")
+
+    @inlineCallbacks
+    def _run_subprocess(self, send_cfg, recv_cfg, send_dir, receive_dir,
+                        output_file):
+        # returns the stdout and stderr of the sender, then the receiver
+        wormhole_bin = self.find_executable()
+        if send_cfg.text:
+            content_args = ['--text', send_cfg.text]
+        elif send_cfg.what:
+            content_args = [send_cfg.what]
+
+        # raise the rx KEY_TIMER to some large number here, to avoid
+        # spurious test failures on hosts that are slow enough to trigger
+        # the "Waiting for sender..." pacifier message. We can do in
+        # not-as_subprocess, because we can directly patch the value before
+        # running the receiver. But we can't patch across the subprocess
+        # boundary, so we use an environment variable.
+        env = self._env.copy()
+        env["_MAGIC_WORMHOLE_TEST_KEY_TIMER"] = "999999"
+        env["_MAGIC_WORMHOLE_TEST_VERIFY_TIMER"] = "999999"
+        send_args = [
+            '--relay-url',
+            self.relayurl,
+            '--transit-helper',
+            '',
+            'send',
+            '--hide-progress',
+            '--code',
+            send_cfg.code,
+        ] + content_args
+
+        send_d = getProcessOutputAndValue(
+            wormhole_bin,
+            send_args,
+            path=send_dir,
+            env=env,
+        )
+        recv_args = [
+            '--relay-url',
+            self.relayurl,
+            '--transit-helper',
+            '',
+            'receive',
+            '--hide-progress',
+            '--accept-file',
+            recv_cfg.code,
+        ]
+        if output_file:
+            recv_args.extend(['-o', output_file])
+
+        receive_d = getProcessOutputAndValue(
+            wormhole_bin,
+            recv_args,
+            path=receive_dir,
+            env=env,
+        )
+
+        (send_res, receive_res) = yield gatherResults([send_d, receive_d],
+                                                      True)
+        self.assertEqual((send_res[2], receive_res[2]), (0, 0),
+                         (send_res, receive_res))
+        returnValue((send_res[0].decode("utf-8"),
+                     send_res[1].decode("utf-8"),
+                     receive_res[0].decode("utf-8"),
+                     receive_res[1].decode("utf-8")))
+
+    @inlineCallbacks
+    def _run_in_process(self, send_cfg, recv_cfg, mode, fake_tor,
+                        mock_accept, stream, hash_algs):
+        # returns the stdout and stderr of the sender, then the receiver
+        if fake_tor:
+            send_cfg.tor = True
+            send_cfg.transit_helper = self.transit
+            tx_tm = FakeTor()
+            with mock.patch(
+                    "wormhole.tor_manager.get_tor",
+                    return_value=tx_tm,
+            ) as mtx_tm:
+                send_d = cmd_send.send(send_cfg)
+
+            recv_cfg.tor = True
+            recv_cfg.transit_helper = self.transit
+            rx_tm = FakeTor()
+            with mock.patch(
+                    "wormhole.tor_manager.get_tor",
+                    return_value=rx_tm,
+            ) as mrx_tm:
+                receive_d = cmd_receive.receive(recv_cfg)
+        else:
+            KEY_TIMER = 0 if mode == "slow-sender-text" else 99999
+            rxw = []
+            # an older receiver can only take a whole zipfile
+            directory_modes = cmd_receive.DIRECTORY_MODES
+            if not stream:
+                directory_modes = [u"zipfile/deflated"]
+            # the hashes the sender offers ([] acts like an older one)
+            if hash_algs is None:
+                hash_algs = util.available_hash_algorithms()
+            with mock.patch.object(cmd_receive, "KEY_TIMER", KEY_TIMER), \
+                    mock.patch.object(cmd_receive, "DIRECTORY_MODES",
+                                      directory_modes), \
+                    mock.patch.object(cmd_send,
+                                      "available_hash_algorithms",
+                                      return_value=hash_algs):
+                send_d = cmd_send.send(send_cfg)
+                receive_d = cmd_receive.receive(
+                    recv_cfg, _debug_stash_wormhole=rxw)
+                # we need to keep KEY_TIMER patched until the receiver
+                # gets far enough to start the timer, which happens after
+                # the code is set
+                if mode == "slow-sender-text":
+                    yield rxw[0].get_unverified_key()
+
+        # The sender might fail, leaving the receiver hanging, or vice
+        # versa. Make sure we don't wait on one side exclusively
+        VERIFY_TIMER = 0 if mode == "slow-text" else 99999
+        with mock.patch.object(cmd_receive, "VERIFY_TIMER", VERIFY_TIMER):
+            with mock.patch.object(cmd_send, "VERIFY_TIMER", VERIFY_TIMER):
+                if mock_accept:
+                    with mock.patch.object(
+                            cmd_receive.six.moves, 'input',
+                            return_value='y'):
+                        yield gatherResults([send_d, receive_d], True)
+                else:
+                    yield gatherResults([send_d, receive_d], True)
+
+        if fake_tor:
+            expected_endpoints = [("127.0.0.1", self.rdv_ws_port)]
+            if mode in ("file", "directory"):
+                expected_endpoints.append(("127.0.0.1", self.transitport))
+            tx_timing = mtx_tm.call_args[1]["timing"]
+            self.assertEqual(tx_tm.endpoints, expected_endpoints)
+            self.assertEqual(
+                mtx_tm.mock_calls,
+                [mock.call(reactor, False, None, timing=tx_timing)])
+            rx_timing = mrx_tm.call_args[1]["timing"]
+            self.assertEqual(rx_tm.endpoints, expected_endpoints)
+            self.assertEqual(
+                mrx_tm.mock_calls,
+                [mock.call(reactor, False, None, timing=rx_timing)])
+
+        returnValue((send_cfg.stdout.getvalue(), send_cfg.stderr.getvalue(),
+                     recv_cfg.stdout.getvalue(), recv_cfg.stderr.getvalue()))
+
     @inlineCallbacks
     def _do_test(self,
                  as_subprocess=False,
@@ -406,14 +946,33 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                  override_filename=False,
                  fake_tor=False,
                  overwrite=False,
-                 mock_accept=False):
-        assert mode in ("text", "file", "empty-file", "directory", "slow-text",
-                        "slow-sender-text")
+                 mock_accept=False,
+                 compress=False,
+                 stripes=1,
+                 partial=None,
+                 stream=True,
+                 spool_max_size=None,
+                 jobs=1,
+                 prehash=False,
+                 hash_algs=None,
+                 chunk_hashes=False,
+                 update=None,
+                 chunk_cache=None,
+                 sparse_file=False,
+                 inline=False):
+        assert mode in ("text", "file", "empty-file", "directory", "files",
+                        "slow-text", "slow-sender-text")
         if fake_tor:
             assert not as_subprocess
         send_cfg = config("send")
         recv_cfg = config("receive")
-        message = "blah blah blah ponies"
+        # (a chunk cache needs chunk hashes)
+        chunk_hashes = chunk_hashes or bool(chunk_cache)
+        message = self._setup_features(
+            send_cfg, recv_cfg, "blah blah blah ponies", compress=compress,
+            jobs=jobs, prehash=prehash, chunk_hashes=chunk_hashes,
+            sparse_file=sparse_file, update=update, inline=inline,
+            stripes=stripes)
 
         for cfg in [send_cfg, recv_cfg]:
             cfg.hide_progress = True
@@ -423,6 +982,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             cfg.code = u"1-abc"
             cfg.stdout = io.StringIO()
             cfg.stderr = io.StringIO()
+            if spool_max_size:
+                cfg.spool_max_size = spool_max_size
+                cfg.spool_dir = os.path.abspath(self.mktemp())
+                os.mkdir(cfg.spool_dir)
 
         send_dir = self.mktemp()
         os.mkdir(send_dir)
@@ -435,190 +998,49 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         elif mode in ("file", "empty-file"):
             if mode == "empty-file":
                 message = ""
-            send_filename = u"testfil\u00EB"  # e-with-diaeresis
-            with open(os.path.join(send_dir, send_filename), "w") as f:
-                f.write(message)
-            send_cfg.what = send_filename
-            receive_filename = send_filename
-
             recv_cfg.accept_file = False if mock_accept else True
-            if override_filename:
-                recv_cfg.output_file = receive_filename = u"outfile"
-            if overwrite:
-                recv_cfg.output_file = receive_filename
-                existing_file = os.path.join(receive_dir, receive_filename)
-                with open(existing_file, 'w') as f:
-                    f.write('pls overwrite me')
-
-        elif mode == "directory":
-            # $send_dir/
-            # $send_dir/middle/
-            # $send_dir/middle/$dirname/
-            # $send_dir/middle/$dirname/[12345]
-            # cd $send_dir && wormhole send middle/$dirname
-            # cd $receive_dir && wormhole receive
-            # expect: $receive_dir/$dirname/[12345]
-
-            send_dirname = u"testdir"
-
-            def message(i):
-                return "test message %d\n" % i
-
+            (message, send_filename, receive_filename,
+             block_size) = self._make_file(
+                 send_cfg, recv_cfg, send_dir, receive_dir, message,
+                 override_filename=override_filename, overwrite=overwrite,
+                 update=update, sparse_file=sparse_file,
+                 chunk_cache=chunk_cache, partial=partial, stripes=stripes)
+
+        elif mode == "files":
+            # cd $send_dir && wormhole send 0 middle/1 middle/2
+            # (where 1 is empty)
             os.mkdir(os.path.join(send_dir, u"middle"))
-            source_dir = os.path.join(send_dir, u"middle", send_dirname)
-            os.mkdir(source_dir)
-            modes = {}
-            for i in range(5):
-                path = os.path.join(source_dir, str(i))
-                with open(path, "w") as f:
-                    f.write(message(i))
-                if i == 3:
-                    os.chmod(path, 0o755)
-                modes[i] = stat.S_IMODE(os.stat(path).st_mode)
-            send_dirname_arg = os.path.join(u"middle", send_dirname)
-            if addslash:
-                send_dirname_arg += os.sep
-            send_cfg.what = send_dirname_arg
-            receive_dirname = send_dirname
+            send_names = [u"0", os.path.join(u"middle", u"1"),
+                          os.path.join(u"middle", u"2")]
+            messages = [message, "", message * 1000]
+            for (name, data) in zip(send_names, messages):
+                with open(os.path.join(send_dir, name), "w") as f:
+                    f.write(data)
+            send_cfg.files = send_names
+            recv_cfg.accept_file = False if mock_accept else True
 
+        elif mode == "directory":
             recv_cfg.accept_file = False if mock_accept else True
-            if override_filename:
-                recv_cfg.output_file = receive_dirname = u"outdir"
-            if overwrite:
-                recv_cfg.output_file = receive_dirname
-                os.mkdir(os.path.join(receive_dir, receive_dirname))
+            (message, source_dir, modes,
+             receive_dirname) = self._make_directory(
+                 send_cfg, recv_cfg, send_dir, receive_dir, addslash=addslash,
+                 override_filename=override_filename, overwrite=overwrite,
+                 update=update)
 
         if as_subprocess:
-            wormhole_bin = self.find_executable()
-            if send_cfg.text:
-                content_args = ['--text', send_cfg.text]
-            elif send_cfg.what:
-                content_args = [send_cfg.what]
-
-            # raise the rx KEY_TIMER to some large number here, to avoid
-            # spurious test failures on hosts that are slow enough to trigger
-            # the "Waiting for sender..." pacifier message. We can do in
-            # not-as_subprocess, because we can directly patch the value before
-            # running the receiver. But we can't patch across the subprocess
-            # boundary, so we use an environment variable.
-            env = self._env.copy()
-            env["_MAGIC_WORMHOLE_TEST_KEY_TIMER"] = "999999"
-            env["_MAGIC_WORMHOLE_TEST_VERIFY_TIMER"] = "999999"
-            send_args = [
-                '--relay-url',
-                self.relayurl,
-                '--transit-helper',
-                '',
-                'send',
-                '--hide-progress',
-                '--code',
-                send_cfg.code,
-            ] + content_args
-
-            send_d = getProcessOutputAndValue(
-                wormhole_bin,
-                send_args,
-                path=send_dir,
-                env=env,
-            )
-            recv_args = [
-                '--relay-url',
-                self.relayurl,
-                '--transit-helper',
-                '',
-                'receive',
-                '--hide-progress',
-                '--accept-file',
-                recv_cfg.code,
-            ]
-            if override_filename:
-                recv_args.extend(['-o', receive_filename])
-
-            receive_d = getProcessOutputAndValue(
-                wormhole_bin,
-                recv_args,
-                path=receive_dir,
-                env=env,
-            )
-
-            (send_res, receive_res) = yield gatherResults([send_d, receive_d],
-                                                          True)
-            send_stdout = send_res[0].decode("utf-8")
-            send_stderr = send_res[1].decode("utf-8")
-            send_rc = send_res[2]
-            receive_stdout = receive_res[0].decode("utf-8")
-            receive_stderr = receive_res[1].decode("utf-8")
-            receive_rc = receive_res[2]
+            (send_stdout, send_stderr, receive_stdout,
+             receive_stderr) = yield self._run_subprocess(
+                 send_cfg, recv_cfg, send_dir, receive_dir,
+                 output_file=recv_cfg.output_file if override_filename
+                 else None)
             NL = os.linesep
-            self.assertEqual((send_rc, receive_rc), (0, 0),
-                             (send_res, receive_res))
         else:
             send_cfg.cwd = send_dir
             recv_cfg.cwd = receive_dir
-
-            if fake_tor:
-                send_cfg.tor = True
-                send_cfg.transit_helper = self.transit
-                tx_tm = FakeTor()
-                with mock.patch(
-                        "wormhole.tor_manager.get_tor",
-                        return_value=tx_tm,
-                ) as mtx_tm:
-                    send_d = cmd_send.send(send_cfg)
-
-                recv_cfg.tor = True
-                recv_cfg.transit_helper = self.transit
-                rx_tm = FakeTor()
-                with mock.patch(
-                        "wormhole.tor_manager.get_tor",
-                        return_value=rx_tm,
-                ) as mrx_tm:
-                    receive_d = cmd_receive.receive(recv_cfg)
-            else:
-                KEY_TIMER = 0 if mode == "slow-sender-text" else 99999
-                rxw = []
-                with mock.patch.object(cmd_receive, "KEY_TIMER", KEY_TIMER):
-                    send_d = cmd_send.send(send_cfg)
-                    receive_d = cmd_receive.receive(
-                        recv_cfg, _debug_stash_wormhole=rxw)
-                    # we need to keep KEY_TIMER patched until the receiver
-                    # gets far enough to start the timer, which happens after
-                    # the code is set
-                    if mode == "slow-sender-text":
-                        yield rxw[0].get_unverified_key()
-
-            # The sender might fail, leaving the receiver hanging, or vice
-            # versa. Make sure we don't wait on one side exclusively
-            VERIFY_TIMER = 0 if mode == "slow-text" else 99999
-            with mock.patch.object(cmd_receive, "VERIFY_TIMER", VERIFY_TIMER):
-                with mock.patch.object(cmd_send, "VERIFY_TIMER", VERIFY_TIMER):
-                    if mock_accept:
-                        with mock.patch.object(
-                                cmd_receive.six.moves, 'input',
-                                return_value='y'):
-                            yield gatherResults([send_d, receive_d], True)
-                    else:
-                        yield gatherResults([send_d, receive_d], True)
-
-            if fake_tor:
-                expected_endpoints = [("127.0.0.1", self.rdv_ws_port)]
-                if mode in ("file", "directory"):
-                    expected_endpoints.append(("127.0.0.1", self.transitport))
-                tx_timing = mtx_tm.call_args[1]["timing"]
-                self.assertEqual(tx_tm.endpoints, expected_endpoints)
-                self.assertEqual(
-                    mtx_tm.mock_calls,
-                    [mock.call(reactor, False, None, timing=tx_timing)])
-                rx_timing = mrx_tm.call_args[1]["timing"]
-                self.assertEqual(rx_tm.endpoints, expected_endpoints)
-                self.assertEqual(
-                    mrx_tm.mock_calls,
-                    [mock.call(reactor, False, None, timing=rx_timing)])
-
-            send_stdout = send_cfg.stdout.getvalue()
-            send_stderr = send_cfg.stderr.getvalue()
-            receive_stdout = recv_cfg.stdout.getvalue()
-            receive_stderr = recv_cfg.stderr.getvalue()
+            (send_stdout, send_stderr, receive_stdout,
+             receive_stderr) = yield self._run_in_process(
+                 send_cfg, recv_cfg, mode, fake_tor=fake_tor,
+                 mock_accept=mock_accept, stream=stream, hash_algs=hash_algs)
 
             # all output here comes from a StringIO, which uses \n for
             # newlines, even if we're on windows
@@ -659,9 +1081,21 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                 u"File sent.. waiting for confirmation{NL}"
                 "Confirmation received. Transfer complete.{NL}".format(NL=NL),
                 send_stderr)
+        elif mode == "files":
+            self.failUnlessIn(u"Sending 3 files ({size:s}){NL}".format(
+                size=naturalsize(sum(len(m) for m in messages)), NL=NL),
+                send_stderr)
+            self.failUnlessIn(
+                u"File sent.. waiting for confirmation{NL}"
+                "Confirmation received. Transfer complete.{NL}".format(NL=NL),
+                send_stderr)
         elif mode == "directory":
             self.failUnlessIn(u"Sending directory", send_stderr)
             self.failUnlessIn(u"named 'testdir'", send_stderr)
+            if stream:
+                self.failIfIn(u"Building zipfile", send_stderr)
+            else:
+                self.failUnlessIn(u"Building zipfile", send_stderr)
             self.failUnlessIn(u"Wormhole code is: {code}{NL}"
                               "On the other computer, please run:{NL}{NL}"
                               "wormhole receive {code}{NL}{NL}".format(
@@ -690,9 +1124,30 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             self.failUnless(os.path.exists(fn))
             with open(fn, "r") as f:
                 self.failUnlessEqual(f.read(), message)
+            self.failIf(os.path.exists(fn + ".tmp.checkpoint"))
+            if partial:
+                self._check_resume(send_stderr, receive_stderr, message,
+                                   partial)
+        elif mode == "files":
+            self.failUnlessEqual(receive_stdout, "")
+            self.failUnlessIn(u"Receiving 3 files ({size:s}): 0, 1, 2".format(
+                size=naturalsize(sum(len(m) for m in messages))),
+                receive_stderr)
+            # each one is written where it belongs, as it arrives
+            self.assertEqual(sorted(os.listdir(receive_dir)),
+                             ["0", "1", "2"])
+            for (i, data) in enumerate(messages):
+                self.failUnlessIn(u"Received file written to %d" % i,
+                                  receive_stderr)
+                with open(os.path.join(receive_dir, str(i)), "r") as f:
+                    self.failUnlessEqual(f.read(), data)
+            (rx, ) = [e for e in recv_cfg.timing._events
+                      if e._name == "rx file"]
+            self.assertEqual(rx._details["files"], 3)
         elif mode == "directory":
             self.failUnlessEqual(receive_stdout, "")
-            want = (r"Receiving directory \(\d+ \w+\) into: {name}/"
+            # (the size of a zipfile/stream isn't known in advance)
+            want = (r"Receiving directory (\(\d+ \w+\) )?into: {name}/"
                     .format(name=receive_dirname))
             self.failUnless(
                 re.search(want, receive_stderr), (want, receive_stderr))
@@ -709,6 +1164,146 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                 self.failUnlessEqual(modes[i], stat.S_IMODE(
                     os.stat(fn).st_mode))
 
+        if compress:
+            self._check_compress(send_cfg, recv_cfg, message)
+        if stripes > 1 and not (mode == "file" and update == "old"):
+            self._check_stripes(send_cfg, recv_cfg, stripes)
+        if chunk_hashes:
+            self._check_chunk_hashes(recv_cfg, message, partial)
+        if update == "old" and mode == "directory":
+            self._check_directory_update(send_stderr, receive_stderr,
+                                         source_dir,
+                                         os.path.join(receive_dir,
+                                                      receive_dirname))
+        elif update == "old":
+            self._check_file_update(send_cfg, recv_cfg, receive_stderr,
+                                    receive_filename, message, block_size)
+        elif update == "small":
+            self.failUnlessIn(u"Updating '%s'" % receive_filename,
+                              receive_stderr)
+        elif update == "none":
+            self.assertEqual([e for e in recv_cfg.timing._events
+                              if e._name == "rx delta"], [])
+        if sparse_file:
+            self._check_sparse(send_cfg, recv_cfg, send_stderr)
+        if chunk_cache:
+            self._check_chunk_cache(send_cfg, recv_cfg, send_stderr,
+                                    receive_stderr, chunk_cache)
+        if inline:
+            self._check_inline(send_cfg, recv_cfg, message, inline)
+
+    def _event(self, timing, name):
+        # the one event with this name
+        (e, ) = [e for e in timing._events if e._name == name]
+        return e
+
+    def _check_resume(self, send_stderr, receive_stderr, message, partial):
+        if partial == "good":
+            resuming = u"Resuming, {size:s} already received".format(
+                size=naturalsize(len(message) // 3))
+            self.failUnlessIn(resuming, send_stderr)
+            self.failUnlessIn(resuming, receive_stderr)
+        elif partial == "stale":
+            self.failIfIn(u"Resuming", send_stderr)
+            self.failUnlessIn(u"Partial file doesn't match its checkpoint",
+                              receive_stderr)
+
+    def _check_compress(self, send_cfg, recv_cfg, message):
+        # the compression ratio is reported in the timing data
+        tx = self._event(send_cfg.timing, "tx file")
+        self.assertEqual(tx._details["compression"],
+                         transit.available_codecs()[0].name)
+        self.assertEqual(tx._details["sent_bytes"], len(message))
+        self.assertTrue(tx._details["sent_ratio"] > 10)
+        rx = self._event(recv_cfg.timing, "rx file")
+        self.assertEqual(rx._details["received_bytes"], len(message))
+
+    def _check_stripes(self, send_cfg, recv_cfg, stripes):
+        # stripes are used as they finish connecting, which might not be
+        # before the sender runs out of file (a delta only uses one)
+        for (timing, name) in [(send_cfg.timing, "tx file"),
+                               (recv_cfg.timing, "rx file")]:
+            e = self._event(timing, name)
+            self.assertIn(e._details["stripes"], range(1, stripes + 1))
+
+    def _check_chunk_hashes(self, recv_cfg, message, partial):
+        # every chunk is checked, except one that we resumed partway into
+        chunk_size = merkle.chunk_size_for(len(message))
+        chunks = -(-len(message) // chunk_size)
+        if partial == "good":
+            chunks -= -(-(len(message) // 3) // chunk_size)
+        rx = self._event(recv_cfg.timing, "rx file")
+        self.assertEqual(rx._details["chunks_checked"], chunks)
+
+    def _check_directory_update(self, send_stderr, receive_stderr,
+                                source_dir, receive_path):
+        # only the new and changed files were sent, and the rest of the old
+        # copy was left alone
+        self.failUnlessIn(u"Updating '%s'" % os.path.basename(receive_path),
+                          receive_stderr)
+        self.failUnlessIn(u"3 of 5 files are new or changed", receive_stderr)
+        self.failUnlessIn(u"Sending 3 of 5 files", send_stderr)
+        with open(os.path.join(receive_path, "extra"), "r") as f:
+            self.failUnlessEqual(f.read(), "not in the manifest\n")
+        for i in range(2, 5):
+            fn = os.path.join(receive_path, str(i))
+            self.assertEqual(
+                int(os.stat(fn).st_mtime),
+                int(os.stat(os.path.join(source_dir, str(i))).st_mtime))
+
+    def _check_file_update(self, send_cfg, recv_cfg, receive_stderr,
+                           receive_filename, message, block_size):
+        # only the block with the change was sent
+        self.failUnlessIn(u"Updating '%s'" % receive_filename, receive_stderr)
+        for (timing, name) in [(send_cfg.timing, "tx delta"),
+                               (recv_cfg.timing, "rx delta")]:
+            e = self._event(timing, name)
+            self.assertEqual(e._details["literal_bytes"], block_size)
+            self.assertEqual(e._details["copied_bytes"],
+                             len(message) - block_size)
+
+    def _check_sparse(self, send_cfg, recv_cfg, send_stderr):
+        holes = 2 * sparse.BLOCK_SIZE
+        self.failUnlessIn(u"skipping %s of holes" % naturalsize(holes),
+                          send_stderr)
+        for (timing, name) in [(send_cfg.timing, "tx file"),
+                               (recv_cfg.timing, "rx file")]:
+            e = self._event(timing, name)
+            self.assertEqual(e._details["hole_bytes"], holes)
+
+    def _check_chunk_cache(self, send_cfg, recv_cfg, send_stderr,
+                           receive_stderr, chunk_cache):
+        # the chunks that were in the cache weren't sent, and the rest were
+        # added to it
+        cached = 20 if chunk_cache == "old" else 0
+        tx = self._event(send_cfg.timing, "tx file")
+        rx = self._event(recv_cfg.timing, "rx file")
+        store = self._event(recv_cfg.timing, "store in cache")
+        self.assertEqual(store._details["stored_chunks"], 21 - cached)
+        if cached:
+            self.failUnlessIn(u"20 of 21 chunks were in the chunk cache",
+                              receive_stderr)
+            self.failUnlessIn(u"20 of 21 chunks were cached", send_stderr)
+            self.assertEqual(tx._details["cached_chunks"], cached)
+            self.assertEqual(rx._details["cached_chunks"], cached)
+        else:
+            self.failIfIn(u"chunk cache", receive_stderr)
+            self.assertNotIn("cached_chunks", tx._details)
+
+    def _check_inline(self, send_cfg, recv_cfg, message, inline):
+        tx = [e for e in send_cfg.timing._events if e._name == "tx file"]
+        rx = [e for e in recv_cfg.timing._events if e._name == "rx inline"]
+        if inline == "older":
+            # it went through transit, as usual
+            self.assertEqual(len(tx), 1)
+            self.assertEqual(rx, [])
+        else:
+            # it came in the offer, without a transit connection
+            self.assertEqual(tx, [])
+            self.assertEqual(rx[0]._details["bytes"], len(message))
+            self.assertEqual([e for e in send_cfg.timing._events
+                              if e._name == "transit connected"], [])
+
     def test_text(self):
         return self._do_test()
 
@@ -721,6 +1316,117 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     def test_file(self):
         return self._do_test(mode="file")
 
+    def test_file_compress(self):
+        return self._do_test(mode="file", compress=True)
+
+    def test_file_prehash(self):
+        return self._do_test(mode="file", prehash=True)
+
+    def test_file_chunk_hashes(self):
+        return self._do_test(mode="file", chunk_hashes=True)
+
+    def test_file_chunk_hashes_jobs(self):
+        return self._do_test(mode="file", chunk_hashes=True, jobs=3)
+
+    def test_file_chunk_hashes_stripes(self):
+        return self._do_test(mode="file", chunk_hashes=True, stripes=4)
+
+    def test_file_chunk_hashes_resume(self):
+        return self._do_test(mode="file", chunk_hashes=True, partial="good")
+
+    def test_file_chunk_cache(self):
+        return self._do_test(mode="file", chunk_cache="old")
+
+    def test_file_chunk_cache_jobs(self):
+        return self._do_test(mode="file", chunk_cache="old", jobs=3)
+
+    def test_file_chunk_cache_empty(self):
+        return self._do_test(mode="file", chunk_cache="empty")
+
+    def test_files(self):
+        return self._do_test(mode="files")
+
+    def test_files_accept(self):
+        return self._do_test(mode="files", mock_accept=True)
+
+    def test_file_sparse(self):
+        return self._do_test(mode="file", sparse_file=True)
+
+    def test_file_sparse_chunk_hashes(self):
+        return self._do_test(mode="file", sparse_file=True,
+                             chunk_hashes=True)
+
+    def test_file_sparse_prehash(self):
+        return self._do_test(mode="file", sparse_file=True, prehash=True)
+
+    def test_file_delta(self):
+        return self._do_test(mode="file", update="old")
+
+    def test_file_delta_blake2b(self):
+        if u"blake2b" not in util.available_hash_algorithms():
+            raise unittest.SkipTest("this python has no blake2b")
+        return self._do_test(mode="file", update="old",
+                             hash_algs=[u"blake2b"])
+
+    def test_file_delta_stripes(self):
+        return self._do_test(mode="file", update="old", stripes=4)
+
+    def test_file_delta_nothing_to_update(self):
+        return self._do_test(mode="file", update="none")
+
+    def test_file_hash_sha256(self):
+        return self._do_test(mode="file", hash_algs=[u"sha256"])
+
+    def test_file_hash_blake2b(self):
+        if u"blake2b" not in util.available_hash_algorithms():
+            raise unittest.SkipTest("this python has no blake2b")
+        return self._do_test(mode="file", hash_algs=[u"blake2b"])
+
+    def test_file_hash_older_sender(self):
+        return self._do_test(mode="file", hash_algs=[])
+
+    def test_file_hash_prehash_blake2b(self):
+        # the receiver can only check a pre-hashed file with sha256
+        return self._do_test(mode="file", prehash=True,
+                             hash_algs=[u"blake2b", u"sha256"])
+
+    def test_directory_manifest(self):
+        return self._do_test(mode="directory", update="old")
+
+    def test_directory_manifest_jobs(self):
+        return self._do_test(mode="directory", update="old", jobs=3)
+
+    def test_directory_manifest_nothing_to_update(self):
+        return self._do_test(mode="directory", update="none")
+
+    def test_directory_manifest_older_receiver(self):
+        # (which can't take a zipfile/stream, or ask for some of the files)
+        return self._do_test(mode="directory", update="none", stream=False)
+
+    def test_directory_hash_older_sender(self):
+        return self._do_test(mode="directory", hash_algs=[])
+
+    def test_file_prehash_stripes(self):
+        return self._do_test(mode="file", prehash=True, stripes=4)
+
+    def test_file_prehash_resume(self):
+        return self._do_test(mode="file", prehash=True, partial="good")
+
+    def test_file_stripes(self):
+        return self._do_test(mode="file", stripes=4)
+
+    def test_empty_file_stripes(self):
+        return self._do_test(mode="empty-file", stripes=4)
+
+    def test_file_resume(self):
+        return self._do_test(mode="file", partial="good")
+
+    def test_file_resume_stale(self):
+        return self._do_test(mode="file", partial="stale")
+
+    def test_file_resume_stripes(self):
+        return self._do_test(mode="file", partial="good", stripes=4)
+
     def test_file_override(self):
         return self._do_test(mode="file", override_filename=True)
 
@@ -730,6 +1436,29 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     def test_file_overwrite_mock_accept(self):
         return self._do_test(mode="file", overwrite=True, mock_accept=True)
 
+    def test_file_inline(self):
+        return self._do_test(mode="file", inline=True)
+
+    def test_empty_file_inline(self):
+        return self._do_test(mode="empty-file", inline=True)
+
+    def test_file_inline_override(self):
+        return self._do_test(mode="file", inline=True, override_filename=True)
+
+    def test_file_inline_overwrite(self):
+        return self._do_test(mode="file", inline=True, overwrite=True)
+
+    def test_file_inline_overwrite_mock_accept(self):
+        return self._do_test(mode="file", inline=True, overwrite=True,
+                             mock_accept=True)
+
+    def test_file_inline_delta(self):
+        # a receiver with an old copy takes the whole of the new one
+        return self._do_test(mode="file", inline=True, update="small")
+
+    def test_file_inline_older_receiver(self):
+        return self._do_test(mode="file", inline="older")
+
     def test_file_tor(self):
         return self._do_test(mode="file", fake_tor=True)
 
@@ -742,6 +1471,25 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     def test_directory_addslash(self):
         return self._do_test(mode="directory", addslash=True)
 
+    def test_directory_no_stream(self):
+        return self._do_test(mode="directory", stream=False)
+
+    def test_directory_no_stream_spooled(self):
+        return self._do_test(
+            mode="directory", stream=False, spool_max_size=1000)
+
+    def test_directory_jobs(self):
+        return self._do_test(mode="directory", jobs=3)
+
+    def test_directory_no_stream_jobs(self):
+        return self._do_test(mode="directory", stream=False, jobs=3)
+
+    def test_directory_stripes(self):
+        return self._do_test(mode="directory", stripes=4)
+
+    def test_directory_stripes_spooled(self):
+        return self._do_test(mode="directory", stripes=4, spool_max_size=1000)
+
     def test_directory_override(self):
         return self._do_test(mode="directory", override_filename=True)
 
@@ -1066,8 +1814,8 @@ class NoServer(ServerBase, unittest.TestCase):
 
 
 class Cleanup(ServerBase, unittest.TestCase):
-    def make_config(self):
-        cfg = config("send")
+    def make_config(self, command="send"):
+        cfg = config(command)
         # common options for all tests in this suite
         cfg.hide_progress = True
         cfg.relay_url = self.relayurl
@@ -1113,48 +1861,1255 @@ class Cleanup(ServerBase, unittest.TestCase):
         cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
         self.assertEqual(len(cids), 0)
 
+    @inlineCallbacks
+    def test_bad_offer(self):
+        # the offer is built while we wait for the receiver, but a missing
+        # file is noticed before we even get a code
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        cfg = self.make_config()
+        cfg.cwd = send_dir
+        cfg.what = u"missing"
+        cfg.code = u"1-abc"
+
+        e = yield self.assertFailure(cmd_send.send(cfg), TransferError)
+        self.assertEqual(str(e), "Cannot send: no file/directory named "
+                         "'missing'")
+        self.assertNotIn(u"Wormhole code is", cfg.stderr.getvalue())
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
+    @inlineCallbacks
+    def test_bad_chunk(self):
+        # the receiver gives up as soon as a chunk doesn't match its hash,
+        # and doesn't keep any of the file
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(b"ponies\n" * 10000)
+        send_cfg = self.make_config()
+        send_cfg.cwd = send_dir
+        send_cfg.what = u"testfile"
+        send_cfg.code = u"1-abc"
+        send_cfg.chunk_hashes = True
+
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        rx_cfg = self.make_config("receive")
+        rx_cfg.cwd = receive_dir
+        rx_cfg.code = u"1-abc"
+        rx_cfg.accept_file = True
+
+        hash_file = merkle.hash_file
+
+        def bad_hash_file(*args, **kwargs):
+            tree = hash_file(*args, **kwargs)
+            leaves = list(tree.leaves)
+            leaves[3] = b"\x00" * len(leaves[3])
+            return merkle.ChunkTree(tree.hash_alg, tree.chunk_size,
+                                    tree.filesize, leaves)
+
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        self.patch(cmd_send.merkle, "hash_file", bad_hash_file)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "chunk 3 of the file doesn't match the sender's hash"
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "remote error, transfer abandoned: " + err)
+        self.assertEqual(os.listdir(receive_dir), [])
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
+    @inlineCallbacks
+    def test_bad_cached_chunk(self):
+        # a cached chunk that went bad is caught (and dropped from the
+        # cache) along with the rest of the file
+        data = b"ponies\n" * 10000
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(data)
+        send_cfg = self.make_config()
+        send_cfg.cwd = send_dir
+        send_cfg.what = u"testfile"
+        send_cfg.code = u"1-abc"
+        send_cfg.chunk_hashes = True
+
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        rx_cfg = self.make_config("receive")
+        rx_cfg.cwd = receive_dir
+        rx_cfg.code = u"1-abc"
+        rx_cfg.accept_file = True
+        rx_cfg.chunk_cache = os.path.abspath(self.mktemp())
+
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        fn = os.path.join(send_dir, "testfile")
+        tree = merkle.hash_file(fn, len(data),
+                                util.available_hash_algorithms()[0])
+        cache = chunkcache.ChunkCache(rx_cfg.chunk_cache,
+                                      rx_cfg.chunk_cache_size)
+        with open(fn, "rb") as f:
+            cache.store(f, tree)
+        bad = cache._chunk_path(tree.hash_alg, tree.leaves[3])
+        with open(bad, "wb") as f:
+            f.write(b"x" * 1000)
+
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "chunk 3 of the file doesn't match the sender's hash"
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "remote error, transfer abandoned: " + err)
+        self.assertEqual(os.listdir(receive_dir), [])
+        self.assertFalse(os.path.exists(bad))
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
+    @inlineCallbacks
+    def test_resume_other_partial_file(self):
+        # a partial file that matches its checkpoint, but isn't the start of
+        # the sender's file, is caught by the sender's hash, and not kept
+        data = b"ponies\n" * 10000
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        fn = os.path.join(send_dir, "testfile")
+        with open(fn, "wb") as f:
+            f.write(data)
+        send_cfg = self.make_config()
+        send_cfg.cwd = send_dir
+        send_cfg.what = u"testfile"
+        send_cfg.code = u"1-abc"
+
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        rx_cfg = self.make_config("receive")
+        rx_cfg.cwd = receive_dir
+        rx_cfg.code = u"1-abc"
+        rx_cfg.accept_file = True
+        tmp_file = os.path.join(receive_dir, "testfile.tmp")
+        prefix = b"x" * 1000
+        with open(tmp_file, "wb") as f:
+            f.write(prefix)
+        checkpoint = {
+            "filesize": len(data),
+            "offset": len(prefix),
+            "hash_alg": u"sha256",
+            "digest": hashlib.sha256(prefix).hexdigest(),
+            "mtime": int(os.stat(fn).st_mtime),
+        }
+        with open(tmp_file + ".checkpoint", "w") as f:
+            json.dump(checkpoint, f)
+
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e),
+                         "received data doesn't match the sender's hash")
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "Transfer failed (bad remote hash)")
+        self.assertEqual(os.listdir(receive_dir), [])
+
+    def _files_configs(self):
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        for name in ["a", "b"]:
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(b"ponies\n" * 10000)
+        send_cfg = self.make_config()
+        send_cfg.cwd = send_dir
+        send_cfg.files = [u"a", u"b"]
+        send_cfg.code = u"1-abc"
+
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        rx_cfg = self.make_config("receive")
+        rx_cfg.cwd = receive_dir
+        rx_cfg.code = u"1-abc"
+        rx_cfg.accept_file = True
+        return send_cfg, rx_cfg
+
+    @inlineCallbacks
+    def test_files_older_receiver(self):
+        # a receiver that can't take several files doesn't list them in its
+        # versions, and the sender tells it so
+        send_cfg, rx_cfg = self._files_configs()
+        create = cmd_receive.create
+
+        def create_older(*args, **kwargs):
+            kwargs["versions"] = {
+                u"directory-modes": cmd_receive.DIRECTORY_MODES}
+            return create(*args, **kwargs)
+
+        self.patch(cmd_receive, "create", create_older)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = ("the receiver can't take several files at once: send them "
+               "one at a time, or as a directory")
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        self.assertEqual(os.listdir(rx_cfg.cwd), [])
+
+    @inlineCallbacks
+    def test_files_bad_hash(self):
+        # a file that doesn't match its hash isn't kept, and the sender
+        # stops there
+        send_cfg, rx_cfg = self._files_configs()
+
+        def bad_hasher(name):
+            hasher = util.new_hasher(name)
+            hasher.update(b"x")
+            return hasher
+
+        self.patch(cmd_send, "new_hasher", bad_hasher)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "a doesn't match the sender's hash"
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "transit connection lost, transfer abandoned")
+        self.assertEqual(os.listdir(rx_cfg.cwd), [])
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
+    def _stream_configs(self, data):
+        send_cfg = self.make_config()
+        send_cfg.stream = True
+        send_cfg.stdin = io.BytesIO(data)
+        send_cfg.code = u"1-abc"
+
+        rx_cfg = self.make_config("receive")
+        rx_cfg.stream = True
+        rx_cfg.stdout = io.BytesIO()
+        rx_cfg.code = u"1-abc"
+        return send_cfg, rx_cfg
+
+    @inlineCallbacks
+    def test_stream(self):
+        # 'wormhole send --stream' sends stdin to the receiver's stdout
+        data = os.urandom(200 * 1000)
+        send_cfg, rx_cfg = self._stream_configs(data)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+        yield send_d
+        yield receive_d
+
+        self.assertEqual(rx_cfg.stdout.getvalue(), data)
+        send_stderr = send_cfg.stderr.getvalue()
+        self.assertIn(u"wormhole receive --stream 1-abc", send_stderr)
+        self.assertIn(u"Sending stdin as a stream", send_stderr)
+        self.assertIn(u"Confirmation received. Transfer complete.",
+                      send_stderr)
+        rx_stderr = rx_cfg.stderr.getvalue()
+        self.assertIn(u"Receiving a stream, to stdout", rx_stderr)
+        self.assertIn(u"written to stdout", rx_stderr)
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
+    @inlineCallbacks
+    def test_stream_empty(self):
+        send_cfg, rx_cfg = self._stream_configs(b"")
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+        yield send_d
+        yield receive_d
+        self.assertEqual(rx_cfg.stdout.getvalue(), b"")
+
+    @inlineCallbacks
+    def test_stream_not_asked_for(self):
+        # the receiver has to ask for a stream, since it goes to stdout
+        send_cfg, rx_cfg = self._stream_configs(b"data")
+        rx_cfg.stream = False
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = ("the receiver didn't ask for a stream "
+               "('wormhole receive --stream')")
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "remote error, transfer abandoned: " + err)
+
+    @inlineCallbacks
+    def test_stream_only(self):
+        # and with --stream, it won't take anything else
+        send_cfg, rx_cfg = self._files_configs()
+        rx_cfg.stream = True
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "the receiver only takes a stream ('wormhole send --stream')"
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "remote error, transfer abandoned: " + err)
+        self.assertEqual(os.listdir(rx_cfg.cwd), [])
+
+    @inlineCallbacks
+    def test_stream_older_receiver(self):
+        send_cfg, rx_cfg = self._stream_configs(b"data")
+        create = cmd_receive.create
+
+        def create_older(*args, **kwargs):
+            kwargs["versions"] = {
+                u"directory-modes": cmd_receive.DIRECTORY_MODES}
+            return create(*args, **kwargs)
+
+        self.patch(cmd_receive, "create", create_older)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "the receiver can't take a stream: send a file instead"
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        self.assertEqual(rx_cfg.stdout.getvalue(), b"")
+
+    @inlineCallbacks
+    def test_stream_bad_hash(self):
+        # the stream has already been written when its hash arrives, but
+        # the receiver still fails
+        data = b"ponies\n" * 10000
+        send_cfg, rx_cfg = self._stream_configs(data)
+
+        def bad_hasher(name):
+            hasher = util.new_hasher(name)
+            hasher.update(b"x")
+            return hasher
+
+        self.patch(cmd_send, "new_hasher", bad_hasher)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        err = "the stream doesn't match the sender's hash"
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e), err)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "transit connection lost, transfer abandoned")
+        self.assertEqual(rx_cfg.stdout.getvalue(), data)
+
+    @inlineCallbacks
+    def test_bad_delta(self):
+        # the receiver checks the file it builds from its old copy before
+        # replacing that, and keeps the old copy if it's wrong
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(b"ponies\n" * 10000)
+        send_cfg = self.make_config()
+        send_cfg.cwd = send_dir
+        send_cfg.what = u"testfile"
+        send_cfg.code = u"1-abc"
+
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        old = b"ponies\n" * 5000 + b"unicorns\n" * 5000
+        with open(os.path.join(receive_dir, "testfile"), "wb") as f:
+            f.write(old)
+        rx_cfg = self.make_config("receive")
+        rx_cfg.cwd = receive_dir
+        rx_cfg.code = u"1-abc"
+        rx_cfg.accept_file = True
+        rx_cfg.delta = True
+
+        plan = delta.plan
+
+        def bad_plan(*args):
+            # copy the wrong block
+            ops = plan(*args)
+            (kind, offset, length) = ops[0]
+            return [(kind, offset + 1, length)] + ops[1:]
+
+        self.patch(cmd_send.delta, "plan", bad_plan)
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(rx_cfg)
+
+        e = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(e),
+                         "received data doesn't match the sender's hash")
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "Transfer failed (bad remote hash)")
+        self.assertEqual(os.listdir(receive_dir), ["testfile"])
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.assertEqual(f.read(), old)
+
+        cids = self._rendezvous.get_app(cmd_send.APPID).get_nameplate_ids()
+        self.assertEqual(len(cids), 0)
+
 
-class ExtractFile(unittest.TestCase):
+class ChunkHashes(unittest.TestCase):
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_chunk_size(self):
+        self.assertEqual(merkle.chunk_size_for(0), merkle.CHUNK_SIZE)
+        self.assertEqual(merkle.chunk_size_for(10**9), 1024 * 1024)
+        self.assertEqual(merkle.chunk_size_for(10**10), 16 * 1024 * 1024)
+        for size in (10**11, 10**12):
+            chunk_size = merkle.chunk_size_for(size)
+            self.assertTrue(size / chunk_size <= merkle.MAX_CHUNKS)
+            self.assertTrue(size / chunk_size > merkle.MAX_CHUNKS // 2)
+
+    def test_root(self):
+        def h(data):
+            return hashlib.sha256(data).digest()
+
+        a, b, c = h(b"\x00a"), h(b"\x00b"), h(b"\x00c")
+        self.assertEqual(merkle.merkle_root("sha256", []), h(b"\x00"))
+        self.assertEqual(merkle.merkle_root("sha256", [a]), a)
+        ab = h(b"\x01" + a + b)
+        self.assertEqual(merkle.merkle_root("sha256", [a, b]), ab)
+        self.assertEqual(merkle.merkle_root("sha256", [a, b, c]),
+                         h(b"\x01" + ab + c))
+
+    def test_hash_file(self):
+        data = os.urandom(10500)
+        fn = self.make_file(data)
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        tree = merkle.hash_file(fn, len(data), "sha256")
+        self.assertEqual(tree.chunk_size, 1000)
+        self.assertEqual(tree.leaves[10],
+                         hashlib.sha256(b"\x00" + data[10000:]).digest())
+        pieces = []
+        tree2 = merkle.hash_file(fn, len(data), "sha256", jobs=3,
+                                 progress=pieces.append)
+        self.assertEqual(tree2.leaves, tree.leaves)
+        self.assertEqual(tree2.root, tree.root)
+        self.assertEqual(pieces, [1000] * 10 + [500])
+        # an empty file has no chunks
+        empty = merkle.hash_file(self.make_file(b""), 0, "sha256")
+        self.assertEqual(empty.leaves, [])
+        # the file must be as big as we think it is
+        self.assertRaises(EnvironmentError, merkle.hash_file, fn,
+                          len(data) + 1, "sha256")
+
+    def test_dict(self):
+        data = os.urandom(10500)
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        tree = merkle.hash_file(self.make_file(data), len(data), "sha256")
+        d = tree.to_dict()
+        tree2 = merkle.ChunkTree.from_dict(d, len(data))
+        self.assertEqual(tree2.root, tree.root)
+        self.assertEqual(tree2.leaves, tree.leaves)
+
+        def bad(msg, filesize=len(data), **changes):
+            d2 = dict(d)
+            d2.update(changes)
+            e = self.assertRaises(ValueError, merkle.ChunkTree.from_dict, d2,
+                                  filesize)
+            self.assertIn(msg, str(e))
+
+        bad("wrong number", filesize=len(data) + 1000)
+        bad("unknown hash", hash_alg="sha3-999")
+        bad("bad chunk size", chunk_size=0)
+        bad("bad chunk size", chunk_size="1000")
+        bad("wrong number", leaves=d["leaves"][:-1])
+        bad("aren't hex", root=None)
+        bad("aren't hex", leaves=["xx"] * len(d["leaves"]))
+        bad("wrong size", leaves=["00"] * len(d["leaves"]))
+        bad("don't match", root="00" * 32)
+        e = self.assertRaises(ValueError, merkle.ChunkTree.from_dict, [], 0)
+        self.assertIn("not a dict", str(e))
+
+    def _verify(self, tree, data, offset=0, jobs=1, step=777):
+        bad = []
+        v = merkle.ChunkVerifier(tree, offset, jobs, bad.append)
+        for i in range(offset, len(data), step):
+            v.update(data[i:i + step])
+        v.flush()
+        v.close()
+        return v.checked, bad
+
+    def test_verify(self):
+        data = os.urandom(10500)
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        tree = merkle.hash_file(self.make_file(data), len(data), "sha256")
+        for jobs in (1, 3):
+            self.assertEqual(self._verify(tree, data, jobs=jobs), (11, []))
+            # a chunk that we start partway into isn't checked
+            self.assertEqual(self._verify(tree, data, 2500, jobs), (8, []))
+            self.assertEqual(self._verify(tree, data, 3000, jobs), (8, []))
+            self.assertEqual(self._verify(tree, data, 10500, jobs), (0, []))
+            self.assertEqual(self._verify(tree, data, step=5000), (11, []))
+
+            corrupt = data[:4321] + b"x" + data[4322:]
+            self.assertEqual(self._verify(tree, corrupt, jobs=jobs), (4, [4]))
+
+
+class Delta(unittest.TestCase):
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_block_size(self):
+        self.assertEqual(delta.block_size_for(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(10**8), 16384)
+        self.assertEqual(delta.block_size_for(10**13), delta.MAX_BLOCK_SIZE)
+
+    def _update(self, old, new, block_size=1000, step=777):
+        # returns the ops, and the digest of what the receiver built
+        signatures = delta.signatures(self.make_file(old), block_size,
+                                      "sha256")
+        self.assertEqual(len(signatures),
+                         -(-len(old) // block_size) * delta.DIGEST_SIZE)
+        hasher = util.new_hasher("sha256")
+        ops = delta.plan(io.BytesIO(new), len(new), block_size, signatures,
+                         "sha256", hasher)
+        self.assertEqual(hasher.digest(), hashlib.sha256(new).digest())
+        reader = delta.DeltaReader(io.BytesIO(new), ops)
+        stream = []
+        while True:
+            data = reader.read(step)
+            self.assertTrue(len(data) <= step)
+            if not data:
+                break
+            stream.append(data)
+        stream = b"".join(stream)
+        self.assertEqual(len(stream), reader.size)
+        out = io.BytesIO()
+        patcher = delta.DeltaPatcher(io.BytesIO(old), len(old), out,
+                                     len(new))
+        for i in range(0, len(stream), step + 1):
+            patcher.write(stream[i:i + step + 1])
+        digest = patcher.finish(util.new_hasher("sha256"))
+        self.assertEqual(out.getvalue(), new)
+        self.assertEqual(digest, hashlib.sha256(new).digest())
+        self.assertEqual(patcher.literal_bytes, reader.literal_bytes)
+        self.assertEqual(patcher.copied_bytes, reader.copied_bytes)
+        return ops
+
+    def test_update(self):
+        old = os.urandom(10500)
+        L, C = delta.LITERAL, delta.COPY
+        self.assertEqual(self._update(old, old), [(C, 0, 10500)])
+        changed = old[:4321] + b"x" + old[4322:]
+        self.assertEqual(self._update(old, changed),
+                         [(C, 0, 4000), (L, 4000, 1000), (C, 5000, 5500)])
+        # blocks can move, as long as they stay aligned
+        moved = old[5000:10000] + old[:5000] + old[10000:]
+        self.assertEqual(self._update(old, moved),
+                         [(C, 5000, 5000), (C, 0, 5000), (C, 10000, 500)])
+        shifted = b"x" + old
+        self.assertEqual(self._update(old, shifted), [(L, 0, 10501)])
+        self.assertEqual(self._update(old, old[:7000]), [(C, 0, 7000)])
+        self.assertEqual(self._update(old, old + b"more"),
+                         [(C, 0, 10000), (L, 10000, 504)])
+        self.assertEqual(self._update(b"", old), [(L, 0, 10500)])
+        self.assertEqual(self._update(old, b""), [])
+
+    def _patch(self, stream, basis_size=100, filesize=100):
+        patcher = delta.DeltaPatcher(io.BytesIO(b"x" * basis_size),
+                                     basis_size, io.BytesIO(), filesize)
+        patcher.write(stream)
+        e = self.assertRaises(TransferError, patcher.finish,
+                              util.new_hasher("sha256"))
+        return str(e)
+
+    def test_bad_stream(self):
+        self.assertEqual(self._patch(b"Z"),
+                         "bad delta from sender: unknown delta operation "
+                         "%r" % (b"Z", ))
+        self.assertIn("copies from outside the old file",
+                      self._patch(delta.COPY.pack(b"C", 50, 51)))
+        self.assertIn("bigger than the file",
+                      self._patch(delta.COPY.pack(b"C", 0, 101),
+                                  basis_size=200))
+        self.assertIn("bigger than the file",
+                      self._patch(delta.LITERAL.pack(b"L", 101)))
+        self.assertIn("ended early",
+                      self._patch(delta.LITERAL.pack(b"L", 100) + b"abc"))
+        self.assertIn("ended early", self._patch(b"L\x00"))
+
+
+class Manifests(unittest.TestCase):
+    def make_tree(self, contents):
+        top = os.path.abspath(self.mktemp())
+        files = []
+        for name, data in sorted(contents.items()):
+            path = os.path.join(top, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+            os.utime(path, (1500000000, 1500000000))
+            files.append((path, name))
+        return top, files
+
+    def extract_path(self, top, name):
+        return os.path.join(top, name.replace("/", os.sep))
+
+    def test_build(self):
+        top, files = self.make_tree({
+            "a": b"a",
+            os.path.join("sub", "b"): b"bb",
+        })
+        for jobs in (1, 3):
+            m = manifest.build(files, "sha256", jobs)
+            self.assertEqual(m.hash_alg, "sha256")
+            self.assertEqual(m.entries, [
+                ("a", 1, 1500000000, hashlib.sha256(b"a").hexdigest()),
+                ("sub/b", 2, 1500000000, hashlib.sha256(b"bb").hexdigest()),
+            ])
+            m2 = manifest.Manifest.from_dict(
+                json.loads(json.dumps(m.to_dict())))
+            self.assertEqual(m2.entries, m.entries)
+
+    def test_from_dict_errors(self):
+        digest = hashlib.sha256(b"").hexdigest()
+
+        def check(files, hash_alg="sha256", err="bad entry"):
+            e = self.assertRaises(ValueError, manifest.Manifest.from_dict,
+                                  {"hash_alg": hash_alg, "files": files})
+            self.assertIn(err, str(e))
+
+        check([], "md5", "unknown hash algorithm")
+        check(None, err="no list of files")
+        check([["a", 0, 0]])
+        check([["a", -1, 0, digest]])
+        check([["a", 0, True, digest]])
+        check([["a", 0, 0, digest[:-2]]])
+        check([["../a", 0, 0, digest]], err="bad name")
+        check([["/a", 0, 0, digest]], err="bad name")
+        check([["a//b", 0, 0, digest]], err="bad name")
+
+    def test_missing(self):
+        contents = {"same": b"same", "touched": b"touched",
+                    "changed": b"new", "resized": b"resized", "gone": b"x"}
+        top, files = self.make_tree(contents)
+        m = manifest.build(files, "sha256")
+        names = [name for (name, _, _, _) in m.entries]
+        old = dict(contents)
+        old.update({"changed": b"old", "resized": b"size"})
+        del old["gone"]
+        old_top, _ = self.make_tree(old)
+        # files with another mtime are hashed
+        for name in ("touched", "changed"):
+            os.utime(os.path.join(old_top, name), (1600000000, 1600000000))
+        # a change that keeps the size and the mtime isn't noticed
+        sneaky = os.path.join(old_top, "same")
+        with open(sneaky, "wb") as f:
+            f.write(b"SAME")
+        os.utime(sneaky, (1500000000, 1500000000))
+        for jobs in (1, 3):
+            wanted = manifest.missing(m, old_top, self.extract_path, jobs)
+            self.assertEqual(sorted(names[i] for i in wanted),
+                             ["changed", "gone", "resized"])
+        self.assertEqual(manifest.missing(m, self.mktemp(),
+                                          self.extract_path),
+                         list(range(len(names))))
+
+
+class ChunkCache(unittest.TestCase):
+    def setUp(self):
+        self.patch(merkle, "CHUNK_SIZE", 1000)
+        # (every chunk is different)
+        self.data = b"".join(("%04d" % i).encode("ascii") for i in range(2625))
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(self.data)
+        self.tree = merkle.hash_file(fn, len(self.data), "sha256")
+        self.path = self.mktemp()
+
+    def test_store_and_fill(self):
+        self.assertEqual(len(self.tree.leaves), 11)
+        cache = chunkcache.ChunkCache(self.path, 10**6)
+        self.assertEqual(cache.fill(io.BytesIO(), self.tree), [])
+        self.assertEqual(cache.store(io.BytesIO(self.data), self.tree,
+                                     skip=[1, 2]), 9)
+        self.assertEqual(cache.store(io.BytesIO(self.data), self.tree), 2)
+        self.assertEqual(cache.store(io.BytesIO(self.data), self.tree), 0)
+        f = io.BytesIO()
+        self.assertEqual(cache.fill(f, self.tree), list(range(11)))
+        self.assertEqual(f.getvalue(), self.data)
+
+    def test_store_bad_chunk(self):
+        # a chunk that doesn't match its hash isn't kept
+        cache = chunkcache.ChunkCache(self.path, 10**6)
+        bad = self.data[:3000] + b"x" + self.data[3001:]
+        self.assertEqual(cache.store(io.BytesIO(bad), self.tree), 10)
+        self.assertEqual(cache.fill(io.BytesIO(), self.tree),
+                         [0, 1, 2, 4, 5, 6, 7, 8, 9, 10])
+
+    def test_discard(self):
+        cache = chunkcache.ChunkCache(self.path, 10**6)
+        cache.store(io.BytesIO(self.data), self.tree)
+        cache.discard(self.tree.hash_alg, self.tree.leaves[5])
+        cache.discard(self.tree.hash_alg, self.tree.leaves[5])
+        self.assertNotIn(5, cache.fill(io.BytesIO(), self.tree))
+
+    def test_evict(self):
+        cache = chunkcache.ChunkCache(self.path, 10**6)
+        cache.store(io.BytesIO(self.data), self.tree)
+        for (index, leaf) in enumerate(self.tree.leaves):
+            path = cache._chunk_path(self.tree.hash_alg, leaf)
+            os.utime(path, (1500000000 + index, 1500000000 + index))
+        # the least recently used chunks go first
+        chunkcache.ChunkCache(self.path, 3000).evict()
+        self.assertEqual(cache.fill(io.BytesIO(), self.tree), [8, 9, 10])
+
+    def test_gaps(self):
+        # what a ChunkSkipper reads is what a GapWriter writes around the
+        # chunks that were skipped
+        for skip in ([], [0, 1, 4, 10], list(range(11))):
+            skipper = chunkcache.ChunkSkipper(io.BytesIO(self.data),
+                                              self.tree, skip)
+            f = io.BytesIO()
+            for index in skip:
+                offset = index * self.tree.chunk_size
+                f.seek(offset)
+                f.write(self.data[offset:offset +
+                                  self.tree.chunk_length(index)])
+            writer = chunkcache.GapWriter(f, self.tree, skip)
+            self.assertEqual(writer.size, skipper.size)
+            sent = 0
+            while True:
+                data = skipper.read(777)
+                if not data:
+                    break
+                writer.write(data)
+                sent += len(data)
+            self.assertEqual(sent, skipper.size)
+            self.assertEqual(f.getvalue(), self.data)
+
+
+class Sparse(unittest.TestCase):
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_zeros(self):
+        block = sparse.BLOCK_SIZE
+        data = (b"\x00" * (2 * block) + b"x" + b"\x00" * (3 * block) +
+                b"x" * block + b"\x00" * block)
+        with open(self.make_file(data), "rb") as f:
+            self.assertEqual(sparse.find_extents(f, len(data), zeros=True),
+                             [(2 * block, block), (5 * block, 2 * block + 1)])
+            self.assertEqual(f.tell(), 0)
+        # (a run of zeros that doesn't cover a whole block doesn't count)
+        data = b"x" * (block + 10) + b"\x00" * block + b"x"
+        with open(self.make_file(data), "rb") as f:
+            self.assertEqual(sparse.find_extents(f, len(data), zeros=True),
+                             None)
+        with open(self.make_file(b""), "rb") as f:
+            self.assertEqual(sparse.find_extents(f, 0, zeros=True), None)
+
+    def test_holes(self):
+        # (where the filesystem keeps track of them)
+        block = sparse.BLOCK_SIZE
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(b"x")
+            f.truncate(64 * block)
+            f.seek(32 * block)
+            f.write(b"x")
+        with open(fn, "rb") as f:
+            extents = sparse.find_extents(f, 64 * block)
+        if extents is None:
+            raise unittest.SkipTest("this filesystem doesn't track holes")
+        self.assertEqual(extents[0][0], 0)
+        self.assertTrue(any(offset <= 32 * block < offset + length
+                            for (offset, length) in extents))
+        self.assertTrue(sum(length for (offset, length) in extents) <
+                        64 * block)
+
+    def test_coalesce(self):
+        # holes shorter than a block are sent as data
+        block = sparse.BLOCK_SIZE
+        self.assertEqual(sparse._coalesce([(0, 1), (block, 1)]),
+                         [(0, block + 1)])
+        self.assertEqual(sparse._coalesce([(0, 1), (block + 1, 1)]),
+                         [(0, 1), (block + 1, 1)])
+
+    def test_max_extents(self):
+        # the smallest holes are filled in first
+        block = sparse.BLOCK_SIZE
+        extents = [(0, 1), (2 * block, 1), (5 * block, 1), (7 * block, 1)]
+        self.patch(sparse, "MAX_EXTENTS", 2)
+        self.assertEqual(sparse._coalesce(extents),
+                         [(0, 2 * block + 1), (5 * block, 2 * block + 1)])
+
+    def test_parse(self):
+        self.assertEqual(sparse.parse_extents([[0, 5], [10, 5]], 20),
+                         [(0, 5), (10, 5)])
+        self.assertEqual(sparse.parse_extents([], 20), [])
+        for bad in [{}, [[0]], [(0, 5)], [[0, True]], [[0, u"5"]],
+                    [[0, 0]], [[10, 5], [0, 5]], [[0, 5], [4, 5]],
+                    [[16, 5]], [[-1, 5]]]:
+            self.assertRaises(ValueError, sparse.parse_extents, bad, 20)
+
+    def test_reader_and_writer(self):
+        data = os.urandom(10000)
+        extents = [(0, 100), (1000, 2345), (9000, 1000)]
+        reader = sparse.ExtentReader(io.BytesIO(data), extents)
+        f = io.BytesIO(b"\x00" * len(data))
+        writer = sparse.ExtentWriter(f, extents)
+        self.assertEqual(reader.size, 3445)
+        self.assertEqual(writer.size, reader.size)
+        while True:
+            piece = reader.read(777)
+            self.assertTrue(len(piece) <= 777)
+            if not piece:
+                break
+            writer.write(piece)
+        expected = bytearray(len(data))
+        for (offset, length) in extents:
+            expected[offset:offset + length] = data[offset:offset + length]
+        self.assertEqual(f.getvalue(), bytes(expected))
+
+
+class ExtractPath(unittest.TestCase):
     def test_filenames(self):
         args = mock.Mock()
         args.relay_url = u""
-        ef = cmd_receive.Receiver(args)._extract_file
-        extract_dir = os.path.abspath(self.mktemp())
+        ep = cmd_receive.Receiver(args)._extract_path
+        extract_dir = os.path.realpath(self.mktemp())
+
+        self.assertEqual(
+            ep(extract_dir, "ok"), os.path.join(extract_dir, "ok"))
+
+        e = self.assertRaises(ValueError, ep, extract_dir, "../haha")
+        self.assertIn("malicious zipfile", str(e))
+
+        # abspath squashes this
+        self.assertEqual(
+            ep(extract_dir, "haha//root"),
+            os.path.join(extract_dir, "haha", "root"))
+
+        e = self.assertRaises(ValueError, ep, extract_dir, "/etc/passwd")
+        self.assertIn("malicious zipfile", str(e))
+
+        # a prefix of the name isn't enough
+        e = self.assertRaises(ValueError, ep, extract_dir,
+                              "../%s2/haha" % os.path.basename(extract_dir))
+        self.assertIn("malicious zipfile", str(e))
 
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "ok"
-        zi.external_attr = 5 << 16
-        expected = os.path.join(extract_dir, "ok")
-        with mock.patch.object(cmd_receive.os, "chmod") as chmod:
-            ef(zf, zi, extract_dir)
-            self.assertEqual(zf.extract.mock_calls,
-                             [mock.call(zi.filename, path=extract_dir)])
-            self.assertEqual(chmod.mock_calls, [mock.call(expected, 5)])
-
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "../haha"
-        e = self.assertRaises(ValueError, ef, zf, zi, extract_dir)
+    def test_symlink(self):
+        if not hasattr(os, 'symlink'):
+            raise unittest.SkipTest("host OS does not support symlinks")
+        args = mock.Mock()
+        args.relay_url = u""
+        ep = cmd_receive.Receiver(args)._extract_path
+        extract_dir = os.path.realpath(self.mktemp())
+        outside = os.path.realpath(self.mktemp())
+        os.mkdir(extract_dir)
+        os.mkdir(outside)
+        # a symlink that's already there can't lead us out
+        os.symlink(outside, os.path.join(extract_dir, "link"))
+        e = self.assertRaises(ValueError, ep, extract_dir, "link/haha")
         self.assertIn("malicious zipfile", str(e))
+        # but a symlinked extract_dir is fine
+        os.symlink(extract_dir, extract_dir + ".link")
+        self.assertEqual(
+            ep(extract_dir + ".link", "ok"), os.path.join(extract_dir, "ok"))
+
 
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "haha//root"  # abspath squashes this, hopefully zipfile
-        # does too
-        zi.external_attr = 5 << 16
-        expected = os.path.join(extract_dir, "haha", "root")
-        with mock.patch.object(cmd_receive.os, "chmod") as chmod:
-            ef(zf, zi, extract_dir)
-            self.assertEqual(zf.extract.mock_calls,
-                             [mock.call(zi.filename, path=extract_dir)])
-            self.assertEqual(chmod.mock_calls, [mock.call(expected, 5)])
-
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "/etc/passwd"
-        e = self.assertRaises(ValueError, ef, zf, zi, extract_dir)
+class MergeDirectory(unittest.TestCase):
+    def setUp(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        self.r = cmd_receive.Receiver(args)
+        self.r.abs_destname = os.path.realpath(self.mktemp())
+        os.mkdir(self.r.abs_destname)
+        self.extract_dir = os.path.realpath(self.mktemp())
+        os.makedirs(os.path.join(self.extract_dir, "sub"))
+        with open(os.path.join(self.extract_dir, "sub", "new"), "wb") as f:
+            f.write(b"new\n")
+        self.r._manifest = mock.Mock()
+        self.r._manifest.entries = [(os.path.join("sub", "new"), 4, 1234,
+                                     b"")]
+        self.r._wanted = [0]
+
+    def test_merge(self):
+        self.r._merge_directory(self.extract_dir)
+        target = os.path.join(self.r.abs_destname, "sub", "new")
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"new\n")
+        self.assertEqual(os.stat(target).st_mtime, 1234)
+
+    def test_file_in_the_way(self):
+        # we won't delete a local file to make room for their directory
+        sub = os.path.join(self.r.abs_destname, "sub")
+        with open(sub, "wb") as f:
+            f.write(b"mine\n")
+        e = self.assertRaises(TransferError, self.r._merge_directory,
+                              self.extract_dir)
+        self.assertEqual(str(e),
+                         "refusing to replace '%s' with a directory" % sub)
+        with open(sub, "rb") as f:
+            self.assertEqual(f.read(), b"mine\n")
+
+
+class CheckDatahash(unittest.TestCase):
+    def setUp(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        self.r = cmd_receive.Receiver(args)
+        self.r._close_transit = mock.Mock(return_value=succeed(None))
+        self.tmp_name = os.path.abspath(self.mktemp())
+        self.r._checkpoint_name = self.tmp_name + ".checkpoint"
+        for fn in (self.tmp_name, self.r._checkpoint_name):
+            with open(fn, "wb") as f:
+                f.write(b"data")
+        self.f = open(self.tmp_name, "rb")
+        self.addCleanup(self.f.close)
+        self.r._expected_hash = hashlib.sha256(b"data").hexdigest()
+        self.r._hasher = self.r._new_hasher()
+        self.r._hasher.update(b"data")
+
+    @inlineCallbacks
+    def test_good(self):
+        datahash = self.r._hasher.digest()
+        yield self.r._check_datahash("rp", datahash, self.f)
+        self.assertEqual(self.r._close_transit.mock_calls, [])
+        self.assertTrue(os.path.exists(self.tmp_name))
+
+    @inlineCallbacks
+    def test_bad(self):
+        datahash = hashlib.sha256(b"other").digest()
+        d = self.r._check_datahash("rp", datahash, self.f)
+        e = yield self.assertFailure(d, TransferError)
+        self.assertIn("doesn't match the sender's hash", str(e))
+        # the sender gets our hash, so it can tell too
+        self.assertEqual(self.r._close_transit.mock_calls,
+                         [mock.call("rp", datahash)])
+        self.assertFalse(os.path.exists(self.tmp_name))
+        self.assertFalse(os.path.exists(self.r._checkpoint_name))
+
+
+class LoadCheckpoint(unittest.TestCase):
+    def setUp(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        self.r = cmd_receive.Receiver(args)
+        self.r._resumable = True
+        self.r.xfersize = 100
+        self.r._checkpoint_name = os.path.abspath(self.mktemp())
+
+    def _write(self, **kwargs):
+        checkpoint = {
+            "filesize": 100,
+            "offset": 10,
+            "hash_alg": u"sha256",
+            "digest": u"00" * 32,
+        }
+        checkpoint.update(kwargs)
+        with open(self.r._checkpoint_name, "w") as f:
+            json.dump(checkpoint, f)
+
+    def test_mtime(self):
+        self.r._identity = self.r._file_identity({"mtime": 1500000000})
+        self._write(mtime=1500000000)
+        self.assertEqual(self.r._load_checkpoint()["offset"], 10)
+        self._write(mtime=1500000001)
+        self.assertEqual(self.r._load_checkpoint(), None)
+
+    def test_sha256(self):
+        self.r._expected_hash = u"11" * 32
+        self.r._identity = self.r._file_identity({"mtime": 1500000000})
+        self._write(mtime=1500000000, file_sha256=u"11" * 32)
+        self.assertEqual(self.r._load_checkpoint()["offset"], 10)
+        self._write(mtime=1500000000, file_sha256=u"22" * 32)
+        self.assertEqual(self.r._load_checkpoint(), None)
+
+    def test_unidentified(self):
+        # older senders don't say which file they're sending, and older
+        # checkpoints don't say which file they came from
+        self.r._identity = self.r._file_identity({"mtime": True})
+        self._write(mtime=True)
+        self.assertEqual(self.r._load_checkpoint(), None)
+        self.r._identity = self.r._file_identity({"mtime": 1500000000})
+        self._write(sha256=u"00" * 32)
+        self.assertEqual(self.r._load_checkpoint(), None)
+
+
+class PickHashAlg(unittest.TestCase):
+    def setUp(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        self.r = cmd_receive.Receiver(args)
+
+    def test_older_sender(self):
+        self.r._pick_hash_alg({"filename": "x"})
+        self.assertEqual(self.r._hash_alg, None)
+        self.assertEqual(self.r._hasher.name, "sha256")
+        self.r._pick_hash_alg({"hash_algs": "sha256"})
+        self.assertEqual(self.r._hash_alg, None)
+
+    def test_first_we_know(self):
+        self.r._pick_hash_alg({"hash_algs": [u"sha3-999", u"sha256"]})
+        self.assertEqual(self.r._hash_alg, u"sha256")
+        self.r._pick_hash_alg({"hash_algs": [u"sha3-999"]})
+        self.assertEqual(self.r._hash_alg, None)
+
+    def test_blake2b(self):
+        if u"blake2b" not in util.available_hash_algorithms():
+            raise unittest.SkipTest("this python has no blake2b")
+        self.r._pick_hash_alg({"hash_algs": [u"blake2b", u"sha256"]})
+        self.assertEqual(self.r._hash_alg, u"blake2b")
+        self.assertEqual(self.r._hasher.name, "blake2b")
+
+    def test_prehash(self):
+        self.r._expected_hash = u"00" * 32
+        self.r._pick_hash_alg({"hash_algs": [u"blake2b", u"sha256"]})
+        self.assertEqual(self.r._hash_alg, u"sha256")
+        self.assertIsInstance(self.r._hasher, util.ThreadedHasher)
+        self.r._hasher.close()
+
+    def test_checkpoint(self):
+        # an older checkpoint is resumed with sha256, if we can
+        self.r._checkpoint = {"sha256": u"00" * 32}
+        self.r._pick_hash_alg({"hash_algs": [u"blake2b", u"sha256"]})
+        self.assertEqual(self.r._hash_alg, u"sha256")
+        self.r._checkpoint = {"hash_alg": u"sha3-999"}
+        self.r._pick_hash_alg({"hash_algs": [u"sha256"]})
+        self.assertEqual(self.r._hash_alg, u"sha256")
+
+
+class InlineFile(unittest.TestCase):
+    def _sender(self, data):
+        s = cmd_send.Sender(config("send"), reactor)
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        s._fd_to_send = open(fn, "rb")
+        self.addCleanup(s._fd_to_send.close)
+        offer = {"file": {"filename": "x", "filesize": len(data),
+                          "delta": [delta.FORMAT]}}
+        return s, offer
+
+    def test_inline(self):
+        s, offer = self._sender(b"data")
+        inlined = s._inline_file(offer, 1000)
+        self.assertEqual(inlined, {"file": {"filename": "x", "filesize": 4,
+                                            "inline": u"ZGF0YQ=="}})
+        self.assertEqual(s._inline, b"data")
+
+    def test_too_big(self):
+        s, offer = self._sender(b"data")
+        self.assertIs(s._inline_file(offer, 4), offer)
+        self.patch(cmd_send, "INLINE_MAX_SIZE", 4)
+        self.assertIs(s._inline_file(offer, 1000), offer)
+        self.assertEqual(s._inline, None)
+
+    def test_older_receiver(self):
+        s, offer = self._sender(b"data")
+        for limit in (None, True, "1000"):
+            self.assertIs(s._inline_file(offer, limit), offer)
+        self.assertEqual(s._inline, None)
+
+    def test_changed(self):
+        # a file that grew since it was offered is sent the usual way
+        s, offer = self._sender(b"data and more")
+        offer["file"]["filesize"] = 4
+        self.assertIs(s._inline_file(offer, 1000), offer)
+        self.assertEqual(s._inline, None)
+        self.assertEqual(s._fd_to_send.tell(), 0)
+
+    def test_decode(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        r = cmd_receive.Receiver(args)
+        r.xfersize = 4
+        self.assertEqual(r._decode_inline(u"ZGF0YQ=="), b"data")
+        for bad in (u"ZGF0YQ=", u"ZGF0YWE=", 4):
+            e = self.assertRaises(cmd_receive.RespondError,
+                                  r._decode_inline, bad)
+            self.assertEqual(e.response, "bad inline file")
+        self.patch(cmd_receive, "INLINE_MAX_SIZE", 4)
+        self.assertRaises(cmd_receive.RespondError, r._decode_inline,
+                          u"ZGF0YQ==")
+
+
+class ExtractZip(unittest.TestCase):
+    def setUp(self):
+        args = mock.Mock()
+        args.relay_url = u""
+        self.extract_path = cmd_receive.Receiver(args)._extract_path
+        self.contents = {
+            "0": b"0 ponies\n",
+            "sub/1": os.urandom(100 * 1000),
+            "sub/2": b"",
+        }
+
+    def _make_zipfile(self, compression=zipfile.ZIP_DEFLATED):
+        f = io.BytesIO()
+        with zipfile.ZipFile(f, "w", compression) as zf:
+            for name in sorted(self.contents):
+                zi = zipfile.ZipInfo(name)
+                zi.compress_type = compression
+                zi.external_attr = 0o640 << 16
+                zf.writestr(zi, self.contents[name])
+        return f.getvalue()
+
+    def _extract(self, zdata, record_size=1000):
+        extract_dir = os.path.abspath(self.mktemp())
+        os.mkdir(extract_dir)
+        ze = zipstream.ZipExtractor(extract_dir, self.extract_path,
+                                    chunk_size=500)
+        for i in range(0, len(zdata), record_size):
+            ze.write(zdata[i:i + record_size])
+        self.assertEqual(ze.tell(), len(zdata))
+        return ze, extract_dir
+
+    def _check(self, extract_dir):
+        for name, data in self.contents.items():
+            fn = os.path.join(extract_dir, *name.split("/"))
+            with open(fn, "rb") as f:
+                self.assertEqual(f.read(), data)
+            if os.name == "posix":
+                self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), 0o640)
+
+    def test_deflated(self):
+        ze, extract_dir = self._extract(self._make_zipfile())
+        ze.close()
+        self._check(extract_dir)
+
+    def test_stored(self):
+        ze, extract_dir = self._extract(
+            self._make_zipfile(zipfile.ZIP_STORED), record_size=1)
+        ze.close()
+        self._check(extract_dir)
+
+    def _write_files(self):
+        send_dir = os.path.abspath(self.mktemp())
+        files = []
+        for name, data in sorted(self.contents.items()):
+            fn = os.path.join(send_dir, *name.split("/"))
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            with open(fn, "wb") as f:
+                f.write(data)
+            os.chmod(fn, 0o640)
+            files.append((fn, name))
+        return files
+
+    def test_stream(self):
+        zdata = zipstream.ZipStream(self._write_files()).read()
+        ze, extract_dir = self._extract(zdata)
+        ze.close()
+        self._check(extract_dir)
+
+    def test_stream_chunks(self):
+        # sub/1 is compressed in many chunks, and gets a data descriptor
+        files = self._write_files()
+        zdata = zipstream.ZipStream(files, chunk_size=1000).read()
+        with zipfile.ZipFile(io.BytesIO(zdata), "r") as zf:
+            self.assertEqual(zf.testzip(), None)
+            for name, data in self.contents.items():
+                self.assertEqual(zf.read(name), data)
+        ze, extract_dir = self._extract(zdata)
+        ze.close()
+        self._check(extract_dir)
+
+    def test_stream_jobs(self):
+        # the zipfile is the same, however many threads compress it
+        files = self._write_files()
+        zs = zipstream.ZipStream(files, chunk_size=1000, jobs=3)
+        pieces = []
+        while True:
+            data = zs.read(777)
+            if not data:
+                break
+            pieces.append(data)
+        zdata = b"".join(pieces)
+        self.assertEqual(zs.tell(), len(zdata))
+        self.assertEqual(
+            zdata,
+            zipstream.ZipStream(files, chunk_size=1000, jobs=1).read())
+        ze, extract_dir = self._extract(zdata)
+        ze.close()
+        self._check(extract_dir)
+
+    def test_stream_stores_incompressible(self):
+        text = b"ponies " * 100000
+        self.contents = {
+            "text": text,
+            "small": text[:1000],
+            "small.jpg": text[:1000],  # (it says it's compressed)
+            "random": os.urandom(100),
+            "big/random": os.urandom(3000),
+            "big/mixed": os.urandom(1000) + text[:2000],
+        }
+        files = self._write_files()
+        zs = zipstream.ZipStream(files, chunk_size=1000, jobs=2)
+        zdata = zs.read()
+        stored = 100 + 3000 + 1000 + 1000
+        self.assertEqual(zs.stored_bytes, stored)
+        self.assertEqual(zs.deflated_bytes,
+                         sum(len(d) for d in self.contents.values()) - stored)
+        with zipfile.ZipFile(io.BytesIO(zdata), "r") as zf:
+            self.assertEqual(zf.testzip(), None)
+            # small files are stored as they are
+            for name in ["small.jpg", "random"]:
+                zi = zf.getinfo(name)
+                self.assertEqual(zi.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zi.compress_size, zi.file_size)
+            self.assertEqual(
+                zf.getinfo("small").compress_type, zipfile.ZIP_DEFLATED)
+            # but chunks of bigger ones are wrapped in deflate blocks
+            zi = zf.getinfo("big/random")
+            self.assertEqual(zi.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertTrue(zi.compress_size >= zi.file_size)
+            self.assertTrue(zf.getinfo("big/mixed").compress_size < 2000)
+            self.assertTrue(zf.getinfo("text").compress_size < 100000)
+        ze, extract_dir = self._extract(zdata)
+        ze.close()
+        self._check(extract_dir)
+
+    def test_stream_unreadable(self):
+        files = self._write_files()
+        files.insert(1, (os.path.abspath(self.mktemp()), "missing"))
+        zs = zipstream.ZipStream(files, jobs=2)
+        zdata = zs.read()
+        self.assertEqual(zs.skipped, ["missing"])
+        with zipfile.ZipFile(io.BytesIO(zdata), "r") as zf:
+            self.assertEqual(sorted(zf.namelist()), sorted(self.contents))
+
+    def test_corrupt(self):
+        zdata = bytearray(self._make_zipfile(zipfile.ZIP_STORED))
+        where = zdata.index(b"0 ponies")
+        zdata[where] ^= 0x01
+        ze, extract_dir = self._extract(bytes(zdata))
+        e = self.assertRaises(zipfile.BadZipfile, ze.close)
+        self.assertIn("bad CRC", str(e))
+
+    def test_incomplete(self):
+        zdata = self._make_zipfile()
+        ze, extract_dir = self._extract(zdata[:len(zdata) // 2])
+        e = self.assertRaises(zipfile.BadZipfile, ze.close)
+        self.assertIn("incomplete", str(e))
+
+    def test_malicious(self):
+        self.contents = {"../haha": b"evil\n"}
+        ze, extract_dir = self._extract(self._make_zipfile())
+        e = self.assertRaises(ValueError, ze.close)
         self.assertIn("malicious zipfile", str(e))
+        self.assertFalse(os.path.exists(
+            os.path.join(os.path.dirname(extract_dir), "haha")))
 
 
 class AppID(ServerBase, unittest.TestCase):
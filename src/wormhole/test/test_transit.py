@@ -2,14 +2,18 @@ from __future__ import print_function, unicode_literals
 
 import gc
 import io
+import os
+import zlib
 from binascii import hexlify, unhexlify
 from collections import namedtuple
 
 import six
 from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
-from twisted.internet import address, defer, endpoints, error, protocol, task
+from twisted.internet import (address, defer, endpoints, error, protocol,
+                              reactor, task)
 from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.protocols import basic
 from twisted.python import log
 from twisted.test import proto_helpers
 from twisted.trial import unittest
@@ -360,7 +364,26 @@ class Basic(unittest.TestCase):
         self.assertEqual(hints[0]["hostname"], "127.0.0.1")
 
     def test_abilities(self):
+        # the newer record formats are only advertised when asked for
         c = transit.Common(None, no_listen=True)
+        self.assertEqual(c.get_connection_abilities(), [
+            {
+                "type": "direct-tcp-v1"
+            },
+            {
+                "type": "relay-v1"
+            },
+            {
+                "type": "record-size-v1",
+                "max": transit.Common.MAX_RECORD_SIZE,
+            },
+            {
+                "type": "striping-v1",
+                "max": 1,
+            },
+        ])
+        c = transit.Common(None, no_listen=True, cipher_suites=True,
+                           framing_v2=True, accept_compressed=True)
         abilities = c.get_connection_abilities()
         self.assertEqual(abilities, [
             {
@@ -369,7 +392,158 @@ class Basic(unittest.TestCase):
             {
                 "type": "relay-v1"
             },
+            {
+                "type": "record-size-v1",
+                "max": transit.Common.MAX_RECORD_SIZE,
+            },
+            {
+                "type": "cipher-suites-v1",
+                "suites": [c.name for c in
+                           transit.available_cipher_suites()],
+            },
+            {
+                "type": "framing-v2"
+            },
+            {
+                "type": "compression-v1",
+                "algorithms": [c.name for c in transit.available_codecs()],
+            },
+            {
+                "type": "striping-v1",
+                "max": 1,
+            },
         ])
+        self.assertIn("zlib", abilities[5]["algorithms"])
+        names = abilities[3]["suites"]
+        self.assertIn("xsalsa20poly1305", names)
+        self.assertEqual(names, [c.name for c in transit.CIPHER_SUITES
+                                 if c.name in names])  # fastest first
+
+    def test_framing(self):
+        c = transit.Common(None, no_listen=True, framing_v2=True)
+        self.assertEqual(c._framing(), 1)
+        c.add_connection_abilities([{"type": "record-size-v1", "max": 10}])
+        self.assertEqual(c._framing(), 1)
+        c.add_connection_abilities(c.get_connection_abilities())
+        self.assertEqual(c._framing(), 2)
+        # (not unless we advertised it too)
+        old = transit.Common(None, no_listen=True)
+        old.add_connection_abilities(c.get_connection_abilities())
+        self.assertEqual(old._framing(), 1)
+
+    def test_record_compressor(self):
+        s = transit.TransitSender(None, no_listen=True, compress=True)
+        r = transit.TransitReceiver(None, no_listen=True)
+        # no flag bytes unless both sides advertise compression-v1
+        self.assertIs(s._record_compressor(), None)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+        self.assertIs(s._record_compressor(), None)
+        self.assertIs(r._record_compressor(), None)
+        r = transit.TransitReceiver(None, no_listen=True,
+                                    accept_compressed=True)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+        sc = s._record_compressor()
+        self.assertIs(sc.codec, transit.available_codecs()[0])
+        # the receiver wasn't asked to compress, but still takes flag bytes
+        self.assertIs(r._record_compressor().codec, None)
+        # only compress with something the peer can decompress
+        s.add_connection_abilities([{"type": "compression-v1",
+                                     "algorithms": ["zlib", "rot13"]}])
+        self.assertIs(s._record_compressor().codec, transit.ZlibCodec)
+        s.add_connection_abilities([{"type": "compression-v1",
+                                     "algorithms": []}])
+        self.assertIs(s._record_compressor().codec, None)
+
+    def test_cipher_suite(self):
+        s = transit.TransitSender(None, no_listen=True, cipher_suites=True)
+        r = transit.TransitReceiver(None, no_listen=True, cipher_suites=True)
+        # old peers only know XSalsa20Poly1305
+        self.assertIs(s._cipher_suite(), transit.XSalsa20Poly1305)
+        self.assertIs(r._cipher_suite(), transit.XSalsa20Poly1305)
+        # and so do applications that didn't ask for the others
+        old = transit.TransitReceiver(None, no_listen=True)
+        old.add_connection_abilities(s.get_connection_abilities())
+        s.add_connection_abilities(old.get_connection_abilities())
+        self.assertIs(old._cipher_suite(), transit.XSalsa20Poly1305)
+        self.assertIs(s._cipher_suite(), transit.XSalsa20Poly1305)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+        self.assertIs(s._cipher_suite(), r._cipher_suite())
+        self.assertIs(s._cipher_suite(), transit.available_cipher_suites()[0])
+
+        # the sender's preference wins
+        def suites(*names):
+            return [{"type": "cipher-suites-v1", "suites": list(names)}]
+
+        s.add_connection_abilities(suites("xsalsa20poly1305",
+                                          "xchacha20poly1305"))
+        self.assertIs(s._cipher_suite(), transit.XChaCha20Poly1305)
+        r.add_connection_abilities(suites("xsalsa20poly1305",
+                                          "xchacha20poly1305"))
+        self.assertIs(r._cipher_suite(), transit.XSalsa20Poly1305)
+        r.add_connection_abilities(suites("rot13", "xchacha20poly1305"))
+        self.assertIs(r._cipher_suite(), transit.XChaCha20Poly1305)
+        for bad in [suites("rot13"), suites(), [{"type": "cipher-suites-v1"}],
+                    [{"type": "cipher-suites-v1", "suites": "aes256gcm"}]]:
+            s.add_connection_abilities(bad)
+            self.assertIs(s._cipher_suite(), transit.XSalsa20Poly1305)
+
+    def test_stripe_count(self):
+        s = transit.TransitSender(None, no_listen=True, stripes=4)
+        r = transit.TransitReceiver(None, no_listen=True,
+                                    stripes=transit.Common.MAX_STRIPES)
+        # old peers only use one connection
+        self.assertEqual(s.get_stripe_count(), 1)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+        self.assertEqual(s.get_stripe_count(), 4)
+        self.assertEqual(r.get_stripe_count(), 4)
+        # the receiver can ask for fewer
+        s.add_connection_abilities([{"type": "striping-v1", "max": 2}])
+        self.assertEqual(s.get_stripe_count(), 2)
+        c = transit.Common(None, no_listen=True, stripes=100)
+        c.add_connection_abilities([{"type": "striping-v1", "max": 100}])
+        self.assertEqual(c.get_stripe_count(), c.MAX_STRIPES)
+        for bad in [0, -1, "4", None, True]:
+            s.add_connection_abilities([{"type": "striping-v1", "max": bad}])
+            self.assertEqual(s.get_stripe_count(), 1)
+
+    def test_stripe_keys(self):
+        s = transit.TransitSender(None, no_listen=True)
+        r = transit.TransitReceiver(None, no_listen=True)
+        s.set_transit_key(b"key")
+        r.set_transit_key(b"key")
+        # stripe 0 uses the usual keys, and each of the others has its own
+        keys = set()
+        for stripe in range(4):
+            skey = s._sender_record_key(stripe)
+            self.assertEqual(skey, r._receiver_record_key(stripe))
+            self.assertEqual(s._receiver_record_key(stripe),
+                             r._sender_record_key(stripe))
+            keys.add(skey)
+            keys.add(s._receiver_record_key(stripe))
+        self.assertEqual(len(keys), 8)
+        self.assertEqual(s._sender_record_key(0), s._sender_record_key())
+
+    def test_max_record_size(self):
+        c = transit.Common(None, no_listen=True)
+        # old peers don't say how big a record they'll take
+        self.assertEqual(c._max_record_size(), None)
+        c.add_connection_abilities([{"type": "direct-tcp-v1"}])
+        self.assertEqual(c._max_record_size(), None)
+        c.add_connection_abilities([{"type": "record-size-v1", "max": 1000}])
+        self.assertEqual(c._max_record_size(), 1000)
+        c.add_connection_abilities([{"type": "record-size-v1",
+                                     "max": 2**40}])
+        self.assertEqual(c._max_record_size(), c.MAX_RECORD_SIZE)
+        for bad in [0, -1, "1000", None, True]:
+            c.add_connection_abilities([{"type": "record-size-v1",
+                                         "max": bad}])
+            self.assertEqual(c._max_record_size(), None)
+        c.add_connection_abilities(["not a dict"])
+        self.assertEqual(c._max_record_size(), None)
 
     def test_transit_key_wait(self):
         KEY = b"123"
@@ -430,6 +604,25 @@ class Basic(unittest.TestCase):
         self.assertEqual(r.connection_ready("p1"), "wait-for-decision")
         self.assertEqual(r.connection_ready("p2"), "wait-for-decision")
 
+    def test_connection_ready_striping(self):
+        s = transit.TransitSender("", stripes=3)
+        s.add_connection_abilities([{"type": "striping-v1", "max": 8}])
+        p = [MockConnection(s, None, None, "p%d" % i) for i in range(5)]
+        self.assertEqual(s.connection_ready(p[0]), "go")
+        self.assertEqual(s._winner, p[0])
+        # the next two become stripes 1 and 2
+        self.assertEqual(s.connection_ready(p[1]), "go")
+        self.assertEqual(s.connection_ready(p[2]), "go")
+        self.assertEqual([c.stripe for c in p[:3]], [0, 1, 2])
+        self.assertEqual(s.connection_ready(p[3]), "nevermind")
+        self.assertEqual(p[3].stripe, 0)
+
+        s = transit.TransitSender("", stripes=3)
+        s.add_connection_abilities([{"type": "striping-v1", "max": 8}])
+        self.assertEqual(s.connection_ready(p[0]), "go")
+        s.stop_striping()
+        self.assertEqual(s.connection_ready(p[4]), "nevermind")
+
 
 class Listener(unittest.TestCase):
     def test_listener(self):
@@ -455,6 +648,21 @@ class Listener(unittest.TestCase):
 
         c._stop_listening()
 
+    def test_stop_listening(self):
+        # an application that gives up before connect() stops the listener
+        # itself, as often as it likes
+        c = transit.TransitSender("")
+        self.successResultOf(c.get_connection_hints())
+        c.stop_listening()
+        self.assertTrue(c._listener_d.called)
+        self.assertTrue(c._striping_done)
+        c.stop_listening()
+
+        # (and without a listener, there's nothing to stop)
+        c = transit.TransitSender("", no_listen=True)
+        self.successResultOf(c.get_connection_hints())
+        c.stop_listening()
+
 
 class DummyProtocol(protocol.Protocol):
     def __init__(self):
@@ -501,6 +709,9 @@ class FakeTransport:
     def write(self, data):
         self._buf += data
 
+    def writeSequence(self, data):
+        self._buf += b"".join(data)
+
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -515,11 +726,68 @@ class FakeTransport:
         return b
 
 
+class PullTransport(proto_helpers.StringTransport):
+    # like a real transport, ask a pull producer for data as soon as it is
+    # registered
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.writes = []
+
+    def registerProducer(self, producer, streaming):
+        proto_helpers.StringTransport.registerProducer(
+            self, producer, streaming)
+        if not streaming:
+            producer.resumeProducing()
+
+    def writeSequence(self, data):
+        self.writes.append(data)
+
+
+class ListProducer:
+    def __init__(self, consumer, records):
+        self.consumer = consumer
+        self.records = records
+
+    def resumeProducing(self):
+        if self.records:
+            self.consumer.write(self.records.pop(0))
+
+    def stopProducing(self):
+        pass
+
+
+class FakeRunner:
+    # stands in for deferToThreadPool: jobs run when the test says so, in
+    # whatever order it likes
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, f, *args):
+        d = defer.Deferred()
+        self.jobs.append((d, f, args))
+        return d
+
+    def run(self, index):
+        (d, f, args) = self.jobs.pop(index)
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    def run_all(self, reverse=False):
+        while self.jobs:
+            self.run(-1 if reverse else 0)
+
+
 class RandomError(Exception):
     pass
 
 
 class MockConnection:
+    stripe = 0
+
     def __init__(self, owner, relay_handshake, start, description):
         self.owner = owner
         self.relay_handshake = relay_handshake
@@ -687,6 +955,7 @@ class OutboundConnectionFactory(unittest.TestCase):
 
 class MockOwner:
     _connection_ready_called = False
+    _connecting = True
 
     def connection_ready(self, connection):
         self._connection_ready_called = True
@@ -699,11 +968,40 @@ class MockOwner:
     def _expect_this(self):
         return b"expect_this"
 
-    def _sender_record_key(self):
-        return b"s" * 32
+    def _sender_record_key(self, stripe=0):
+        return b"s" * (32 - stripe) + b"-" * stripe
+
+    def _receiver_record_key(self, stripe=0):
+        return b"r" * (32 - stripe) + b"-" * stripe
+
+    _stripes = 1
 
-    def _receiver_record_key(self):
-        return b"r" * 32
+    def get_stripe_count(self):
+        return self._stripes
+
+    def _add_stripe(self, connection):
+        self._added_stripes.append(connection)
+
+    _record_size = None
+    _crypto = None
+    _suite = transit.XSalsa20Poly1305
+    _framing_version = 1
+    _compressor = None
+
+    def _max_record_size(self):
+        return self._record_size
+
+    def _record_compressor(self):
+        return self._compressor
+
+    def _framing(self):
+        return self._framing_version
+
+    def _cipher_suite(self):
+        return self._suite
+
+    def _crypto_runner(self):
+        return self._crypto
 
 
 class MockFactory:
@@ -929,6 +1227,74 @@ class Connection(unittest.TestCase):
         self.assertEqual(c.state, "records")
         self.assertEqual(self.successResultOf(d), c)
 
+    def _receiver_waiting(self, stripes):
+        owner = MockOwner()
+        owner._stripes = stripes
+        c = transit.Connection(owner, None, None, "description")
+        c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        return c, d
+
+    def test_receiver_stripe(self):
+        c, d = self._receiver_waiting(stripes=4)
+        c.dataReceived(b"go")
+        c.dataReceived(b" 3")
+        self.assertEqual(c.state, "wait-for-decision")
+        c.dataReceived(b"\n")
+        self.assertEqual(c.state, "records")
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(c.stripe, 3)
+        # each stripe has its own keys
+        c._start_records()
+        self.assertEqual(bytes(c.send_box._key),
+                         MockOwner()._sender_record_key(3))
+
+        # a plain "go" is still stripe 0
+        c, d = self._receiver_waiting(stripes=4)
+        c.dataReceived(b"go\n")
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(c.stripe, 0)
+
+    def test_receiver_bad_stripe(self):
+        for stripes, go in [(4, b"go 4\n"), (4, b"go 0\n"), (4, b"go x\n"),
+                            (4, b"go 12"), (1, b"go 1\n")]:
+            c, d = self._receiver_waiting(stripes)
+            c.dataReceived(go)
+            self.assertEqual(c.state, "hung up")
+            self.failureResultOf(d, transit.BadHandshake)
+
+    def test_sender_stripe(self):
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+
+        def _ready(p):
+            p.stripe = 2
+            return "go"
+
+        owner.connection_ready = _ready
+        d = c.startNegotiation()
+        t.read_buf()
+        c.dataReceived(b"expect_this")
+        self.assertEqual(t.read_buf(), b"go 2\n")
+        self.assertEqual(self.successResultOf(d), c)
+
+    def test_when_closed(self):
+        c = transit.Connection(None, None, None, "description")
+        c.transport = FakeTransport(c, None)
+        negotiation_d = c._negotiation_d
+        d = c.when_closed()
+        self.assertNoResult(d)
+        c.transport.loseConnection()
+        self.assertEqual(self.successResultOf(d), c)
+        self.failureResultOf(negotiation_d, transit.BadHandshake)
+
     def test_receiver_rejected_politely(self):
         # we're on the receiving side, so we wait for the sender to decide
         owner = MockOwner()
@@ -1029,8 +1395,15 @@ class Connection(unittest.TestCase):
         f = self.failureResultOf(d, transit.BadHandshake)
         self.assertEqual(str(f.value), "timeout")
 
-    def make_connection(self):
+    def make_connection(self, record_size=None, crypto=None, suite=None,
+                        framing=1, compressor=None):
         owner = MockOwner()
+        owner._compressor = compressor
+        owner._record_size = record_size
+        owner._crypto = crypto
+        if suite:
+            owner._suite = suite
+        owner._framing_version = framing
         factory = MockFactory()
         addr = address.HostnameAddress("example.com", 1234)
         c = transit.Connection(owner, None, None, "description")
@@ -1126,6 +1499,484 @@ class Connection(unittest.TestCase):
         c.dataReceived(r5 + r6)
         self.assertEqual(inbound_records, [RECORD5, RECORD6])
 
+    def test_records_with_handshake(self):
+        # the first records can arrive in the same read as "go"
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+        owner._state = "wait-for-decision"
+        d = c.startNegotiation()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        send_box = SecretBox(owner._receiver_record_key())
+        wire = b""
+        for i, record in enumerate([b"record0", b"record1", b"record2"]):
+            nonce_buf = unhexlify("%048x" % i)
+            wire += frame(send_box.encrypt(record, nonce_buf))
+        c.dataReceived(b"expect_this" + b"go\n" + wire[:-3])
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(c.buf, b"")
+        self.assertEqual(inbound_records, [b"record0", b"record1"])
+        c.dataReceived(wire[-3:])
+        self.assertEqual(inbound_records, [b"record0", b"record1", b"record2"])
+        self.assertEqual(t._connected, True)
+
+    def decrypt_records(self, owner, buf, first_nonce=0):
+        receive_box = SecretBox(owner._sender_record_key())
+        rb = transit.RecordBuffer()
+        rb.feed(buf)
+        self.assertEqual(rb.buffered(), 0)
+        records = []
+        for i, encrypted in enumerate(rb.records):
+            nonce = int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16)
+            self.assertEqual(nonce, first_nonce + i)
+            records.append(receive_box.decrypt(encrypted))
+        return records
+
+    def test_late_abilities(self):
+        # A sender can finish negotiating an inbound connection before it
+        # hears the receiver's abilities, so the record layer isn't set up
+        # until the first record is sent or received.
+        t, c, owner = self.make_connection()
+        self.assertIs(c.send_box, None)
+        owner._suite = transit.XChaCha20Poly1305
+        c.send_record(b"r0")
+        self.assertIsInstance(c.send_box, transit.XChaCha20Poly1305)
+        rb = transit.RecordBuffer()
+        rb.feed(t.read_buf())
+        receive_box = transit.XChaCha20Poly1305(owner._sender_record_key())
+        self.assertEqual(receive_box.decrypt(rb.records[0]), b"r0")
+
+    def check_cipher_suite(self, suite):
+        if not suite.available():
+            raise unittest.SkipTest("%s is not available" % suite.name)
+        t, c, owner = self.make_connection(suite=suite)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.send_records([b"r0", b"r1"])
+        receive_box = suite(owner._sender_record_key())
+        rb = transit.RecordBuffer()
+        rb.feed(t.read_buf())
+        self.assertEqual(len(rb.records), 2)
+        for i, encrypted in enumerate(rb.records):
+            self.assertEqual(encrypted[:suite.NONCE.size],
+                             suite.NONCE.pack(i))
+            self.assertEqual(len(encrypted), 2 + suite.OVERHEAD)
+            self.assertEqual(receive_box.decrypt(encrypted),
+                             b"r" + str(i).encode("ascii"))
+
+        send_box = suite(owner._receiver_record_key())
+        c.dataReceived(frame(send_box.encrypt(b"in", suite.NONCE.pack(0))))
+        self.assertEqual(inbound_records, [b"in"])
+        self.assertRaises(CryptoError, c.dataReceived,
+                          frame(self.corrupt(
+                              send_box.encrypt(b"in", suite.NONCE.pack(1)))))
+        self.assertEqual(t._connected, False)
+
+    def check_framing_v2(self, suite, crypto=None):
+        if not suite.available():
+            raise unittest.SkipTest("%s is not available" % suite.name)
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(
+            suite=suite, framing=2, crypto=crypto and (runner, 4))
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.send_records([b"r0", b"r1"])
+        runner.run_all(reverse=True)
+        # just the ciphertext and MAC: no nonce
+        receive_box = suite(owner._sender_record_key())
+        rb = transit.RecordBuffer()
+        rb.feed(t.read_buf())
+        self.assertEqual(len(rb.records), 2)
+        for i, encrypted in enumerate(rb.records):
+            self.assertEqual(len(encrypted), 2 + suite.MACBYTES)
+            self.assertEqual(receive_box.open(encrypted, suite.NONCE.pack(i)),
+                             b"r" + str(i).encode("ascii"))
+
+        send_box = suite(owner._receiver_record_key())
+
+        def seal(record, n):
+            return frame(send_box.seal(record, suite.NONCE.pack(n)))
+
+        c.dataReceived(seal(b"in0", 0) + seal(b"in1", 1))
+        runner.run_all(reverse=True)
+        self.assertEqual(inbound_records, [b"in0", b"in1"])
+        return t, c, runner, seal, inbound_records
+
+    def test_framing_v2(self):
+        for suite in transit.available_cipher_suites():
+            t, c, runner, seal, inbound_records = self.check_framing_v2(suite)
+            # a replayed record is detected, even though it carries no nonce
+            self.assertRaises(transit.BadNonce, c.dataReceived,
+                              seal(b"in1", 1))
+            self.assertEqual(inbound_records, [b"in0", b"in1"])
+            self.assertEqual(t._connected, False)
+
+    def test_records_before_connect(self):
+        # a sender's inbound connection can get records before it knows the
+        # receiver's abilities (framing-v2, here), so they wait for connect()
+        t, c, owner = self.make_connection()
+        t = c.transport = proto_helpers.StringTransport()
+        owner._connecting = False
+        waiters = []
+        owner._when_connecting = waiters.append
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        suite = transit.XSalsa20Poly1305
+        send_box = suite(owner._receiver_record_key())
+
+        def seal(record, n):
+            return frame(send_box.seal(record, suite.NONCE.pack(n)))
+
+        c.dataReceived(seal(b"in0", 0)[:10])
+        # (we stop reading, and only hold what was already in flight)
+        self.assertEqual(t.producerState, "paused")
+        c.dataReceived(seal(b"in0", 0)[10:] + seal(b"in1", 1))
+        self.assertEqual(inbound_records, [])
+        self.assertEqual(len(waiters), 1)
+        # our consumer can't resume us early
+        c.pauseProducing()
+        c.resumeProducing()
+        self.assertEqual(t.producerState, "paused")
+        owner._framing_version = 2
+        owner._connecting = True
+        waiters[0]()
+        self.assertEqual(inbound_records, [b"in0", b"in1"])
+        self.assertEqual(t.producerState, "producing")
+        c.dataReceived(seal(b"in2", 2))
+        self.assertEqual(inbound_records, [b"in0", b"in1", b"in2"])
+
+    def test_framing_v2_skipped_record(self):
+        t, c, runner, seal, inbound_records = self.check_framing_v2(
+            transit.XSalsa20Poly1305)
+        self.assertRaises(transit.BadNonce, c.dataReceived, seal(b"in3", 3))
+        self.assertEqual(t._connected, False)
+
+    def test_framing_v2_crypto_threads(self):
+        t, c, runner, seal, inbound_records = self.check_framing_v2(
+            transit.XSalsa20Poly1305, crypto=True)
+        c.dataReceived(seal(b"in2", 2) + seal(b"in2", 2) + seal(b"in4", 4))
+        runner.run_all()
+        self.assertEqual(inbound_records, [b"in0", b"in1", b"in2"])
+        self.assertEqual(t._connected, False)
+
+    def test_compression(self):
+        compressor = transit.RecordCompressor(transit.ZlibCodec, 100000)
+        t, c, owner = self.make_connection(compressor=compressor)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        text = b"".join([b"line " + str(i).encode("ascii") +
+                         b" of a log file\n" for i in range(2000)])
+        noise = os.urandom(50000)
+        c.send_records([text, noise, b"short"])
+        records = self.decrypt_records(owner, t.read_buf())
+        self.assertEqual(records[0][:1], transit.ZlibCodec.FLAG)
+        self.assertTrue(len(records[0]) < len(text) / 5)
+        self.assertEqual(records[1], transit.RAW + noise)
+        self.assertEqual(records[2], transit.RAW + b"short")
+        self.assertEqual([compressor.decompress(r) for r in records],
+                         [text, noise, b"short"])
+
+        send_box = SecretBox(owner._receiver_record_key())
+        wire = b"".join([
+            frame(send_box.encrypt(compressor.compress(record),
+                                   unhexlify("%048x" % i)))
+            for i, record in enumerate([text, b"ack"])])
+        c.dataReceived(wire)
+        self.assertEqual(inbound_records, [text, b"ack"])
+
+        stats = c.compression_stats()
+        self.assertEqual(stats["compression"], "zlib")
+        self.assertEqual(stats["sent_bytes"], len(text) + len(noise) + 5)
+        self.assertEqual(stats["sent_compressed_bytes"],
+                         sum([len(r) for r in records]))
+        self.assertTrue(stats["sent_ratio"] > 1.5)
+        self.assertEqual(stats["received_bytes"], len(text) + 3)
+        self.assertTrue(stats["received_ratio"] > 5)
+
+    def test_compression_crypto_threads(self):
+        runner = FakeRunner()
+        compressor = transit.RecordCompressor(transit.ZlibCodec, 100000)
+        t, c, owner = self.make_connection(compressor=compressor,
+                                           crypto=(runner, 4), framing=2)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        text = b"abc" * 10000
+        c.send_records([text, text])
+        runner.run_all(reverse=True)
+        rb = transit.RecordBuffer()
+        rb.feed(t.read_buf())
+        receive_box = SecretBox(owner._sender_record_key())
+        for i, encrypted in enumerate(rb.records):
+            payload = receive_box.decrypt(encrypted, transit.NONCE.pack(i))
+            self.assertEqual(compressor.decompress(payload), text)
+
+        send_box = SecretBox(owner._receiver_record_key())
+        c.dataReceived(frame(send_box.encrypt(
+            compressor.compress(text), transit.NONCE.pack(0)).ciphertext))
+        runner.run_all()
+        self.assertEqual(inbound_records, [text])
+
+    def test_compression_bomb(self):
+        compressor = transit.RecordCompressor(transit.ZlibCodec, 100000)
+        t, c, owner = self.make_connection(compressor=compressor)
+        send_box = SecretBox(owner._receiver_record_key())
+        bomb = transit.ZlibCodec.FLAG + zlib.compress(b"\x00" * 100001)
+        self.assertRaises(
+            transit.RecordTooLarge, c.dataReceived,
+            frame(send_box.encrypt(bomb, unhexlify("%048x" % 0))))
+        self.assertEqual(t._connected, False)
+
+    def test_xsalsa20poly1305(self):
+        self.check_cipher_suite(transit.XSalsa20Poly1305)
+
+    def test_xchacha20poly1305(self):
+        self.check_cipher_suite(transit.XChaCha20Poly1305)
+
+    def test_aes256gcm(self):
+        self.check_cipher_suite(transit.AES256GCM)
+
+    def test_nonce(self):
+        for n in [0, 1, 255, 256, 2**32 + 5, 2**64 - 1]:
+            self.assertEqual(transit.NONCE.pack(n), unhexlify("%048x" % n))
+
+    def test_send_records(self):
+        t, c, owner = self.make_connection()
+        writes = []
+        t.writeSequence = writes.append
+        c.send_records([b"r0", b"r1", b"", b"r3"])
+        self.assertEqual(len(writes), 1)  # a single write
+        self.assertEqual(
+            self.decrypt_records(owner, b"".join(writes[0])),
+            [b"r0", b"r1", b"", b"r3"])
+        c.send_record(b"r4")
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(
+            self.decrypt_records(owner, b"".join(writes[1]), 4), [b"r4"])
+        c.flush()  # nothing pending
+        self.assertEqual(len(writes), 2)
+
+    def test_coalesce_pull_producer(self):
+        t, c, owner = self.make_connection()
+        t = c.transport = PullTransport()
+        c.flush_threshold = 64 * 1024
+        chunk = basic.FileSender.CHUNK_SIZE
+        data = b"".join([
+            str(i % 10).encode("ascii") * chunk for i in range(10)]) + b"tail"
+        fs = basic.FileSender()
+        d = fs.beginFileTransfer(io.BytesIO(data), c)
+        # registering the producer pulled enough chunks to fill one write
+        self.assertEqual(len(t.writes), 1)
+        while t.producer:
+            t.producer.resumeProducing()
+        self.successResultOf(d)
+        # 11 records went out in 3 writes
+        self.assertEqual([len(w) // 2 for w in t.writes], [4, 4, 3])
+        records = self.decrypt_records(
+            owner, b"".join([b"".join(w) for w in t.writes]))
+        self.assertEqual(len(records), 11)
+        self.assertEqual(b"".join(records), data)
+
+    def test_coalesce_stalled_producer(self):
+        # if the producer runs dry without unregistering, whatever it did
+        # produce must still be written, or the transport would never ask
+        # for more
+        t, c, owner = self.make_connection()
+        t = c.transport = PullTransport()
+        p = ListProducer(c, [b"r0", b"r1", b"r2"])
+        c.registerProducer(p, False)
+        self.assertEqual(len(t.writes), 1)
+        self.assertEqual(
+            self.decrypt_records(owner, b"".join(t.writes[0])),
+            [b"r0", b"r1", b"r2"])
+        p.records.extend([b"r3", b"r4"])
+        p.resumeProducing()
+        self.assertEqual(len(t.writes), 2)
+        self.assertEqual(
+            self.decrypt_records(owner, b"".join(t.writes[1]), 3),
+            [b"r3", b"r4"])
+        c.send_record(b"r5")
+        c.unregisterProducer()
+        self.assertEqual(len(t.writes), 3)
+
+    def test_send_file(self):
+        t, c, owner = self.make_connection(record_size=100 * 1024)
+        t = c.transport = PullTransport()
+        data = os.urandom(1024 * 1024)
+        seen = []
+
+        def _transform(chunk):
+            seen.append(len(chunk))
+            return chunk
+
+        d = c.sendFile(io.BytesIO(data), _transform)
+        while t.producer:
+            t.producer.resumeProducing()
+        self.successResultOf(d)
+        records = self.decrypt_records(
+            owner, b"".join([b"".join(w) for w in t.writes]))
+        self.assertEqual(b"".join(records), data)
+        self.assertEqual([len(r) for r in records], seen)
+        self.assertTrue(max(seen) <= 100 * 1024)
+
+    def test_send_file_old_peer(self):
+        # without a negotiated size, stick to 16KiB records
+        t, c, owner = self.make_connection()
+        t = c.transport = PullTransport()
+        data = b"." * 6 * 16 * 1024
+        d = c.sendFile(io.BytesIO(data))
+        while t.producer:
+            t.producer.resumeProducing()
+        self.successResultOf(d)
+        records = self.decrypt_records(
+            owner, b"".join([b"".join(w) for w in t.writes]))
+        self.assertEqual(b"".join(records), data)
+        self.assertEqual(set([len(r) for r in records]), set([16 * 1024]))
+
+    def test_record_too_large(self):
+        t, c, owner = self.make_connection(record_size=100)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        ok = send_box.encrypt(b"." * 100, unhexlify("%048x" % 0))
+        c.dataReceived(frame(ok))
+        self.assertEqual(inbound_records, [b"." * 100])
+        # the length prefix alone is enough to reject it
+        big = send_box.encrypt(b"." * 101, unhexlify("%048x" % 1))
+        self.assertRaises(transit.RecordTooLarge, c.dataReceived,
+                          frame(big)[:4])
+        self.assertEqual(t._connected, False)
+
+    def test_crypto_threads_send(self):
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 4))
+        writes = []
+        t.writeSequence = writes.append
+        c.send_records([b"r0", b"r1", b"r2"])
+        self.assertEqual(writes, [])
+        self.assertEqual(len(runner.jobs), 3)
+        # the threads finish in the wrong order, but the records are written
+        # in the right order (and all together, once the last one is ready)
+        runner.run(2)
+        runner.run(0)
+        self.assertEqual(writes, [])
+        runner.run(0)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(
+            self.decrypt_records(owner, b"".join(writes[0])),
+            [b"r0", b"r1", b"r2"])
+
+    def test_crypto_threads_pull_producer(self):
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 3))
+        t = c.transport = PullTransport()
+        records = [b"r" + str(i).encode("ascii") for i in range(5)]
+        p = ListProducer(c, list(records))
+        # registering the producer pulls enough to keep every thread busy
+        c.registerProducer(p, False)
+        self.assertEqual(len(runner.jobs), 3)
+        runner.run_all(reverse=True)
+        self.assertEqual(len(t.writes), 1)
+        # the transport asks for more once that write has drained
+        p.resumeProducing()
+        self.assertEqual(len(runner.jobs), 2)
+        c.unregisterProducer()
+        runner.run_all()
+        self.assertEqual(
+            self.decrypt_records(
+                owner, b"".join([b"".join(w) for w in t.writes])), records)
+
+    def test_crypto_threads_close(self):
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 4))
+        c.send_record(b"last words")
+        c.close()
+        self.assertEqual(t._connected, True)
+        runner.run_all()
+        self.assertEqual(t._connected, False)
+        self.assertEqual(
+            self.decrypt_records(owner, t.read_buf()), [b"last words"])
+
+    def test_crypto_threads_receive(self):
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 2))
+        t = c.transport = proto_helpers.StringTransport()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        wire = b"".join([
+            frame(send_box.encrypt(b"r" + str(i).encode("ascii"),
+                                   unhexlify("%048x" % i)))
+            for i in range(3)])
+        c.dataReceived(wire)
+        self.assertEqual(len(runner.jobs), 3)
+        # too many records in flight: stop reading until they're done
+        self.assertEqual(t.producerState, "paused")
+        runner.run(1)
+        self.assertEqual(inbound_records, [])
+        runner.run(0)
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+        self.assertEqual(t.producerState, "producing")
+        # our consumer can still pause us, and we won't override it
+        c.pauseProducing()
+        c.dataReceived(
+            frame(send_box.encrypt(b"r3", unhexlify("%048x" % 3))))
+        runner.run_all()
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2", b"r3"])
+        self.assertEqual(t.producerState, "paused")
+        c.resumeProducing()
+        self.assertEqual(t.producerState, "producing")
+
+    def test_crypto_threads_lost(self):
+        # a record that's still being decrypted when the connection is lost
+        # (like the final ack) is delivered before reads start failing
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 4))
+        d1 = c.receive_record()
+        d2 = c.receive_record()
+        closed = c.when_closed()
+        send_box = SecretBox(owner._receiver_record_key())
+        c.dataReceived(
+            frame(send_box.encrypt(b"ack", unhexlify("%048x" % 0))))
+        c.connectionLost()
+        self.assertNoResult(d1)
+        self.assertNoResult(closed)
+        runner.run_all()
+        self.assertEqual(self.successResultOf(d1), b"ack")
+        self.failureResultOf(d2, error.ConnectionClosed)
+        self.assertEqual(self.successResultOf(closed), c)
+
+    def test_crypto_threads_bad_records(self):
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 4))
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        good = send_box.encrypt(b"good", unhexlify("%048x" % 0))
+        bad = self.corrupt(send_box.encrypt(b"bad", unhexlify("%048x" % 1)))
+        after = send_box.encrypt(b"after", unhexlify("%048x" % 2))
+        c.dataReceived(frame(good) + frame(bad) + frame(after))
+        runner.run_all(reverse=True)
+        # the corrupt record drops the connection, and nothing after it is
+        # delivered
+        self.assertEqual(inbound_records, [b"good"])
+        self.assertEqual(t._connected, False)
+
+    def test_crypto_threads_bad_nonce(self):
+        # nonces are still checked on the reactor thread, right away
+        runner = FakeRunner()
+        t, c, owner = self.make_connection(crypto=(runner, 4))
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(b"record", unhexlify("%048x" % 1))
+        self.assertRaises(transit.BadNonce, c.dataReceived, frame(encrypted))
+        self.assertEqual(runner.jobs, [])
+        self.assertEqual(t._connected, False)
+
     def corrupt(self, orig):
         last_byte = orig[-1:]
         num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1211,6 +2062,21 @@ class Connection(unittest.TestCase):
         c.close()
         self.failureResultOf(d5, error.ConnectionClosed)
 
+    def test_receive_lost(self):
+        # once the connection is gone, nobody waits forever for a record
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None)  # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"0")
+        self.assertEqual(self.successResultOf(c.receive_record()), b"0")
+        d1 = c.receive_record()
+        c.connectionLost()
+        self.failureResultOf(d1, error.ConnectionClosed)
+        self.failureResultOf(c.receive_record(), error.ConnectionClosed)
+        # and neither does a consumer that shows up afterwards
+        d2 = c.writeToFile(io.BytesIO(), 10)
+        self.failureResultOf(d2, error.ConnectionClosed)
+
     def test_producer(self):
         # a Transit object (receiving data from the remote peer) produces
         # data and writes it into a local Consumer
@@ -1343,6 +2209,47 @@ class Connection(unittest.TestCase):
         c.connectionLost()
         self.failureResultOf(d, error.ConnectionClosed)
 
+    def test_writeToFile_stream(self):
+        # with expected=None, an empty record marks the end
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None)  # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+
+        f = io.BytesIO()
+        hashee = []
+        d = c.writeToFile(f, None, hasher=hashee.append)
+        self.assertEqual(f.getvalue(), b"r1.")
+        c.recordReceived(b"r2.")
+        self.assertNoResult(d)
+        c.recordReceived(b"")
+        self.assertEqual(self.successResultOf(d), 6)
+        self.assertEqual(f.getvalue(), b"r1.r2.")
+        self.assertEqual(hashee, [b"r1.", b"r2."])
+        self.assertIs(c._consumer, None)
+        c.recordReceived(b"overflow")
+        self.assertEqual(f.getvalue(), b"r1.r2.")
+
+        # the end might already be queued
+        c.recordReceived(b"")
+        f = io.BytesIO()
+        d = c.writeToFile(f, None)
+        self.assertEqual(self.successResultOf(d), 8)
+        self.assertEqual(f.getvalue(), b"overflow")
+
+        d = c.writeToFile(f, None)
+        c.connectionLost()
+        self.failureResultOf(d, error.ConnectionClosed)
+
+        # and after the connection is gone, it fails right away
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None)  # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+        c.connectionLost()
+        d = c.writeToFile(io.BytesIO(), None)
+        self.failureResultOf(d, error.ConnectionClosed)
+
     def test_consumer(self):
         # a local producer sends data to a consuming Transit object
         c = transit.Connection(None, None, None, "description")
@@ -1361,6 +2268,235 @@ class Connection(unittest.TestCase):
         self.assertEqual(c.transport.producer, None)
 
 
+class RecordCompressor(unittest.TestCase):
+    def check_codec(self, codec):
+        if codec not in transit.available_codecs():
+            raise unittest.SkipTest("%s is not installed" % codec.name)
+        rc = transit.RecordCompressor(codec, 100000)
+        text = b"compress me " * 5000
+        compressed = rc.compress(text)
+        self.assertEqual(compressed[:1], codec.FLAG)
+        self.assertTrue(len(compressed) < len(text) / 10)
+        self.assertEqual(rc.decompress(compressed), text)
+        # a record that decompresses to more than max_length is rejected,
+        # before it is decompressed
+        big = codec.FLAG + codec.compress(b"\x00" * 100001)
+        self.assertRaises(transit.RecordTooLarge, rc.decompress, big)
+        self.assertEqual(len(rc.decompress(
+            codec.FLAG + codec.compress(b"\x00" * 100000))), 100000)
+
+    def test_zlib(self):
+        self.check_codec(transit.ZlibCodec)
+
+    def test_zstd(self):
+        self.check_codec(transit.ZstdCodec)
+
+    def test_lz4(self):
+        self.check_codec(transit.LZ4Codec)
+
+    def test_incompressible(self):
+        rc = transit.RecordCompressor(transit.ZlibCodec, 100000)
+        # a sample of the front tells us not to bother with the rest
+        noise = os.urandom(50000)
+        self.assertEqual(rc.compress(noise + b"\x00" * 50000),
+                         transit.RAW + noise + b"\x00" * 50000)
+        # small records aren't worth compressing
+        self.assertEqual(rc.compress(b"a" * 100), transit.RAW + b"a" * 100)
+        # nor is anything that compression would make bigger
+        noise = os.urandom(5000)
+        self.assertEqual(rc.compress(noise), transit.RAW + noise)
+        for record in [b"", b"a" * 100, noise]:
+            self.assertEqual(rc.decompress(rc.compress(record)), record)
+
+    def test_no_codec(self):
+        # we weren't asked to compress, but still add (and remove) flags
+        rc = transit.RecordCompressor(None, 100000)
+        text = b"compress me " * 5000
+        self.assertEqual(rc.compress(text), transit.RAW + text)
+        self.assertEqual(
+            rc.decompress(transit.ZlibCodec.FLAG + zlib.compress(text)), text)
+
+    def test_bad(self):
+        rc = transit.RecordCompressor(transit.ZlibCodec, 100000)
+        self.assertRaises(transit.BadCompression, rc.decompress, b"\x09abc")
+        self.assertRaises(transit.BadCompression, rc.decompress,
+                          transit.ZlibCodec.FLAG + b"not zlib")
+        truncated = zlib.compress(b"compress me " * 5000)[:-10]
+        self.assertRaises(transit.BadCompression, rc.decompress,
+                          transit.ZlibCodec.FLAG + truncated)
+
+
+class OrderedPipeline(unittest.TestCase):
+    def test_order(self):
+        runner = FakeRunner()
+        delivered = []
+        p = transit.OrderedPipeline(runner, delivered.append, None)
+        for i in range(4):
+            p.submit(lambda i: i * 10, i)
+        self.assertEqual(len(p), 4)
+        d = p.when_drained()
+        runner.run(3)  # job 3
+        runner.run(1)  # job 1
+        self.assertEqual(delivered, [])
+        runner.run(0)  # job 0
+        self.assertEqual(delivered, [0, 10])
+        self.assertEqual(len(p), 2)
+        self.assertNoResult(d)
+        runner.run(0)
+        self.assertEqual(delivered, [0, 10, 20, 30])
+        self.assertEqual(len(p), 0)
+        self.successResultOf(d)
+        self.successResultOf(p.when_drained())
+
+    def test_failure(self):
+        runner = FakeRunner()
+        delivered = []
+        failures = []
+        p = transit.OrderedPipeline(runner, delivered.append,
+                                    failures.append)
+
+        def _job(i):
+            if i == 1:
+                raise RandomError("boom")
+            return i
+
+        for i in range(4):
+            p.submit(_job, i)
+        runner.run_all(reverse=True)
+        self.assertEqual(delivered, [0])
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(RandomError)
+        # and later jobs are discarded too
+        p.submit(_job, 4)
+        runner.run_all()
+        self.assertEqual(delivered, [0])
+        self.assertEqual(len(failures), 1)
+
+
+class RecordSizer(unittest.TestCase):
+    def test_ramp_up(self):
+        clock = task.Clock()
+        rs = transit.RecordSizer(1024 * 1024, clock.seconds)
+        self.assertEqual(rs.size, 16 * 1024)
+        sizes = []
+        # each window moves more data than the last
+        for i in range(10):
+            rs.sent(0)
+            clock.advance(rs.WINDOW)
+            rs.sent(1000 * (i + 1))
+            sizes.append(rs.size)
+        self.assertEqual(sizes[:7], [32 * 1024, 64 * 1024, 128 * 1024,
+                                     256 * 1024, 512 * 1024, 1024 * 1024,
+                                     1024 * 1024])
+        # a small drop doesn't shrink the records
+        clock.advance(rs.WINDOW)
+        rs.sent(8000)
+        self.assertEqual(rs.size, 1024 * 1024)
+        # but a big one does
+        clock.advance(rs.WINDOW)
+        rs.sent(1000)
+        self.assertEqual(rs.size, 512 * 1024)
+        for i in range(20):
+            clock.advance(rs.WINDOW)
+            rs.sent(1)
+        self.assertEqual(rs.size, 16 * 1024)
+
+    def test_window(self):
+        clock = task.Clock()
+        rs = transit.RecordSizer(1024 * 1024, clock.seconds)
+        rs.sent(100)
+        clock.advance(rs.WINDOW / 2)
+        rs.sent(100)
+        self.assertEqual(rs.size, 16 * 1024)
+        clock.advance(rs.WINDOW / 2)
+        rs.sent(100)
+        self.assertEqual(rs.size, 32 * 1024)
+
+    def test_small_maximum(self):
+        clock = task.Clock()
+        rs = transit.RecordSizer(1000, clock.seconds)
+        self.assertEqual(rs.size, 1000)
+        for i in range(5):
+            clock.advance(rs.WINDOW)
+            rs.sent(1000 * (i + 1))
+        self.assertEqual(rs.size, 1000)
+
+    def test_no_maximum(self):
+        clock = task.Clock()
+        rs = transit.RecordSizer(None, clock.seconds)
+        for i in range(5):
+            clock.advance(rs.WINDOW)
+            rs.sent(1000 * (i + 1))
+        self.assertEqual(rs.size, 16 * 1024)
+
+
+def frame(record):
+    return unhexlify("%08x" % len(record)) + record
+
+
+class RecordBuffer(unittest.TestCase):
+    def test_one_per_read(self):
+        rb = transit.RecordBuffer()
+        r1 = frame(b"record1")
+        rb.feed(r1)
+        self.assertEqual(list(rb.records), [b"record1"])
+        self.assertEqual(rb.buffered(), 0)
+        self.assertEqual(rb.bytes_copied, len(b"record1"))
+
+    def test_coalesced(self):
+        rb = transit.RecordBuffer()
+        records = [(b"r" + str(i).encode("ascii")) * (i + 1)
+                   for i in range(10)]
+        rb.feed(b"".join([frame(r) for r in records]))
+        self.assertEqual(list(rb.records), records)
+        self.assertEqual(rb.buffered(), 0)
+        # each byte is copied exactly once, no matter how many records
+        # shared the read
+        self.assertEqual(rb.bytes_copied, sum([len(r) for r in records]))
+
+    def test_fragmented(self):
+        rb = transit.RecordBuffer()
+        records = [b"first record", b"", b"second record" * 50, b"third"]
+        data = b"".join([frame(r) for r in records])
+        for i in range(len(data)):
+            rb.feed(data[i:i + 1])
+        self.assertEqual(list(rb.records), records)
+        self.assertEqual(rb.buffered(), 0)
+        self.assertEqual(rb.bytes_copied, sum([len(r) for r in records]))
+
+    def test_split_everywhere(self):
+        records = [b"one", b"two two", b"", b"three three three"]
+        data = b"".join([frame(r) for r in records])
+        for split in range(len(data) + 1):
+            rb = transit.RecordBuffer()
+            rb.feed(data[:split])
+            rb.feed(data[split:])
+            self.assertEqual(list(rb.records), records)
+            self.assertEqual(rb.buffered(), 0)
+
+    def test_partial(self):
+        rb = transit.RecordBuffer()
+        data = frame(b"record")
+        rb.feed(data[:2])
+        self.assertEqual(rb.buffered(), 2)
+        rb.feed(data[2:7])
+        self.assertEqual(rb.buffered(), 3)
+        self.assertEqual(list(rb.records), [])
+        rb.feed(data[7:] + frame(b"next")[:6])
+        self.assertEqual(list(rb.records), [b"record"])
+        # the length prefix has been parsed, so only the body counts
+        self.assertEqual(rb.buffered(), 2)
+
+    def test_whole_read_not_copied(self):
+        rb = transit.RecordBuffer()
+        record = b"exactly one record"
+        rb.feed(frame(record)[:4])
+        rb.feed(record)
+        self.assertEqual(list(rb.records), [record])
+        self.assertIs(rb.records[0], record)
+        self.assertEqual(rb.bytes_copied, 0)
+
+
 class FileConsumer(unittest.TestCase):
     def test_basic(self):
         f = io.BytesIO()
@@ -1393,6 +2529,378 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(hashee, [b"." * 99, b"!"])
 
 
+class FileSender(unittest.TestCase):
+    def test_lost(self):
+        fs = transit.FileSender(transit.RecordSizer(None))
+        consumer = proto_helpers.StringTransport()
+        d = fs.beginFileTransfer(io.BytesIO(b"data"), consumer)
+        # the transport does this when the connection is lost
+        fs.stopProducing()
+        self.failureResultOf(d, transit.TransitClosed)
+
+
+class ThreadedFileSender(unittest.TestCase):
+    def test_send(self):
+        runner = FakeRunner()
+        fs = transit.ThreadedFileSender(runner, transit.RecordSizer(None))
+        consumer = proto_helpers.StringTransport()
+        data = b"." * (3 * 16 * 1024 + 10)
+        seen = []
+
+        def _transform(chunk):
+            seen.append(len(chunk))
+            return chunk
+
+        d = fs.beginFileTransfer(io.BytesIO(data), consumer, _transform)
+        self.assertIs(consumer.producer, fs)
+        self.assertTrue(consumer.streaming)
+        # one read at a time
+        self.assertEqual(len(runner.jobs), 1)
+        runner.run(0)
+        self.assertEqual(consumer.value(), data[:16 * 1024])
+        self.assertEqual(len(runner.jobs), 1)
+        # and none start while we're paused
+        fs.pauseProducing()
+        runner.run(0)
+        self.assertEqual(runner.jobs, [])
+        fs.resumeProducing()
+        self.assertEqual(len(runner.jobs), 1)
+        runner.run_all()
+        self.successResultOf(d)
+        self.assertEqual(consumer.value(), data)
+        self.assertEqual(seen, [16 * 1024] * 3 + [10])
+        self.assertIs(consumer.producer, None)
+
+    def test_lost(self):
+        runner = FakeRunner()
+        fs = transit.ThreadedFileSender(runner, transit.RecordSizer(None))
+        consumer = proto_helpers.StringTransport()
+        d = fs.beginFileTransfer(io.BytesIO(b"data"), consumer)
+        fs.stopProducing()
+        self.failureResultOf(d, transit.TransitClosed)
+        # the read that was underway is ignored
+        runner.run_all()
+        self.assertEqual(consumer.value(), b"")
+
+    def test_read_error(self):
+        class BadFile(object):
+            def read(self, size):
+                raise IOError("nope")
+
+        runner = FakeRunner()
+        fs = transit.ThreadedFileSender(runner, transit.RecordSizer(None))
+        consumer = proto_helpers.StringTransport()
+        d = fs.beginFileTransfer(BadFile(), consumer)
+        runner.run_all()
+        self.failureResultOf(d, IOError)
+        self.assertIs(consumer.producer, None)
+
+
+class ThreadedFileConsumer(unittest.TestCase):
+    def test_write(self):
+        runner = FakeRunner()
+        f = io.BytesIO()
+        progress = []
+        hashee = []
+        fc = transit.ThreadedFileConsumer(
+            runner, f, progress.append, hasher=hashee.append, depth=2)
+        producer = proto_helpers.StringTransport()
+        fc.registerProducer(producer, True)
+        self.successResultOf(fc.when_flushed())
+
+        fc.write(b"r1.")
+        # hashed right away, written later
+        self.assertEqual(hashee, [b"r1."])
+        self.assertEqual(f.getvalue(), b"")
+        d = fc.when_flushed()
+        self.assertNoResult(d)
+        fc.write(b"r2.")
+        fc.write(b"r3.")
+        self.assertEqual(producer.producerState, "producing")
+        # more than 'depth' waiting pauses the producer
+        fc.write(b"r4.")
+        self.assertEqual(producer.producerState, "paused")
+        self.assertEqual(len(runner.jobs), 1)  # one write at a time
+        runner.run(0)
+        self.assertEqual(f.getvalue(), b"r1.")
+        self.assertEqual(progress, [3])
+        self.assertEqual(producer.producerState, "paused")
+        runner.run(0)
+        self.assertEqual(producer.producerState, "producing")
+        runner.run_all()
+        self.assertEqual(f.getvalue(), b"r1.r2.r3.r4.")
+        self.assertEqual(progress, [3, 3, 3, 3])
+        self.assertEqual(hashee, [b"r1.", b"r2.", b"r3.", b"r4."])
+        self.successResultOf(d)
+
+    def test_unregister_while_paused(self):
+        runner = FakeRunner()
+        fc = transit.ThreadedFileConsumer(runner, io.BytesIO(), depth=0)
+        producer = proto_helpers.StringTransport()
+        fc.registerProducer(producer, True)
+        fc.write(b"r1.")
+        fc.write(b"r2.")
+        self.assertEqual(producer.producerState, "paused")
+        # the connection is still needed after the end of the stream
+        fc.unregisterProducer()
+        self.assertEqual(producer.producerState, "producing")
+        runner.run_all()
+        self.successResultOf(fc.when_flushed())
+
+    def test_write_error(self):
+        class BadFile(object):
+            def write(self, data):
+                raise IOError("broken pipe")
+
+        runner = FakeRunner()
+        fc = transit.ThreadedFileConsumer(runner, BadFile())
+        producer = proto_helpers.StringTransport()
+        fc.registerProducer(producer, True)
+        fc.write(b"r1.")
+        fc.write(b"r2.")
+        d = fc.when_flushed()
+        runner.run(0)
+        self.failureResultOf(d, IOError)
+        self.assertEqual(producer.producerState, "stopped")
+        self.assertEqual(runner.jobs, [])
+        # anything more is ignored
+        fc.write(b"r3.")
+        self.assertEqual(runner.jobs, [])
+        self.failureResultOf(fc.when_flushed(), IOError)
+
+
+class FakeStripe(object):
+    # enough of a Connection for StripedFileSender and StripedFileConsumer
+    def __init__(self, record_size=None):
+        self.owner = MockOwner()
+        self.owner._record_size = record_size
+        self.producer = None
+        self.consumer = None
+        self.records = []
+        self.closed = False
+        self._close_d = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        assert not streaming
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, record):
+        self.records.append(record)
+
+    def connectConsumer(self, consumer):
+        consumer.registerProducer(self, True)
+        self.consumer = consumer
+
+    def disconnectConsumer(self):
+        self.consumer.unregisterProducer()
+        self.consumer = None
+
+    def when_closed(self):
+        return self._close_d
+
+    def close(self):
+        self.closed = True
+
+
+class StripedFile(unittest.TestCase):
+    def test_send(self):
+        data = os.urandom(100 * 1000)
+        seen = []
+
+        def transform(chunk):
+            seen.append(chunk)
+            return chunk
+
+        sender = transit.StripedFileSender(io.BytesIO(data), transform)
+        d = sender.when_done()
+        s1 = FakeStripe(record_size=10000)
+        s2 = FakeStripe(record_size=10000)
+        sender.add_stripe(s1)
+        sender.add_stripe(s2)
+        # the stripes take turns, each asking for more when it's ready
+        while s1.producer or s2.producer:
+            for s in [s1, s2, s2]:
+                if s.producer:
+                    s.producer.resumeProducing()
+        self.assertEqual(self.successResultOf(d), None)
+        # the file was read in order, so a hasher would see it in order
+        self.assertEqual(b"".join(seen), data)
+        self.assertTrue(s1.records)
+        self.assertTrue(len(s2.records) > len(s1.records))
+        got = {}
+        for record in s1.records + s2.records:
+            self.assertTrue(len(record) <= 10000)
+            (offset, ) = transit.OFFSET.unpack(record[:8])
+            got[offset] = record[8:]
+        self.assertEqual(b"".join(got[o] for o in sorted(got)), data)
+
+        # a stripe that shows up too late isn't used, but is still closed
+        s3 = FakeStripe()
+        sender.add_stripe(s3)
+        self.assertIs(s3.producer, None)
+        sender.close()
+        self.assertEqual([s.closed for s in [s1, s2, s3]], [True] * 3)
+
+    def test_send_lost(self):
+        sender = transit.StripedFileSender(io.BytesIO(b"data"))
+        d = sender.when_done()
+        s1 = FakeStripe()
+        sender.add_stripe(s1)
+        s1.producer.stopProducing()
+        self.failureResultOf(d, transit.TransitClosed)
+
+    def test_send_stream(self):
+        # the end of a stream is marked with an empty record
+        data = os.urandom(1000)
+        sender = transit.StripedFileSender(io.BytesIO(data), stream=True)
+        d = sender.when_done()
+        s1 = FakeStripe(record_size=408)
+        sender.add_stripe(s1)
+        while s1.producer:
+            s1.producer.resumeProducing()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(s1.records[-1], transit.OFFSET.pack(1000))
+        self.assertEqual(b"".join(r[8:] for r in s1.records), data)
+
+    def test_send_resumed(self):
+        # a resumed transfer starts wherever the file is positioned
+        data = os.urandom(1000)
+        f = io.BytesIO(data)
+        f.seek(600)
+        sender = transit.StripedFileSender(f)
+        d = sender.when_done()
+        s1 = FakeStripe()
+        sender.add_stripe(s1)
+        while s1.producer:
+            s1.producer.resumeProducing()
+        self.assertEqual(self.successResultOf(d), None)
+        got = {}
+        for record in s1.records:
+            (offset, ) = transit.OFFSET.unpack(record[:8])
+            got[offset] = record[8:]
+        self.assertEqual(min(got), 600)
+        self.assertEqual(b"".join(got[o] for o in sorted(got)), data[600:])
+
+    def test_receive(self):
+        data = os.urandom(1000)
+        f = io.BytesIO()
+        progress = []
+        hasher = []
+        consumer = transit.StripedFileConsumer(f, len(data), progress.append,
+                                               hasher.append)
+        d = consumer.when_done()
+        s1 = FakeStripe()
+        s2 = FakeStripe()
+        consumer.add_stripe(s1)
+        consumer.add_stripe(s2)
+
+        def send(stripe, start, end):
+            stripe.consumer.write(transit.OFFSET.pack(start) +
+                                  data[start:end])
+
+        send(s2, 500, 800)
+        send(s2, 300, 500)
+        self.assertEqual(hasher, [])
+        send(s1, 0, 300)
+        # the hasher sees it all in order
+        self.assertEqual(b"".join(hasher), data[:800])
+        self.assertNoResult(d)
+        send(s1, 800, 1000)
+        self.assertEqual(self.successResultOf(d), 1000)
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual(b"".join(hasher), data)
+        self.assertEqual(sum(progress), 1000)
+        self.assertIs(s1.consumer, None)
+        self.assertIs(s2.consumer, None)
+        # losing a stripe now doesn't matter
+        s1._close_d.callback(s1)
+        consumer.close()
+        self.assertTrue(s1.closed and s2.closed)
+
+    def test_receive_empty(self):
+        consumer = transit.StripedFileConsumer(io.BytesIO(), 0)
+        s1 = FakeStripe()
+        consumer.add_stripe(s1)
+        self.assertEqual(self.successResultOf(consumer.when_done()), 0)
+        self.assertIs(s1.consumer, None)
+
+    def test_receive_lost(self):
+        consumer = transit.StripedFileConsumer(io.BytesIO(), 10)
+        d = consumer.when_done()
+        s1 = FakeStripe()
+        s2 = FakeStripe()
+        consumer.add_stripe(s1)
+        consumer.add_stripe(s2)
+        s1.consumer.write(transit.OFFSET.pack(0) + b"abc")
+        s2.consumer.write(transit.OFFSET.pack(6) + b"gh")
+        s2._close_d.callback(s2)
+        self.failureResultOf(d, error.ConnectionClosed)
+        self.assertIs(s1.consumer, None)
+        # only the data before the gap can be kept
+        self.assertEqual(consumer.get_offset(), 3)
+
+    def test_receive_stream(self):
+        data = os.urandom(1000)
+        f = io.BytesIO()
+        hasher = []
+        consumer = transit.StripedFileConsumer(f, None, hasher=hasher.append)
+        d = consumer.when_done()
+        s1 = FakeStripe()
+        s2 = FakeStripe()
+        consumer.add_stripe(s1)
+        consumer.add_stripe(s2)
+        # the end can arrive before the data in front of it
+        s2.consumer.write(transit.OFFSET.pack(600) + data[600:])
+        s2.consumer.write(transit.OFFSET.pack(1000))
+        self.assertNoResult(d)
+        s1.consumer.write(transit.OFFSET.pack(0) + data[:600])
+        self.assertEqual(self.successResultOf(d), 1000)
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual(b"".join(hasher), data)
+
+    def test_receive_stream_bad_end(self):
+        for records in [[(0, b"abcdef"), (3, b"")],  # data after the end
+                        [(4, b""), (4, b"")],  # two ends
+                        [(4, b""), (4, b"ef")]]:
+            consumer = transit.StripedFileConsumer(io.BytesIO(), None)
+            d = consumer.when_done()
+            s1 = FakeStripe()
+            consumer.add_stripe(s1)
+            for (offset, data) in records:
+                if s1.consumer:
+                    s1.consumer.write(transit.OFFSET.pack(offset) + data)
+            self.failureResultOf(d, transit.TransitError)
+
+    def test_receive_resumed(self):
+        data = os.urandom(1000)
+        f = io.BytesIO(data[:600])
+        hasher = []
+        consumer = transit.StripedFileConsumer(f, 400, hasher=hasher.append,
+                                               offset=600)
+        d = consumer.when_done()
+        s1 = FakeStripe()
+        consumer.add_stripe(s1)
+        self.assertEqual(consumer.get_offset(), 600)
+        s1.consumer.write(transit.OFFSET.pack(800) + data[800:])
+        s1.consumer.write(transit.OFFSET.pack(600) + data[600:800])
+        self.assertEqual(self.successResultOf(d), 400)
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual(b"".join(hasher), data[600:])
+        self.assertEqual(consumer.get_offset(), 1000)
+
+    def test_receive_bad(self):
+        for record in [b"short", transit.OFFSET.pack(8) + b"abc"]:
+            consumer = transit.StripedFileConsumer(io.BytesIO(), 10)
+            d = consumer.when_done()
+            s1 = FakeStripe()
+            consumer.add_stripe(s1)
+            s1.consumer.write(record)
+            self.failureResultOf(d, transit.TransitError)
+
+
 DIRECT_HINT_JSON = {
     "type": "direct-tcp-v1",
     "hostname": "direct",
@@ -1437,7 +2945,8 @@ class Transit(unittest.TestCase):
         self._waiters = []
         self._descriptions = []
 
-    def _start_connector(self, ep, description, is_relay=False):
+    def _start_connector(self, ep, description, is_relay=False,
+                         relay_stripe=0):
         d = defer.Deferred()
         self._connectors.append(ep)
         self._waiters.append(d)
@@ -1721,6 +3230,118 @@ class Full(ServerBase, unittest.TestCase):
         yield x.close()
         yield y.close()
 
+    @inlineCallbacks
+    def test_direct_crypto_threads(self):
+        KEY = b"k" * 32
+        # (with every record format we have)
+        options = dict(crypto_threads=2, cipher_suites=True, framing_v2=True,
+                       compress=True)
+        s = transit.TransitSender(None, **options)
+        r = transit.TransitReceiver(None, **options)
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        for c in [s, r]:
+            self.addCleanup(c._crypto_pool.stop)
+            self.addCleanup(reactor.removeSystemEventTrigger,
+                            c._crypto_pool_trigger)
+
+        records = [os.urandom(1000) for i in range(20)]
+        ds = [y.receive_record() for i in range(20)]
+        x.send_records(records)
+        got = yield gatherResults(ds, True)
+        self.assertEqual(got, records)
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_direct_stripes(self):
+        KEY = b"k" * 32
+        s = transit.TransitSender(None, stripes=3)
+        r = transit.TransitReceiver(None, stripes=transit.Common.MAX_STRIPES)
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertEqual((x.stripe, y.stripe), (0, 0))
+        self.addCleanup(s.stop_striping)
+        self.addCleanup(r.stop_striping)
+
+        data = os.urandom(1000 * 1000)
+        sender = transit.StripedFileSender(io.BytesIO(data))
+        sender.add_stripe(x)
+        s.observe_stripes(sender.add_stripe)
+        f = io.BytesIO()
+        consumer = transit.StripedFileConsumer(f, len(data))
+        consumer.add_stripe(y)
+        r.observe_stripes(consumer.add_stripe)
+        received = yield consumer.when_done()
+        self.assertEqual(received, len(data))
+        self.assertEqual(f.getvalue(), data)
+        yield sender.when_done()
+
+        self.assertTrue(len(sender.stripes) <= 3)
+        self.assertEqual(sorted(p.stripe for p in sender.stripes),
+                         list(range(len(sender.stripes))))
+        sender.close()
+        consumer.close()
+
+    @inlineCallbacks
+    def test_relay_stripes(self):
+        KEY = b"k" * 32
+        s = transit.TransitSender(self.transit, no_listen=True, stripes=2)
+        r = transit.TransitReceiver(self.transit, no_listen=True, stripes=2)
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        self.addCleanup(s.stop_striping)
+        self.addCleanup(r.stop_striping)
+        stripes = []
+        r.observe_stripes(stripes.append)
+        s.observe_stripes(stripes.append)
+        # the relay pairs up both connections from each side
+        while len(stripes) < 2:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        (y1, x1) = sorted(stripes, key=lambda p: p.owner is s)
+        self.assertEqual((x1.stripe, y1.stripe), (1, 1))
+
+        d = y1.receive_record()
+        x1.send_record(b"record1")
+        self.assertEqual((yield d), b"record1")
+
+        for c in [x, y, x1, y1]:
+            yield c.close()
+
     @inlineCallbacks
     def test_relay(self):
         KEY = b"k" * 32
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import hashlib
+import io
+import os
 import unicodedata
 
 import six
@@ -46,6 +49,112 @@ class Utils(unittest.TestCase):
         self.assertIsInstance(d, dict)
         self.assertEqual(d, {"a": "b", "c": 2})
 
+    def test_hash_file_prefix(self):
+        data = b"0123456789" * 100
+        f = io.BytesIO(data)
+        f.seek(500)
+        hasher = hashlib.sha256()
+        self.assertEqual(util.hash_file_prefix(f, 700, hasher, 64), 700)
+        self.assertEqual(hasher.digest(), hashlib.sha256(data[:700]).digest())
+        self.assertEqual(f.tell(), 700)
+
+        # a short file hashes what it has
+        hasher = hashlib.sha256()
+        self.assertEqual(util.hash_file_prefix(f, 2000, hasher), 1000)
+        self.assertEqual(hasher.digest(), hashlib.sha256(data).digest())
+
+        # progress is told about each piece
+        pieces = []
+        util.hash_file_prefix(f, 300, hashlib.sha256(), 128,
+                              progress=pieces.append)
+        self.assertEqual(pieces, [128, 128, 44])
+
+    def test_hash_algorithms(self):
+        available = util.available_hash_algorithms()
+        self.assertIn("sha256", available)
+        self.assertEqual(len(set(available)), len(available))
+        self.assertEqual(set(available) - set(util.HASH_ALGORITHMS), set())
+        if "blake3" in available:
+            self.assertEqual(available[0], "blake3")
+        self.assertEqual(util.choose_hash_algorithm(["nope", "sha256"]),
+                         "sha256")
+        self.assertEqual(util.choose_hash_algorithm(["nope"]), None)
+        self.assertEqual(util.choose_hash_algorithm([]), None)
+        for name in available:
+            h = util.new_hasher(name)
+            h.update(b"data")
+            self.assertEqual(len(h.digest()), 64 if name == "blake2b" else 32)
+        self.assertEqual(util.new_hasher("sha256").digest(),
+                         hashlib.sha256().digest())
+        self.assertRaises(ValueError, util.new_hasher, "nope")
+        self.assertRaises(ValueError, util.new_hasher, "md5")
+
+    def test_hash_algorithm_order(self):
+        self.addCleanup(setattr, util, "_available_hashes", None)
+        if not hasattr(hashlib, "blake2b"):
+            raise unittest.SkipTest("this python has no blake2b")
+        # the order is fixed, whatever is fastest here
+        with mock.patch("wormhole.util.blake3", None):
+            util._available_hashes = None
+            self.assertEqual(util.available_hash_algorithms(),
+                             ["blake2b", "sha256"])
+        with mock.patch("wormhole.util.blake3", mock.Mock()):
+            util._available_hashes = None
+            self.assertEqual(util.available_hash_algorithms(),
+                             ["blake3", "blake2b", "sha256"])
+
+    def test_threaded_hasher(self):
+        h = util.ThreadedHasher(hashlib.sha256(), backlog=2)
+        data = [os.urandom(5000) for i in range(10)]
+        for d in data[:5]:
+            h.update(d)
+        self.assertEqual(h.digest(),
+                         hashlib.sha256(b"".join(data[:5])).digest())
+        for d in data[5:]:
+            h.update(d)
+        h.close()
+        expected = hashlib.sha256(b"".join(data)).digest()
+        self.assertEqual(h.digest(), expected)
+        h.close()  # harmless
+        # and an empty one
+        h = util.ThreadedHasher(hashlib.sha256())
+        self.assertEqual(h.digest(), hashlib.sha256().digest())
+        h.close()
+
+    def test_worker_pool(self):
+        for jobs in (1, 3):
+            pool = util.WorkerPool(jobs)
+            tasks = [pool.submit(pow, i, 2) for i in range(10)]
+            bad = pool.submit(int, "nope")
+            self.assertEqual([t.result() for t in tasks],
+                             [i * i for i in range(10)])
+            # a task's error is raised by its result()
+            self.assertRaises(ValueError, bad.result)
+            pool.close()
+            pool.close()  # harmless
+
+    def test_spool_file(self):
+        spool_dir = self.mktemp()
+        os.mkdir(spool_dir)
+        with util.SpoolFile(1000, spool_dir) as f:
+            self.assertTrue(f.seekable())
+            f.write(b"a" * 600)
+            f.seek(0)
+            f.write(b"b" * 100)
+            self.assertEqual(f.peak_memory, 600)
+            self.assertFalse(f.rolled)
+            f.seek(0, 2)
+            f.write(b"c" * 600)
+            # that took it over the limit, so it's on disk now
+            self.assertEqual(f.peak_memory, 1200)
+            self.assertTrue(f.rolled)
+            f.write(b"d" * 5000)
+            self.assertEqual(f.peak_memory, 1200)
+            f.seek(0)
+            self.assertEqual(
+                f.read(),
+                b"b" * 100 + b"a" * 500 + b"c" * 600 + b"d" * 5000)
+
 
 class Space(unittest.TestCase):
     def test_free_space(self):
@@ -4,20 +4,25 @@ from __future__ import absolute_import, print_function
 import os
 import re
 import socket
+import struct
 import sys
 import time
-from binascii import hexlify, unhexlify
+import zlib
+from binascii import hexlify
 from collections import deque, namedtuple
 
 import six
 from hkdf import Hkdf
+from nacl import bindings
+from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
 from twisted.internet import (address, defer, endpoints, error, interfaces,
-                              protocol, reactor, task)
+                              protocol, reactor, task, threads)
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.protocols import policies
-from twisted.python import log
+from twisted.protocols import basic, policies
+from twisted.python import failure, log
 from twisted.python.runtime import platformType
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implementer
 
 from . import ipaddrs
@@ -25,6 +30,15 @@ from .errors import InternalError
 from .timing import DebugTiming
 from .util import bytes_to_hexstr
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 
 def HKDF(skm, outlen, salt=None, CTXinfo=b""):
     return Hkdf(salt, skm).expand(CTXinfo, outlen)
@@ -46,6 +60,14 @@ class BadNonce(TransitError):
     pass
 
 
+class RecordTooLarge(TransitError):
+    pass
+
+
+class BadCompression(TransitError):
+    pass
+
+
 # The beginning of each TCP connection consists of the following handshake
 # messages. The sender transmits the same text regardless of whether it is on
 # the initiating/connecting end of the TCP connection, or on the
@@ -77,6 +99,15 @@ class BadNonce(TransitError):
 # "go\n" or "nevermind\n"+close().
 
 
+def _stripe_info(info, stripe):
+    # Every stripe of a striped transfer counts its nonces from zero, so
+    # each one needs its own keys (and, at the relay, its own token). Stripe
+    # 0 uses the same ones as an unstriped connection.
+    if stripe:
+        return info + b"-stripe-" + str(stripe).encode("ascii")
+    return info
+
+
 def build_receiver_handshake(key):
     hexid = HKDF(key, 32, CTXinfo=b"transit_receiver")
     return b"transit receiver " + hexlify(hexid) + b" ready\n\n"
@@ -87,10 +118,10 @@ def build_sender_handshake(key):
     return b"transit sender " + hexlify(hexid) + b" ready\n\n"
 
 
-def build_sided_relay_handshake(key, side):
+def build_sided_relay_handshake(key, side, stripe=0):
     assert isinstance(side, type(u""))
     assert len(side) == 8 * 2
-    token = HKDF(key, 32, CTXinfo=b"transit_relay_token")
+    token = HKDF(key, 32, CTXinfo=_stripe_info(b"transit_relay_token", stripe))
     return b"please relay " + hexlify(token) + b" for side " + side.encode(
         "ascii") + b"\n"
 
@@ -164,12 +195,426 @@ def parse_hint_argv(hint, stderr=sys.stderr):
 
 TIMEOUT = 60  # seconds
 
+# Records written by a pull producer (like t.p.basic.FileSender, which
+# produces 16KiB chunks) are held back and handed to the transport together,
+# once this many bytes have accumulated, or the producer is unregistered.
+FLUSH_THRESHOLD = 256 * 1024
+
+# The nonce is a 24-byte big-endian integer: the record counter
+NONCE = struct.Struct(">16xQ")
+
+# Cipher suites. Each one encrypts a record under a 32-byte key (from
+# Common._sender_record_key/_receiver_record_key) and lays it out on the
+# wire the same way: the nonce (the record counter, packed with NONCE), then
+# the ciphertext and its MAC. With framing-v2, the nonce is left out, and
+# seal()/open() are used instead of encrypt()/decrypt(). Peers that predate
+# cipher-suites-v1 only know XSalsa20Poly1305.
+
+
+def _binding(name):
+    f = getattr(bindings, name, None)
+    return f and staticmethod(f)
+
+
+class XSalsa20Poly1305(object):
+    name = u"xsalsa20poly1305"
+    NONCE = NONCE
+    MACBYTES = SecretBox.MACBYTES
+    OVERHEAD = NONCE.size + MACBYTES
+    _seal = _binding("crypto_secretbox_easy")
+
+    def __init__(self, key):
+        self._key = key
+        self._box = SecretBox(key)
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encrypt(self, record, nonce):
+        return self._box.encrypt(record, nonce)
+
+    def decrypt(self, encrypted):
+        return self._box.decrypt(encrypted)
+
+    def seal(self, record, nonce):
+        if self._seal is None:  # older PyNaCl
+            return self._box.encrypt(record, nonce).ciphertext
+        return self._seal(record, nonce, self._key)
+
+    def open(self, ciphertext, nonce):
+        return self._box.decrypt(ciphertext, nonce)
+
+
+class _AEAD(object):
+    # one of libsodium's crypto_aead_* constructions, used without any
+    # additional data
+    _encrypt = _decrypt = None
+
+    def __init__(self, key):
+        self._key = key
+
+    @classmethod
+    def available(cls):
+        # older PyNaCl doesn't have every binding, and AES-256-GCM needs
+        # hardware support, which libsodium only checks when it's used
+        if cls._encrypt is None:
+            return False
+        try:
+            suite = cls(b"\x00" * 32)
+            encrypted = suite.encrypt(b"test", cls.NONCE.pack(0))
+            return suite.decrypt(encrypted) == b"test"
+        except Exception:
+            return False
+
+    def encrypt(self, record, nonce):
+        return nonce + self.seal(record, nonce)
+
+    def decrypt(self, encrypted):
+        size = self.NONCE.size
+        return self.open(encrypted[size:], encrypted[:size])
+
+    def seal(self, record, nonce):
+        return self._encrypt(record, None, nonce, self._key)
+
+    def open(self, ciphertext, nonce):
+        return self._decrypt(ciphertext, None, nonce, self._key)
+
+
+class XChaCha20Poly1305(_AEAD):
+    name = u"xchacha20poly1305"
+    NONCE = NONCE
+    MACBYTES = 16
+    OVERHEAD = NONCE.size + MACBYTES
+    _encrypt = _binding("crypto_aead_xchacha20poly1305_ietf_encrypt")
+    _decrypt = _binding("crypto_aead_xchacha20poly1305_ietf_decrypt")
+
+
+class AES256GCM(_AEAD):
+    name = u"aes256gcm"
+    NONCE = struct.Struct(">4xQ")  # only 12 bytes
+    MACBYTES = 16
+    OVERHEAD = NONCE.size + MACBYTES
+    _encrypt = _binding("crypto_aead_aes256gcm_encrypt")
+    _decrypt = _binding("crypto_aead_aes256gcm_decrypt")
+
+
+# fastest first (with AES-NI, AES-256-GCM is several times faster than the
+# others), and each peer prefers them in this order
+CIPHER_SUITES = [AES256GCM, XChaCha20Poly1305, XSalsa20Poly1305]
+
+_available_suites = None
+
+
+def available_cipher_suites():
+    global _available_suites
+    if _available_suites is None:
+        _available_suites = [c for c in CIPHER_SUITES if c.available()]
+    return _available_suites
+
+
+# Record compression. If both sides list compression-v1, every record
+# starts (before encryption) with a flag byte, which says how the rest of it
+# was compressed: RAW means not at all. Each side lists the algorithms it
+# can decompress, and only compresses (if it was asked to) with one of
+# those.
+
+RAW = b"\x00"
+
+
+class ZlibCodec(object):
+    name = u"zlib"
+    FLAG = b"\x01"
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(data, 1)  # most of the benefit, fastest
+
+    @staticmethod
+    def decompress(data, max_length):
+        d = zlib.decompressobj()
+        out = d.decompress(data, max_length)
+        if d.unconsumed_tail:
+            raise RecordTooLarge("record decompresses to more than %d bytes" %
+                                 max_length)
+        if not d.eof:
+            raise BadCompression("truncated zlib record")
+        return out
+
+
+class ZstdCodec(object):
+    name = u"zstd"
+    FLAG = b"\x02"
+
+    @staticmethod
+    def compress(data):
+        # (de)compressor objects can't be shared between threads
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    @staticmethod
+    def decompress(data, max_length):
+        if zstandard.frame_content_size(data) > max_length:
+            raise RecordTooLarge("record decompresses to more than %d bytes" %
+                                 max_length)
+        return zstandard.ZstdDecompressor().decompress(
+            data, max_output_size=max_length)
+
+
+class LZ4Codec(object):
+    name = u"lz4"
+    FLAG = b"\x03"
+    SIZE = struct.Struct("<L")  # lz4.block puts this in front
+
+    @staticmethod
+    def compress(data):
+        return lz4.block.compress(data)
+
+    @classmethod
+    def decompress(cls, data, max_length):
+        if len(data) < 4 or cls.SIZE.unpack_from(data)[0] > max_length:
+            raise RecordTooLarge("record decompresses to more than %d bytes" %
+                                 max_length)
+        return lz4.block.decompress(data)
+
+
+# in order of preference, for the side that compresses
+CODECS = [ZstdCodec, LZ4Codec, ZlibCodec]
+
+
+def available_codecs():
+    return [c for c in CODECS
+            if not ((c is ZstdCodec and zstandard is None) or
+                    (c is LZ4Codec and lz4 is None))]
+
+
+class RecordCompressor(object):
+    """I add the compression-v1 flag byte to outbound records, and remove
+    it from inbound ones.
+
+    If I'm given a 'codec', I compress each outbound record with it, unless
+    the record is small, or a sample from the front of it doesn't compress
+    well (which is what happens with media files, archives, and anything
+    else that is already compressed). Those records are sent RAW, as is any
+    record that compression would make bigger.
+
+    'max_length' limits how big a record may decompress to (our negotiated
+    record size), so a small record can't expand into a huge one.
+    """
+    MIN_SIZE = 256
+    SAMPLE_SIZE = 4096
+    # only compress a record if its sample shrinks to this fraction or less
+    SAMPLE_RATIO = 0.9
+
+    def __init__(self, codec, max_length):
+        self.codec = codec
+        self._max_length = max_length
+        self._codecs = dict([(c.FLAG, c) for c in available_codecs()])
+
+    def compress(self, record):
+        codec = self.codec
+        if codec is not None and len(record) >= self.MIN_SIZE:
+            if len(record) > 2 * self.SAMPLE_SIZE:
+                sample = record[:self.SAMPLE_SIZE]
+                worthwhile = (len(codec.compress(sample)) <=
+                              len(sample) * self.SAMPLE_RATIO)
+            else:
+                worthwhile = True
+            if worthwhile:
+                compressed = codec.compress(record)
+                if len(compressed) < len(record):
+                    return codec.FLAG + compressed
+        return RAW + record
+
+    def decompress(self, payload):
+        flag = payload[:1]
+        if flag == RAW:
+            return payload[1:]
+        codec = self._codecs.get(flag)
+        if codec is None:
+            raise BadCompression("unknown compression flag %r" % (flag, ))
+        try:
+            return codec.decompress(payload[1:], self._max_length)
+        except TransitError:
+            raise
+        except Exception as e:
+            raise BadCompression("bad %s record: %s" % (codec.name, e))
+
+
+def _decompress_record(decompress, f, args):
+    # run as a single job, so a thread pool can do both
+    return decompress(f(*args))
+
+
+if six.PY2:
+    # py2's str.join() won't accept buffers
+
+    def _join_views(views):
+        return b"".join([v.tobytes() for v in views])
+else:
+    _join_views = b"".join
+
+
+class RecordBuffer(object):
+    """I reassemble length-prefixed records from a sequence of TCP reads.
+
+    Each record on the wire is a 4-byte big-endian length, followed by that
+    many bytes of ciphertext. The naive approach (append each read to a
+    buffer, then slice records off the front) copies the unread tail once
+    per record, which goes quadratic when a single read holds many records.
+
+    Instead, I hold a partial record as a list of memoryview fragments of
+    the reads that carried it, and join them into a single bytes object
+    (which is what SecretBox wants) only once the last fragment arrives. A
+    record that arrives inside a single read is sliced out directly, and a
+    read that holds exactly one whole record is passed through untouched.
+    So each ciphertext byte is copied at most once before decryption.
+    'bytes_copied' counts those copies, for the benefit of benchmarks.
+
+    Completed records are appended to the 'records' deque, for the caller
+    to pop off. If 'max_length' is set, a length prefix that exceeds it
+    raises RecordTooLarge, before any of the record is buffered.
+    """
+    HEADER = struct.Struct(">L")
+
+    def __init__(self):
+        self.records = deque()
+        self.bytes_copied = 0
+        self.max_length = None
+        self._header = b""
+        self._length = None  # of the record being assembled, if known
+        self._fragments = []
+        self._have = 0  # bytes in self._fragments
+
+    def buffered(self):
+        """Return the number of bytes held for an incomplete record."""
+        return len(self._header) + self._have
+
+    def feed(self, data):
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        while pos < end:
+            if self._length is None:
+                if not self._header and end - pos >= 4:
+                    (self._length, ) = self.HEADER.unpack_from(data, pos)
+                    pos += 4
+                else:
+                    # the length prefix itself was split across reads
+                    take = min(4 - len(self._header), end - pos)
+                    self._header += view[pos:pos + take].tobytes()
+                    pos += take
+                    if len(self._header) < 4:
+                        return
+                    (self._length, ) = self.HEADER.unpack(self._header)
+                    self._header = b""
+                if (self.max_length is not None and
+                        self._length > self.max_length):
+                    raise RecordTooLarge(
+                        "record of %d bytes exceeds limit of %d" %
+                        (self._length, self.max_length))
+            need = self._length - self._have
+            avail = end - pos
+            if not self._fragments and avail >= need:
+                # the whole record is in this read
+                if pos == 0 and need == end:
+                    record = data
+                else:
+                    record = data[pos:pos + need]
+                    self.bytes_copied += need
+                pos += need
+                self._length = None
+                self.records.append(record)
+                continue
+            take = min(need, avail)
+            if take:
+                self._fragments.append(view[pos:pos + take])
+                self._have += take
+                pos += take
+            if self._have < self._length:
+                return
+            record = _join_views(self._fragments)
+            self.bytes_copied += self._length
+            self._fragments = []
+            self._have = 0
+            self._length = None
+            self.records.append(record)
+
+
+class OrderedPipeline(object):
+    """I run a function on a thread pool for each job I'm given, and hand
+    the results to 'deliver' in the order the jobs were submitted, no
+    matter which order the threads finish them in.
+
+    'runner' is called like runner(f, *args), and must return a Deferred
+    that fires with f(*args) (i.e. it is deferToThreadPool with the pool
+    filled in). If any job fails, 'failed' is called with the Failure, and
+    the results of that job and every later one are discarded.
+    """
+
+    def __init__(self, runner, deliver, failed):
+        self._runner = runner
+        self._deliver = deliver
+        self._failed = failed
+        self._jobs = deque()  # of [finished, result], oldest first
+        self._broken = False
+        self._waiting_for_drain = []
+
+    def __len__(self):
+        # the number of jobs that are running, or have finished but are
+        # stuck behind one that hasn't
+        return len(self._jobs)
+
+    def submit(self, f, *args):
+        job = [False, None]
+        self._jobs.append(job)
+        d = self._runner(f, *args)
+        d.addBoth(self._finished, job)
+
+    def _finished(self, result, job):
+        job[0] = True
+        job[1] = result
+        while self._jobs and self._jobs[0][0]:
+            (_, result) = self._jobs.popleft()
+            if self._broken:
+                continue
+            if isinstance(result, failure.Failure):
+                self._broken = True
+                self._failed(result)
+            else:
+                self._deliver(result)
+        if not self._jobs:
+            waiting, self._waiting_for_drain = self._waiting_for_drain, []
+            for d in waiting:
+                d.callback(None)
+
+    def when_drained(self):
+        """Return a Deferred that fires once every job submitted so far has
+        been delivered (or discarded)."""
+        if not self._jobs:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting_for_drain.append(d)
+        return d
+
+
+def _open_record(box, ciphertext, nonce):
+    # With framing-v2, the receiver supplies the nonce it expects, so a
+    # record that was dropped, reordered, or replayed fails to decrypt, just
+    # like a corrupted one. Either way, the stream can't be trusted.
+    try:
+        return box.open(ciphertext, nonce)
+    except CryptoError:
+        raise BadNonce("record did not decrypt with nonce %s: corrupt, or "
+                       "out of order" % (bytes_to_hexstr(nonce), ))
+
 
 @implementer(interfaces.IProducer, interfaces.IConsumer)
 class Connection(protocol.Protocol, policies.TimeoutMixin):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
-        self.buf = b""
+        self.buf = b""  # only used during negotiation
+        self._inbound = RecordBuffer()
+        self._held = None  # records that arrived before our owner connected
         self.owner = owner
         self.relay_handshake = relay_handshake
         self.start = start
@@ -182,6 +627,27 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_deferred = None
         self._inbound_records = deque()
         self._waiting_reads = deque()
+        self.flush_threshold = FLUSH_THRESHOLD
+        self._outbound = []
+        self._outbound_bytes = 0
+        self._producer = None
+        self._producer_streaming = None
+        self._pulling = False
+        # these are only used if the owner gives us a thread pool
+        self._encryptor = None
+        self._decryptor = None
+        self._crypto_depth = None
+        self._crypto_paused = False
+        self._consumer_paused = False
+        self._compressor = None
+        # (before, after) compression, for each direction
+        self._sent_bytes = [0, 0]
+        self._received_bytes = [0, 0]
+        # which of our owner's connections this is, when striping: each
+        # stripe gets its own record keys (and therefore nonces)
+        self.stripe = 0
+        self._close_observers = []
+        self._lost = False
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT)  # does timeoutConnection() when it expires
@@ -226,6 +692,27 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self.buf = self.buf[len(expected):]
         return True
 
+    def _check_and_remove_go(self):
+        # Returns the stripe number once the sender's decision has arrived,
+        # or None to keep waiting. "go\n" means stripe 0, which is all that
+        # a sender that isn't striping will ever send. The other stripes
+        # get "go 1\n", "go 2\n", etc.
+        stripes = self.owner.get_stripe_count()
+        if stripes > 1 and self.buf.startswith(b"go "):
+            line, newline, rest = self.buf.partition(b"\n")
+            if not newline:
+                if len(self.buf) > len(b"go ") + len(str(stripes)):
+                    raise BadHandshake("got %r want go" % (self.buf, ))
+                return None
+            number = line[len(b"go "):]
+            if not number.isdigit() or not 0 < int(number) < stripes:
+                raise BadHandshake("got %r want go" % (line, ))
+            self.buf = rest
+            return int(number)
+        if self._check_and_remove(b"go\n"):
+            return 0
+        return None
+
     def _dataReceived(self, data):
         # protocol is:
         #  (maybe: send relay handshake, wait for ok)
@@ -233,6 +720,10 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         #  wait for (receive|send)_handshake
         #  sender: decide, send "go" or hang up
         #  receiver: wait for "go"
+        if self.state == "records":
+            # once negotiation is done, reads go straight to the record
+            # decoder, without passing through self.buf
+            return self.dataReceivedRECORDS(data)
         self.buf += data
 
         assert self.state != "too-early"
@@ -255,18 +746,24 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # hang up).
 
         if self.state == "wait-for-decision":
-            if not self._check_and_remove(b"go\n"):
+            stripe = self._check_and_remove_go()
+            if stripe is None:
                 return
+            self.stripe = stripe
             self._negotiationSuccessful()
         if self.state == "go":
             GO = b"go\n"
+            if self.stripe:
+                GO = b"go " + str(self.stripe).encode("ascii") + b"\n"
             self.transport.write(GO)
             self._negotiationSuccessful()
         if self.state == "nevermind":
             self.transport.write(b"nevermind\n")
             raise BadHandshake("abandoned")
         if self.state == "records":
-            return self.dataReceivedRECORDS()
+            # the first records may have arrived along with the handshake
+            data, self.buf = self.buf, b""
+            return self.dataReceivedRECORDS(data)
         if self.state == "hung up":
             return
         if isinstance(self.state, Exception):  # for tests
@@ -276,53 +773,223 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _negotiationSuccessful(self):
         self.state = "records"
         self.setTimeout(None)
-        send_key = self.owner._sender_record_key()
-        self.send_box = SecretBox(send_key)
+        self.send_box = self.receive_box = None  # see _start_records
         self.send_nonce = 0
-        receive_key = self.owner._receiver_record_key()
-        self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
+        crypto = self.owner._crypto_runner()
+        if crypto is not None:
+            runner, self._crypto_depth = crypto
+            self._encryptor = OrderedPipeline(runner, self._encrypted,
+                                              self._crypto_failed)
+            self._decryptor = OrderedPipeline(runner, self._decrypted,
+                                              self._crypto_failed)
         d, self._negotiation_d = self._negotiation_d, None
         d.callback(self)
 
-    def dataReceivedRECORDS(self):
-        while True:
-            if len(self.buf) < 4:
+    def _start_records(self):
+        # This waits for the first record to be sent or received, rather
+        # than happening in _negotiationSuccessful(), because a sender can
+        # finish negotiating an inbound connection before it has heard the
+        # receiver's abilities. Applications must add those before they
+        # call connect(), which is what gives them a Connection to send
+        # records with.
+        suite = self.owner._cipher_suite()
+        self.send_box = suite(self.owner._sender_record_key(self.stripe))
+        self.receive_box = suite(self.owner._receiver_record_key(self.stripe))
+        self._framing = self.owner._framing()
+        if self._framing == 2:
+            # the nonce is implied by the record's position in the stream
+            self._encrypt_record = self.send_box.seal
+            self._overhead = suite.MACBYTES
+        else:
+            self._encrypt_record = self.send_box.encrypt
+            self._overhead = suite.OVERHEAD
+        max_record_size = self.owner._max_record_size()
+        if max_record_size is not None:
+            self._inbound.max_length = max_record_size + self._overhead
+        self._compressor = self.owner._record_compressor()
+        if self._compressor is not None:
+            if max_record_size is not None:
+                self._inbound.max_length += len(RAW)
+            encrypt = self._encrypt_record
+            compress = self._compressor.compress
+
+            def _compress_and_encrypt(record, nonce):
+                return encrypt(compress(record), nonce)
+
+            self._encrypt_record = _compress_and_encrypt
+
+    def dataReceivedRECORDS(self, data):
+        if self.receive_box is None:
+            if self._held is not None:
+                self._held.append(data)
                 return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4 + length:
+            if not data:
+                return  # just the end of negotiation: too early to start
+            if not self.owner._connecting:
+                # A sender can hear from an inbound connection before it
+                # has the receiver's abilities, which say how to read these
+                # records, so they wait until the application calls
+                # connect() (which it only does once it has added them).
+                # We stop reading until then, so all we hold is what the
+                # transport already gave us.
+                self._held = [data]
+                self.transport.pauseProducing()
+                self.owner._when_connecting(self._release_held)
                 return
-            encrypted, self.buf = self.buf[4:4 + length], self.buf[4 + length:]
-
-            record = self._decrypt_record(encrypted)
-            self.recordReceived(record)
-
-    def _decrypt_record(self, encrypted):
-        nonce_buf = encrypted[:SecretBox.NONCE_SIZE]  # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
+            self._start_records()
+        self._inbound.feed(data)
+        # recordReceived() might provoke a re-entrant dataReceived(), which
+        # will drain this same queue, so records are still delivered in order
+        records = self._inbound.records
+        if self._decryptor is None:
+            while records:
+                record = self._decrypt_record(records.popleft())
+                self._received_bytes[0] += len(record)
+                self.recordReceived(record)
+            return
+        # Only the decryption itself is handed to the thread pool
+        while records:
+            (f, args) = self._next_decryption(records.popleft())
+            self._decryptor.submit(f, *args)
+        if len(self._decryptor) >= self._crypto_depth:
+            # stop reading until the threads catch up
+            if not self._crypto_paused:
+                self._crypto_paused = True
+                self.transport.pauseProducing()
+
+    def _release_held(self):
+        data, self._held = b"".join(self._held), None
+        if self.state != "records":
+            return
+        if not (self._consumer_paused or self._crypto_paused):
+            self.transport.resumeProducing()
+        self.dataReceivedRECORDS(data)
+
+    def _next_decryption(self, encrypted):
+        # Returns (f, args), where f(*args) decrypts the next inbound record
+        # (and raises BadNonce if it arrived out of order).
+        if self._framing == 2:
+            nonce = self.receive_box.NONCE.pack(self.next_receive_nonce)
+            self.next_receive_nonce += 1
+            job = (_open_record, (self.receive_box, encrypted, nonce))
+        else:
+            # with framing-v1 the nonce is in the clear, so we can reject
+            # out-of-order records before decrypting anything
+            self._check_nonce(encrypted)
+            job = (self.receive_box.decrypt, (encrypted, ))
+        self._received_bytes[1] += len(encrypted) - self._overhead
+        if self._compressor is not None:
+            job = (_decompress_record, (self._compressor.decompress, ) + job)
+        return job
+
+    def _check_nonce(self, encrypted):
+        size = self.receive_box.NONCE.size
+        nonce_buf = encrypted[:size]  # assume it's prepended
+        if nonce_buf != self.receive_box.NONCE.pack(self.next_receive_nonce):
+            nonce = int(hexlify(nonce_buf), 16)
             raise BadNonce(
                 "received out-of-order record: got %d, expected %d" %
                 (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
-        record = self.receive_box.decrypt(encrypted)
-        return record
+
+    def _decrypt_record(self, encrypted):
+        (f, args) = self._next_decryption(encrypted)
+        return f(*args)
+
+    def _decrypted(self, record):
+        if self._crypto_paused and len(self._decryptor) < self._crypto_depth:
+            self._crypto_paused = False
+            if not self._consumer_paused:
+                self.transport.resumeProducing()
+        self._received_bytes[0] += len(record)
+        self.recordReceived(record)
+
+    def _crypto_failed(self, f):
+        # a record that didn't decrypt, most likely. This is just as fatal
+        # as it is on the reactor thread, but there's nobody to raise it to.
+        log.msg("transit crypto failed, dropping connection: %s" % (f.value,))
+        self._error = f.value
+        self.state = "hung up"
+        self.transport.loseConnection()
 
     def describe(self):
         return self._description
 
     def send_record(self, record):
+        self.send_records([record])
+
+    def send_records(self, records):
+        """Encrypt and frame a batch of records, and hand them (along with
+        anything queued by write()) to the transport in a single
+        writeSequence()."""
+        for record in records:
+            self._queue_record(record)
+        self.flush()
+
+    def _queue_record(self, record):
         if not isinstance(record, type(b"")):
             raise InternalError
-        assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8 * 24)
+        if self.send_box is None:
+            self._start_records()
+        assert self.send_nonce < 2**64
         assert len(record) < 2**(8 * 4)
-        nonce = unhexlify("%048x" % self.send_nonce)  # big-endian
+        nonce = self.send_box.NONCE.pack(self.send_nonce)  # big-endian
         self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted))  # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
+        self._sent_bytes[0] += len(record)
+        if self._encryptor is None:
+            self._frame(self._encrypt_record(record, nonce))
+        else:
+            # the nonce was assigned above, and the pipeline delivers
+            # ciphertexts in the same order, so the wire format is the same
+            self._encryptor.submit(self._encrypt_record, record, nonce)
+
+    def _frame(self, encrypted):
+        self._outbound.append(RecordBuffer.HEADER.pack(len(encrypted)))
+        self._outbound.append(encrypted)
+        self._outbound_bytes += 4 + len(encrypted)
+        self._sent_bytes[1] += len(encrypted) - self._overhead
+
+    def compression_stats(self):
+        """Return a dict describing how well record compression has worked
+        so far (for timing/debug output), or None if our peer doesn't do
+        compression-v1. 'sent_ratio' is uncompressed/compressed, so 5.0
+        means records were a fifth of their original size on the wire (not
+        counting encryption overhead)."""
+        if self._compressor is None:
+            return None
+        codec = self._compressor.codec
+        stats = {
+            u"compression": codec.name if codec else u"none",
+            u"sent_bytes": self._sent_bytes[0],
+            u"sent_compressed_bytes": self._sent_bytes[1],
+            u"received_bytes": self._received_bytes[0],
+            u"received_compressed_bytes": self._received_bytes[1],
+        }
+        for direction in [u"sent", u"received"]:
+            compressed = stats[direction + u"_compressed_bytes"]
+            if compressed:
+                stats[direction + u"_ratio"] = (
+                    stats[direction + u"_bytes"] / float(compressed))
+        return stats
+
+    def _encrypted(self, encrypted):
+        self._frame(encrypted)
+        # hold records back while more are on their way, so they can share
+        # a write
+        if (len(self._encryptor) == 0 or
+                self._outbound_bytes >= self.flush_threshold):
+            self.flush()
+
+    def flush(self):
+        """Write out any records that write() has been holding back.
+        Records that are still being encrypted by the thread pool are
+        written when they're ready."""
+        if not self._outbound:
+            return
+        outbound, self._outbound = self._outbound, []
+        self._outbound_bytes = 0
+        self.transport.writeSequence(outbound)
 
     def recordReceived(self, record):
         if self._consumer:
@@ -342,8 +1009,22 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             r = self._inbound_records.popleft()
             d = self._waiting_reads.popleft()
             d.callback(r)
+        if self._lost:
+            # no more records are coming
+            while self._waiting_reads:
+                d = self._waiting_reads.popleft()
+                d.errback(error.ConnectionClosed())
 
     def close(self):
+        if self._encryptor is not None:
+            # let the threads finish the records we've already accepted
+            d = self._encryptor.when_drained()
+            d.addCallback(lambda _: self._close())
+            return
+        self._close()
+
+    def _close(self):
+        self.flush()
         self.transport.loseConnection()
         while self._waiting_reads:
             d = self._waiting_reads.popleft()
@@ -371,20 +1052,79 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # timeout: BadHandshake("timeout")
 
             d.errback(self._error or BadHandshake("connection lost"))
+        if self._decryptor is not None:
+            # records that arrived before the connection was lost (like a
+            # final ack) are still delivered, once they've been decrypted
+            d = self._decryptor.when_drained()
+            d.addCallback(lambda _: self._inboundLost())
+            return
+        self._inboundLost()
+
+    def _inboundLost(self):
+        self._lost = True
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        self._deliverRecords()
+        observers, self._close_observers = self._close_observers, []
+        for d in observers:
+            d.callback(self)
+
+    def when_closed(self):
+        """Return a Deferred that fires (with this Connection) when the
+        connection is lost, for whatever reason."""
+        d = defer.Deferred()
+        self._close_observers.append(d)
+        return d
 
     # IConsumer methods, for outbound flow-control. We pass these through to
     # the transport. The 'producer' is something like a t.p.basic.FileSender
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
+        self._producer = producer
+        self._producer_streaming = streaming
         self.transport.registerProducer(producer, streaming)
 
     def unregisterProducer(self):
+        self.flush()
+        self._producer = None
+        self._producer_streaming = None
         self.transport.unregisterProducer()
 
     def write(self, data):
-        self.send_record(data)
+        if self._producer is None or self._producer_streaming:
+            # we can't ask a streaming producer for more, so don't hold
+            # anything back
+            self.send_record(data)
+            return
+        self._queue_record(data)
+        if self._outbound_bytes >= self.flush_threshold:
+            self.flush()
+            return
+        if self._pulling:
+            return  # we're being called by the loop below
+        # A pull producer only writes once each time it is asked, and the
+        # transport won't ask again until it has written everything we gave
+        # it. So ask the producer ourselves, until we have enough to be
+        # worth a write (or, with a thread pool, until every thread has a
+        # record to work on). The producer might unregister itself (which
+        # flushes) when it runs out of data.
+        self._pulling = True
+        try:
+            while self._producer is not None and self._want_more():
+                queued = self.send_nonce
+                self._producer.resumeProducing()
+                if self.send_nonce == queued:
+                    break  # it had nothing for us
+        finally:
+            self._pulling = False
+        self.flush()
+
+    def _want_more(self):
+        if self._outbound_bytes >= self.flush_threshold:
+            return False
+        if self._encryptor is not None:
+            return len(self._encryptor) < self._crypto_depth
+        return bool(self._outbound)
 
     # IProducer methods, for inbound flow-control. We pass these through to
     # the transport.
@@ -392,10 +1132,13 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self.transport.stopProducing()
 
     def pauseProducing(self):
+        self._consumer_paused = True
         self.transport.pauseProducing()
 
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        self._consumer_paused = False
+        if not self._crypto_paused and self._held is None:
+            self.transport.resumeProducing()
 
     # Helper methods
 
@@ -443,6 +1186,9 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         while self._consumer and self._inbound_records:
             r = self._inbound_records.popleft()
             self._writeToConsumer(r)
+        if self._lost and self._consumer_deferred:
+            # that's all there will ever be, and it wasn't enough
+            self._consumer_deferred.errback(error.ConnectionClosed())
         return d
 
     def _writeToConsumer(self, record):
@@ -465,10 +1211,59 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     # optional callable which will be called on each write (with the number
     # of bytes written). Returns a Deferred that fires (with the number of
     # bytes written) when the count is reached or the RecordPipe is closed.
+    # If 'expected' is None, the sender didn't know how much it would send,
+    # and marks the end with an empty record instead.
 
     def writeToFile(self, f, expected, progress=None, hasher=None):
         fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+        if expected is not None:
+            return self.connectConsumer(fc, expected)
+        return self._connectStream(fc)
+
+    def _connectStream(self, consumer):
+        sc = _StreamConsumer(self, consumer)
+        self.when_closed().addCallback(sc.connectionLost)
+        self.connectConsumer(sc)
+        if self._lost:
+            sc.connectionLost(self)
+        return sc.deferred
+
+    # Like writeToFile (with 'expected' None), but for a file whose writes
+    # can block, like a pipe to another program: they happen on a thread,
+    # and we stop reading from our peer while they fall behind. The
+    # Deferred fires once everything up to the end marker has been written,
+    # or errbacks with the first write that failed.
+
+    def writeToStream(self, f, progress=None, hasher=None):
+        tc = ThreadedFileConsumer(self._run_in_thread, f, progress, hasher)
+        d = self._connectStream(tc)
+        d.addBoth(lambda res: tc.when_flushed().addCallback(lambda _: res))
+        return d
+
+    def _run_in_thread(self, f, *args):
+        reactor = self.owner._reactor
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(), f,
+                                         *args)
+
+    # Helper method to send the contents of a file, one record per chunk.
+    # The chunks start small and grow (up to the record size negotiated with
+    # our peer) as long as that makes the transfer go faster. 'transform' is
+    # an optional callable that is given each chunk, and returns the data to
+    # send in its place. Returns a Deferred that fires when the last chunk
+    # has been written.
+
+    def sendFile(self, f, transform=None):
+        sizer = RecordSizer(self.owner._max_record_size())
+        return FileSender(sizer).beginFileTransfer(f, self, transform)
+
+    # Like sendFile, but for a file whose reads can block, like a pipe from
+    # another program: they happen on a thread, and only while the
+    # transport wants more.
+
+    def sendStream(self, f, transform=None):
+        sizer = RecordSizer(self.owner._max_record_size())
+        return ThreadedFileSender(self._run_in_thread,
+                                  sizer).beginFileTransfer(f, self, transform)
 
 
 class OutboundConnectionFactory(protocol.ClientFactory):
@@ -499,6 +1294,9 @@ class InboundConnectionFactory(protocol.ClientFactory):
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
         self._pending_connections = set()
+        # when striping, our owner wants more than one connection, and will
+        # shut us down itself
+        self.striping = False
 
     def whenDone(self):
         return self._inbound_d
@@ -535,7 +1333,14 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return res
 
     def _proto_succeeded(self, p):
-        self._shutdown()
+        if p.stripe:
+            # one of the extra connections of a striped transfer (connect()
+            # only returns stripe 0). Our owner collects these, and shuts us
+            # down when it has enough of them.
+            self.owner._add_stripe(p)
+            return
+        if not self.striping:
+            self._shutdown()
         self._inbound_d.callback(p)
 
     def _proto_failed(self, f):
@@ -620,16 +1425,82 @@ def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
 
+class _GatherStripes(object):
+    """Like _ThereCanBeOnlyOne, but for a striped transfer, which keeps
+    several winners. The summary Deferred fires with stripe 0 as soon as it
+    arrives, and each of the other stripes is handed to add_stripe(). The
+    contenders that are still pending when stop() is called are cancelled.
+    If they all fail (or are cancelled) before stripe 0 arrives, the summary
+    errbacks with the first failure.
+    """
+
+    def __init__(self, contenders, add_stripe):
+        self._remaining = set(contenders)
+        self._add_stripe = add_stripe
+        self._winner_d = defer.Deferred(self._cancel)
+        self._first_failure = None
+
+    def _cancel(self, _):
+        self.stop()
+
+    def run(self):
+        for d in list(self._remaining):
+            d.addBoth(self._remove, d)
+            d.addCallbacks(self._succeeded, self._failed)
+            d.addCallback(self._maybe_done)
+        return self._winner_d
+
+    def stop(self):
+        for d in list(self._remaining):
+            d.cancel()
+
+    def _remove(self, res, d):
+        self._remaining.remove(d)
+        return res
+
+    def _succeeded(self, p):
+        if p.stripe:
+            self._add_stripe(p)
+        else:
+            self._winner_d.callback(p)
+
+    def _failed(self, f):
+        if self._first_failure is None:
+            self._first_failure = f
+
+    def _maybe_done(self, _):
+        if self._remaining or self._winner_d.called:
+            return
+        self._winner_d.errback(self._first_failure or
+                               TransitError("no first stripe"))
+
+
 class Common:
     RELAY_DELAY = 2.0
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
+    # the largest record we're willing to receive (or send), not counting
+    # the encryption overhead
+    MAX_RECORD_SIZE = 4 * 1024 * 1024
+    # with crypto_threads=N, let up to this many records per thread be in
+    # flight in each direction, so no thread has to wait for the reactor
+    CRYPTO_DEPTH_PER_THREAD = 2
+    # the most connections we'll stripe a transfer across, and how long
+    # (after the first one) we'll wait for the others to connect
+    MAX_STRIPES = 8
+    STRIPE_WAIT = 2.0
 
     def __init__(self,
                  transit_relay,
                  no_listen=False,
                  tor=None,
                  reactor=reactor,
-                 timing=None):
+                 timing=None,
+                 crypto_threads=0,
+                 cipher_suites=False,
+                 framing_v2=False,
+                 compress=False,
+                 accept_compressed=False,
+                 stripes=1):
         self._side = bytes_to_hexstr(os.urandom(8))  # unicode
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
@@ -641,16 +1512,37 @@ class Common:
         else:
             self._transit_relays = []
         self._their_direct_hints = []  # hintobjs
+        self._their_abilities = []
         self._our_relay_hints = set(self._transit_relays)
         self._tor = tor
         self._transit_key = None
         self._no_listen = no_listen
         self._waiting_for_transit_key = []
+        self._connecting = False
+        self._waiting_to_connect = []
         self._listener = None
+        self._listener_d = None
         self._winner = None
         self._reactor = reactor
         self._timing = timing or DebugTiming()
         self._timing.add("transit")
+        self._crypto_threads = crypto_threads
+        self._crypto_pool = None
+        # The newer record formats are only advertised (and so only used)
+        # when asked for, so applications that don't know about them keep
+        # talking to their older peers the way they always did. Compressing
+        # implies accepting compressed records.
+        self._cipher_suites = cipher_suites
+        self._framing_v2 = framing_v2
+        self._compress = compress
+        self._accept_compressed = accept_compressed or compress
+        self._stripes = stripes
+        self._next_stripe = 1
+        self._extra_stripes = []
+        self._stripe_observers = []
+        self._stripe_gatherer = None
+        self._stripe_timer = None
+        self._striping_done = False
 
     def _build_listener(self):
         if self._no_listen or self._tor:
@@ -669,14 +1561,212 @@ class Common:
         return direct_hints, ep
 
     def get_connection_abilities(self):
-        return [
+        abilities = [
             {
                 u"type": u"direct-tcp-v1"
             },
             {
                 u"type": u"relay-v1"
             },
+            {
+                u"type": u"record-size-v1",
+                u"max": self.MAX_RECORD_SIZE,
+            },
         ]
+        if self._cipher_suites:
+            abilities.append({
+                u"type": u"cipher-suites-v1",
+                u"suites": [c.name for c in available_cipher_suites()],
+            })
+        if self._framing_v2:
+            abilities.append({u"type": u"framing-v2"})
+        if self._accept_compressed:
+            abilities.append({
+                u"type": u"compression-v1",
+                u"algorithms": [c.name for c in available_codecs()],
+            })
+        abilities.append({
+            u"type": u"striping-v1",
+            u"max": self._stripes,
+        })
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        # These are the "abilities-v1" that our peer sent us. The record
+        # layer uses them to decide how to talk to the peer, so they must be
+        # added before connect() is called.
+        self._their_abilities = [a for a in abilities if isinstance(a, dict)]
+
+    def _their_ability(self, ability_type):
+        for a in self._their_abilities:
+            if a.get(u"type") == ability_type:
+                return a
+        return None
+
+    def _max_record_size(self):
+        # None means our peer predates record-size-v1: it will accept
+        # anything, but will only send us 16KiB records
+        a = self._their_ability(u"record-size-v1")
+        if a is None:
+            return None
+        their_max = a.get(u"max")
+        if (not isinstance(their_max, six.integer_types) or
+                isinstance(their_max, bool) or their_max < 1):
+            log.msg("invalid record-size-v1 ability: %r" % (a, ))
+            return None
+        return min(self.MAX_RECORD_SIZE, their_max)
+
+    def _cipher_suite(self):
+        # Both sides must pick the same suite, so we use the first one in
+        # the sender's list that the receiver also supports. Peers that
+        # predate cipher-suites-v1 (or that weren't asked to advertise it)
+        # only use XSalsa20Poly1305.
+        if not self._cipher_suites:
+            return XSalsa20Poly1305
+        ours = available_cipher_suites()
+        a = self._their_ability(u"cipher-suites-v1")
+        theirs = a and a.get(u"suites")
+        if not isinstance(theirs, list):
+            if a is not None:
+                log.msg("invalid cipher-suites-v1 ability: %r" % (a, ))
+            return XSalsa20Poly1305
+        our_names = [c.name for c in ours]
+        sender_names = our_names if self.is_sender else theirs
+        receiver_names = theirs if self.is_sender else our_names
+        for name in sender_names:
+            if name in receiver_names:
+                return ours[our_names.index(name)]
+        return XSalsa20Poly1305
+
+    def _framing(self):
+        # framing-v2 leaves the nonce (which is always the record counter)
+        # off the wire. We only use it if we both advertised it.
+        if (self._framing_v2 and
+                self._their_ability(u"framing-v2") is not None):
+            return 2
+        return 1
+
+    def _record_compressor(self):
+        # None means one of us didn't advertise compression-v1, so records
+        # carry no flag byte. Otherwise, if we were asked to compress, we
+        # use the first of our codecs that our peer can decompress.
+        if not self._accept_compressed:
+            return None
+        a = self._their_ability(u"compression-v1")
+        if a is None:
+            return None
+        codec = None
+        theirs = a.get(u"algorithms")
+        if self._compress and isinstance(theirs, list):
+            for c in available_codecs():
+                if c.name in theirs:
+                    codec = c
+                    break
+        max_length = self._max_record_size() or self.MAX_RECORD_SIZE
+        return RecordCompressor(codec, max_length)
+
+    def get_stripe_count(self):
+        """Return the number of connections that a transfer should be
+        striped across. This is 1 unless both sides asked for more with
+        striping-v1: the sender says how many it wants to use, and the
+        receiver says how many it is willing to accept."""
+        a = self._their_ability(u"striping-v1")
+        if a is None:
+            return 1
+        their_max = a.get(u"max")
+        if (not isinstance(their_max, six.integer_types) or
+                isinstance(their_max, bool) or their_max < 1):
+            log.msg("invalid striping-v1 ability: %r" % (a, ))
+            return 1
+        return max(1, min(self._stripes, their_max, self.MAX_STRIPES))
+
+    def observe_stripes(self, observer):
+        """When striping, call observer(connection) with each of the extra
+        connections (stripes 1 and up): first the ones we already have, then
+        the rest as they arrive. connect() returns stripe 0, which is the
+        only one that an unstriped transfer uses."""
+        self._stripe_observers.append(observer)
+        for p in list(self._extra_stripes):
+            observer(p)
+
+    def _add_stripe(self, p):
+        if self._striping_done:
+            p.close()  # too late to be useful
+            return
+        self._extra_stripes.append(p)
+        for observer in list(self._stripe_observers):
+            observer(p)
+        if self._stripe_timer is not None:
+            self._check_stripes()
+
+    def _check_stripes(self):
+        if 1 + len(self._extra_stripes) >= self.get_stripe_count():
+            self.stop_striping()
+
+    def _first_stripe(self, p):
+        # give the other stripes a little while to show up
+        self._stripe_timer = self._reactor.callLater(self.STRIPE_WAIT,
+                                                     self.stop_striping)
+        self._check_stripes()
+        return p
+
+    def _no_first_stripe(self, f):
+        self.stop_striping()
+        for p in self._extra_stripes:
+            p.close()
+        return f
+
+    def stop_striping(self):
+        """Stop waiting for more stripes, and abandon the connection
+        attempts that might have become one. This happens by itself when we
+        have all the stripes we asked for, or STRIPE_WAIT seconds after
+        stripe 0 arrived, whichever comes first. Applications should also
+        call it when their transfer is finished."""
+        self._striping_done = True
+        if self._stripe_timer is not None:
+            if self._stripe_timer.active():
+                self._stripe_timer.cancel()
+            self._stripe_timer = None
+        gatherer, self._stripe_gatherer = self._stripe_gatherer, None
+        if gatherer is not None:
+            gatherer.stop()
+        if self._listener:
+            # drop inbound connections that are still negotiating
+            self._listener_f._shutdown()
+
+    def stop_listening(self):
+        """Stop striping (see stop_striping), and stop listening for inbound
+        connections. The listener otherwise lasts until connect() has picked
+        a connection, so applications should call this whenever they give up
+        on a transfer (even before calling connect()), as well as when it is
+        finished."""
+        self.stop_striping()
+        d = self._listener_d
+        if d is not None and not d.called:
+            # (if connect() has this too, it sees the cancellation first)
+            d.addErrback(lambda f: f.trap(defer.CancelledError))
+            d.cancel()
+
+    def _crypto_runner(self):
+        # None means the Connection should encrypt and decrypt on the
+        # reactor thread. Otherwise we return (runner, depth): libsodium
+        # releases the GIL, so with N threads we can use N cores, as long as
+        # at least N records are in flight at once.
+        if not self._crypto_threads:
+            return None
+        if self._crypto_pool is None:
+            pool = ThreadPool(minthreads=0, maxthreads=self._crypto_threads,
+                              name="transit-crypto")
+            pool.start()
+            self._crypto_pool_trigger = self._reactor.addSystemEventTrigger(
+                "during", "shutdown", pool.stop)
+            self._crypto_pool = pool
+
+        def runner(f, *args):
+            return threads.deferToThreadPool(self._reactor, self._crypto_pool,
+                                             f, *args)
+
+        return (runner, self._crypto_threads * self.CRYPTO_DEPTH_PER_THREAD)
 
     @inlineCallbacks
     def get_connection_hints(self):
@@ -802,31 +1892,31 @@ class Common:
         else:
             return build_sender_handshake(self._transit_key)  # + b"go\n"
 
-    def _sender_record_key(self):
+    def _sender_record_key(self, stripe=0):
         assert self._transit_key
         if self.is_sender:
             return HKDF(
                 self._transit_key,
                 SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_sender_key")
+                CTXinfo=_stripe_info(b"transit_record_sender_key", stripe))
         else:
             return HKDF(
                 self._transit_key,
                 SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_receiver_key")
+                CTXinfo=_stripe_info(b"transit_record_receiver_key", stripe))
 
-    def _receiver_record_key(self):
+    def _receiver_record_key(self, stripe=0):
         assert self._transit_key
         if self.is_sender:
             return HKDF(
                 self._transit_key,
                 SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_receiver_key")
+                CTXinfo=_stripe_info(b"transit_record_receiver_key", stripe))
         else:
             return HKDF(
                 self._transit_key,
                 SecretBox.KEY_SIZE,
-                CTXinfo=b"transit_record_sender_key")
+                CTXinfo=_stripe_info(b"transit_record_sender_key", stripe))
 
     def set_transit_key(self, key):
         assert isinstance(key, type(b"")), type(key)
@@ -850,8 +1940,20 @@ class Common:
         self._waiting_for_transit_key.append(d)
         return d
 
+    def _when_connecting(self, callback):
+        if self._connecting:
+            callback()
+        else:
+            self._waiting_to_connect.append(callback)
+
     @inlineCallbacks
     def connect(self):
+        # our peer's abilities have been added by now, so the connections
+        # that already have records from it can read them
+        self._connecting = True
+        waiters, self._waiting_to_connect = self._waiting_to_connect, []
+        for callback in waiters:
+            callback()
         with self._timing.add("transit connect"):
             yield self._get_transit_key()
             # we want to have the transit key before starting any outbound
@@ -870,6 +1972,11 @@ class Common:
         if self._listener_d:
             contenders.append(self._listener_d)
         relay_delay = 0
+        # when striping, we make that many connections to each hint, and
+        # keep every one that gets a "go"
+        stripes = self.get_stripe_count()
+        if self._listener_d and stripes > 1:
+            self._listener_f.striping = True
 
         for hint_obj in self._their_direct_hints:
             # Check the hint type to see if we can support it (e.g. skip
@@ -881,8 +1988,9 @@ class Common:
             description = "->%s" % describe_hint_obj(hint_obj)
             if self._tor:
                 description = "tor" + description
-            d = self._start_connector(ep, description)
-            contenders.append(d)
+            for i in range(stripes):
+                d = self._start_connector(ep, description)
+                contenders.append(d)
             relay_delay = self.RELAY_DELAY
 
         # Start trying the relays a few seconds after we start to try the
@@ -908,20 +2016,31 @@ class Common:
                 description = "->relay:%s" % describe_hint_obj(hint_obj)
                 if self._tor:
                     description = "tor" + description
-                d = task.deferLater(
-                    self._reactor,
-                    relay_delay,
-                    self._start_connector,
-                    ep,
-                    description,
-                    is_relay=True)
-                contenders.append(d)
+                # The relay only pairs up one connection from each side
+                # per token, so each of our connections to it uses a
+                # different one.
+                for i in range(stripes):
+                    d = task.deferLater(
+                        self._reactor,
+                        relay_delay,
+                        self._start_connector,
+                        ep,
+                        description,
+                        is_relay=True,
+                        relay_stripe=i)
+                    contenders.append(d)
             relay_delay += self.RELAY_DELAY
 
         if not contenders:
             raise TransitError("No contenders for connection")
 
-        winner = there_can_be_only_one(contenders)
+        if stripes == 1:
+            winner = there_can_be_only_one(contenders)
+        else:
+            self._stripe_gatherer = _GatherStripes(contenders,
+                                                   self._add_stripe)
+            winner = self._stripe_gatherer.run()
+            winner.addCallbacks(self._first_stripe, self._no_first_stripe)
         return self._not_forever(2 * TIMEOUT, winner)
 
     def _not_forever(self, timeout, d):
@@ -937,14 +2056,16 @@ class Common:
         d.addBoth(_done)
         return d
 
-    def _build_relay_handshake(self):
-        return build_sided_relay_handshake(self._transit_key, self._side)
+    def _build_relay_handshake(self, stripe=0):
+        return build_sided_relay_handshake(self._transit_key, self._side,
+                                           stripe)
 
-    def _start_connector(self, ep, description, is_relay=False):
+    def _start_connector(self, ep, description, is_relay=False,
+                         relay_stripe=0):
         relay_handshake = None
         if is_relay:
             assert self._transit_key
-            relay_handshake = self._build_relay_handshake()
+            relay_handshake = self._build_relay_handshake(relay_stripe)
         f = OutboundConnectionFactory(self, relay_handshake, description)
         d = ep.connect(f)
         # fires with protocol, or ConnectError
@@ -969,12 +2090,18 @@ class Common:
     def connection_ready(self, p):
         # inbound/outbound Connection protocols call this when they finish
         # negotiation. The first one wins and gets a "go". Any subsequent
-        # ones lose and get a "nevermind" before being closed.
+        # ones lose and get a "nevermind" before being closed, unless we're
+        # striping, in which case the next few become the other stripes.
 
         if not self.is_sender:
             return "wait-for-decision"
 
         if self._winner:
+            if (not self._striping_done and
+                    self._next_stripe < self.get_stripe_count()):
+                p.stripe = self._next_stripe
+                self._next_stripe += 1
+                return "go"
             # we already have a winner, so this one loses
             return "nevermind"
         # this one wins!
@@ -990,6 +2117,146 @@ class TransitReceiver(Common):
     is_sender = False
 
 
+class RecordSizer(object):
+    """I decide how much data FileSender should put into each record.
+
+    Every record costs a fixed amount of CPU (encryption setup, framing,
+    and a trip through the Python call stack on both ends), so bigger
+    records are cheaper per byte, but they also cost the receiver more
+    memory. I start with small records, and double the size each time the
+    observed throughput reaches a new high (like it does while TCP is
+    ramping up), until I reach 'maximum'. If the throughput falls below half
+    of the best I've seen, I halve the size again.
+
+    If 'maximum' is None, our peer didn't tell us how big a record it will
+    accept, so I stick with INITIAL, which is what FileSender always used.
+    """
+    INITIAL = 16 * 1024
+    WINDOW = 0.25  # seconds
+
+    def __init__(self, maximum, clock=time.time):
+        self._maximum = self.INITIAL if maximum is None else maximum
+        self.size = min(self.INITIAL, self._maximum)
+        self._clock = clock
+        self._window_start = None
+        self._window_bytes = 0
+        self._best_rate = 0.0
+
+    def sent(self, nbytes):
+        now = self._clock()
+        if self._window_start is None:
+            self._window_start = now
+        self._window_bytes += nbytes
+        elapsed = now - self._window_start
+        if elapsed < self.WINDOW:
+            return
+        rate = self._window_bytes / elapsed
+        self._window_start = now
+        self._window_bytes = 0
+        if rate >= self._best_rate:
+            self._best_rate = rate
+            self.size = min(self.size * 2, self._maximum)
+        elif rate < self._best_rate / 2:
+            self.size = max(self.size // 2, min(self.INITIAL, self._maximum))
+
+
+# based on twisted.protocols.basic.FileSender, but ask a RecordSizer how
+# much to read each time
+
+
+class FileSender(basic.FileSender):
+    def __init__(self, sizer):
+        self._sizer = sizer
+
+    def beginFileTransfer(self, file, consumer, transform=None):
+        def _observe(chunk):
+            self._sizer.sent(len(chunk))
+            if transform:
+                return transform(chunk)
+            return chunk
+
+        return basic.FileSender.beginFileTransfer(self, file, consumer,
+                                                  _observe)
+
+    def resumeProducing(self):
+        self.CHUNK_SIZE = self._sizer.size
+        basic.FileSender.resumeProducing(self)
+
+    def stopProducing(self):
+        # our Connection was lost before we finished
+        if self.deferred:
+            self.deferred.errback(TransitClosed("connection lost"))
+            self.deferred = None
+
+
+@implementer(interfaces.IPushProducer)
+class ThreadedFileSender(object):
+    """I am like FileSender, for a file whose reads can block (like a pipe
+    from another program). Each read happens by way of 'run' (which calls
+    a function on a thread, and returns a Deferred), one at a time, and
+    none start while the transport has paused me, so I never hold more
+    than one record of the file."""
+
+    def __init__(self, run, sizer):
+        self._run = run
+        self._sizer = sizer
+        self._paused = False
+        self._reading = False
+        self.deferred = None
+
+    def beginFileTransfer(self, file, consumer, transform=None):
+        self._file = file
+        self._consumer = consumer
+        self._transform = transform
+        self.deferred = defer.Deferred()
+        consumer.registerProducer(self, True)
+        self._read()
+        return self.deferred
+
+    def _read(self):
+        if self._paused or self._reading or self.deferred is None:
+            return
+        self._reading = True
+        d = self._run(self._file.read, self._sizer.size)
+        d.addCallbacks(self._got, self._failed)
+
+    def _got(self, chunk):
+        self._reading = False
+        if self.deferred is None:
+            return  # (we were stopped)
+        if not chunk:
+            self._consumer.unregisterProducer()
+            d, self.deferred = self.deferred, None
+            d.callback(None)
+            return
+        self._sizer.sent(len(chunk))
+        if self._transform:
+            chunk = self._transform(chunk)
+        self._consumer.write(chunk)
+        self._read()
+
+    def _failed(self, f):
+        self._reading = False
+        if self.deferred is None:
+            return
+        self._consumer.unregisterProducer()
+        d, self.deferred = self.deferred, None
+        d.errback(f)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._read()
+
+    def stopProducing(self):
+        # our Connection was lost before we finished
+        if self.deferred:
+            d, self.deferred = self.deferred, None
+            d.errback(TransitClosed("connection lost"))
+
+
 # based on twisted.protocols.ftp.FileConsumer, but don't close the filehandle
 # when done, and add a progress function that gets called with the length of
 # each write, and a hasher function that gets called with the data.
@@ -1020,6 +2287,360 @@ class FileConsumer:
         self._producer = None
 
 
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer(object):
+    """I am like FileConsumer, for a file whose writes can block (like a
+    pipe to another program). Each write happens by way of 'run' (which
+    calls a function on a thread, and returns a Deferred), in order, and is
+    flushed, so the other program sees it right away. While more than
+    'depth' writes are waiting, my producer is paused, so the rest wait in
+    our peer's buffers instead of our memory. If a write fails, I stop the
+    producer, and ignore any more data. when_flushed() fires once
+    everything has been written (or errbacks with the failed write)."""
+
+    def __init__(self, run, f, progress=None, hasher=None, depth=4):
+        self._run = run
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._depth = depth
+        self._producer = None
+        self._paused = False
+        self._pending = deque()
+        self._writing = False
+        self._failure = None
+        self._waiting = []
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        assert streaming
+        self._producer = producer
+
+    def unregisterProducer(self):
+        assert self._producer
+        # (the connection will still be needed for the ack)
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+        self._producer = None
+
+    def write(self, data):
+        if self._failure is not None:
+            return
+        if self._hasher:
+            self._hasher(data)
+        self._pending.append(data)
+        if (len(self._pending) > self._depth and self._producer and
+                not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+        self._write_next()
+
+    def _write_and_flush(self, data):
+        self._f.write(data)
+        self._f.flush()
+
+    def _write_next(self):
+        if self._writing:
+            return
+        if not self._pending:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+            return
+        data = self._pending.popleft()
+        if self._paused and len(self._pending) <= self._depth // 2:
+            self._paused = False
+            self._producer.resumeProducing()
+        self._writing = True
+        d = self._run(self._write_and_flush, data)
+        d.addCallbacks(self._wrote, self._failed, callbackArgs=(len(data), ))
+
+    def _wrote(self, _, length):
+        self._writing = False
+        if self._progress:
+            self._progress(length)
+        self._write_next()
+
+    def _failed(self, f):
+        self._writing = False
+        self._failure = f
+        self._pending.clear()
+        if self._producer:
+            self._producer.stopProducing()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(f)
+
+    def when_flushed(self):
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if not self._writing and not self._pending:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+
+@implementer(interfaces.IConsumer)
+class _StreamConsumer(object):
+    # I pass records to 'consumer' until an empty one marks the end
+    def __init__(self, connection, consumer):
+        self._connection = connection
+        self._consumer = consumer
+        self._received = 0
+        self.deferred = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def write(self, record):
+        if self.deferred.called:
+            return
+        if not record:
+            self._connection.disconnectConsumer()
+            self.deferred.callback(self._received)
+            return
+        self._consumer.write(record)
+        self._received += len(record)
+
+    def connectionLost(self, connection):
+        if not self.deferred.called:
+            self.deferred.errback(error.ConnectionClosed())
+
+
+# When a transfer is striped, each record carries the offset of its data,
+# since records from different stripes can arrive in any order.
+OFFSET = struct.Struct(">Q")
+
+
+@implementer(interfaces.IPullProducer)
+class _StripeProducer(object):
+    def __init__(self, sender, connection, sizer):
+        self._sender = sender
+        self._connection = connection
+        self._sizer = sizer
+
+    def resumeProducing(self):
+        chunk = self._sender._read(self._sizer.size)
+        if chunk is None:
+            self._connection.unregisterProducer()
+            self._sender._stripe_finished()
+            return
+        (offset, data) = chunk
+        self._sizer.sent(len(data))
+        self._connection.write(OFFSET.pack(offset) + data)
+
+    def stopProducing(self):
+        # the stripe was lost. That only matters if it had more to send.
+        self._sender._stripe_lost()
+
+
+class StripedFileSender(object):
+    """I send a file across several Connections (stripes) at once. Each
+    stripe pulls records whenever its transport wants more, so the faster
+    connections carry more of the file. The file is still read from start to
+    finish (starting wherever 'f' is positioned), so 'transform' (like the
+    one given to Connection.sendFile) sees it in order. Add stripes with
+    add_stripe(), then wait for when_done() to fire, which happens when the
+    rest of the file has been handed to them.
+
+    If 'stream' is True, the receiver doesn't know how big the file is, so
+    the stripe that finds the end of it sends an empty record with the
+    offset of the end.
+    """
+
+    def __init__(self, f, transform=None, stream=False):
+        self._f = f
+        self._transform = transform
+        self._stream = stream
+        self._offset = f.tell()
+        self._eof = False
+        self._sending = 0
+        self.stripes = []
+        self._deferred = defer.Deferred()
+
+    def add_stripe(self, connection):
+        self.stripes.append(connection)
+        if self._eof or self._deferred.called:
+            return  # nothing left for it to carry
+        maximum = connection.owner._max_record_size()
+        if maximum is not None:
+            maximum -= OFFSET.size
+        producer = _StripeProducer(self, connection, RecordSizer(maximum))
+        self._sending += 1
+        connection.registerProducer(producer, False)
+
+    def when_done(self):
+        return self._deferred
+
+    def _read(self, size):
+        if self._eof or self._deferred.called:
+            return None
+        data = self._f.read(size)
+        if not data:
+            self._eof = True
+            if self._stream:
+                return (self._offset, b"")  # the end marker
+            return None
+        offset = self._offset
+        self._offset += len(data)
+        if self._transform:
+            data = self._transform(data)
+        return (offset, data)
+
+    def _stripe_finished(self):
+        self._sending -= 1
+        if self._eof and not self._sending and not self._deferred.called:
+            self._deferred.callback(None)
+
+    def _stripe_lost(self):
+        if self._eof:
+            # everything has been written, so this stripe was idle
+            self._stripe_finished()
+            return
+        if not self._deferred.called:
+            self._deferred.errback(TransitClosed("connection lost"))
+
+    def close(self):
+        for connection in self.stripes:
+            connection.close()
+
+
+@implementer(interfaces.IConsumer)
+class _StripeConsumer(object):
+    def __init__(self, receiver):
+        self._receiver = receiver
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+
+    def write(self, record):
+        self._receiver._write(record)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class StripedFileConsumer(object):
+    """I receive a file that a StripedFileSender is sending across several
+    stripes, writing each record at its offset in 'f'. I fire when_done()
+    (with the number of bytes received) when I have all 'expected' bytes,
+    or errback if a stripe is lost before then.
+
+    'progress' and 'hasher' work like they do for Connection.writeToFile(),
+    and the hasher still sees the file in order: data that arrives ahead of
+    a gap is read back from 'f' once the gap is filled (it will usually
+    still be in the page cache), so 'f' must be open for reading as well as
+    writing. If the sender started partway into the file, 'offset' says
+    where, and the 'expected' bytes are the ones that follow it. If
+    'expected' is None, the sender will tell us where the file ends, with
+    an empty record.
+    """
+
+    def __init__(self, f, expected, progress=None, hasher=None, offset=0):
+        self._f = f
+        self._expected = None  # where the file ends
+        if expected is not None:
+            self._expected = offset + expected
+        self._progress = progress
+        self._hasher = hasher
+        self._start = offset
+        self._hashed = offset  # the hasher has seen everything before this
+        self._ahead = {}  # offset -> length, written but not yet hashed
+        self.stripes = []
+        self._deferred = defer.Deferred()
+        if expected == 0:
+            self._deferred.callback(0)
+
+    def add_stripe(self, connection):
+        consumer = _StripeConsumer(self)
+        self.stripes.append((connection, consumer))
+        if self._deferred.called:
+            return
+        connection.when_closed().addCallback(self._stripe_lost)
+        connection.connectConsumer(consumer)
+
+    def when_done(self):
+        return self._deferred
+
+    def get_offset(self):
+        """Return how much of the file is in place: everything before this
+        offset has been written and hashed. After a stripe is lost, this is
+        where a resumed transfer should start."""
+        return self._hashed
+
+    def _write(self, record):
+        if self._deferred.called:
+            return
+        if len(record) < OFFSET.size:
+            self._finish(TransitError("short striped record"))
+            return
+        (offset, ) = OFFSET.unpack(record[:OFFSET.size])
+        data = record[OFFSET.size:]
+        if not data:
+            self._end_marker(offset)
+            return
+        if offset < self._hashed or (self._expected is not None and
+                                     offset + len(data) > self._expected):
+            self._finish(TransitError("striped record out of range: %d+%d"
+                                      % (offset, len(data))))
+            return
+        self._f.seek(offset)
+        self._f.write(data)
+        if self._progress:
+            self._progress(len(data))
+        if offset != self._hashed:
+            self._ahead[offset] = len(data)
+            return
+        if self._hasher:
+            self._hasher(data)
+        self._hashed += len(data)
+        while self._hashed in self._ahead:
+            length = self._ahead.pop(self._hashed)
+            if self._hasher:
+                self._f.seek(self._hashed)
+                self._hasher(self._f.read(length))
+            self._hashed += length
+        if self._hashed == self._expected:
+            self._f.seek(self._expected)
+            self._finish(None)
+
+    def _end_marker(self, offset):
+        ahead = [o + length for (o, length) in self._ahead.items()]
+        if (self._expected is not None or offset < self._hashed or
+                offset < max(ahead or [offset])):
+            self._finish(TransitError("bad end of striped stream: %d"
+                                      % (offset, )))
+            return
+        self._expected = offset
+        if self._hashed == self._expected:
+            self._f.seek(self._expected)
+            self._finish(None)
+
+    def _stripe_lost(self, connection):
+        if not self._deferred.called:
+            self._finish(error.ConnectionClosed())
+
+    def _finish(self, err):
+        for (connection, consumer) in self.stripes:
+            if consumer.producer is not None:
+                connection.disconnectConsumer()
+        if err is None:
+            self._deferred.callback(self._expected - self._start)
+        else:
+            self._deferred.errback(err)
+
+    def close(self):
+        for (connection, consumer) in self.stripes:
+            connection.close()
+
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer
@@ -1,9 +1,19 @@
 # No unicode_literals
+import hashlib
 import json
 import os
+import tempfile
+import threading
 import unicodedata
 from binascii import hexlify, unhexlify
 
+from six.moves import queue
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 
 def to_bytes(u):
     return unicodedata.normalize("NFC", u).encode("utf-8")
@@ -48,3 +58,202 @@ def estimate_free_space(target):
         return s.f_frsize * s.f_bfree
     except AttributeError:
         return None
+
+
+# The hashes that can cover a transferred file, in order of preference: the
+# sender lists the ones it has, and the receiver picks the first of those
+# that it has too. BLAKE3 is a tree hash, which spreads a big update() across
+# several threads. blake2b is next, since it's faster than sha256 in software,
+# and comes with every python3. sha256 is last, but it's what every version
+# can do (and it's faster than blake2b on CPUs with SHA extensions, which we
+# don't try to detect: the order is the same everywhere).
+HASH_ALGORITHMS = [u"blake3", u"blake2b", u"sha256"]
+
+_available_hashes = None
+
+
+def available_hash_algorithms():
+    global _available_hashes
+    if _available_hashes is None:
+        has_blake2b = hasattr(hashlib, "blake2b")
+        _available_hashes = [
+            a for a in HASH_ALGORITHMS
+            if not ((a == u"blake3" and blake3 is None) or
+                    (a == u"blake2b" and not has_blake2b))]
+    return list(_available_hashes)
+
+
+def choose_hash_algorithm(offered):
+    """Return the first of the 'offered' hash names that we can do, or None
+    if there aren't any."""
+    available = available_hash_algorithms()
+    for name in offered:
+        if name in available:
+            return name
+    return None
+
+
+def new_hasher(name):
+    """Return a new hashlib-style object for the named algorithm."""
+    if name not in available_hash_algorithms():
+        raise ValueError("unknown hash algorithm %r" % (name, ))
+    if name == u"blake3":
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.new(str(name))
+
+
+def hash_file_prefix(f, length, hasher, chunk_size=256 * 1024,
+                     progress=None):
+    """Feed the first 'length' bytes of 'f' to 'hasher' (a hashlib object),
+    leaving 'f' positioned just after them. Returns the number of bytes that
+    were hashed, which is less than 'length' if 'f' is shorter than that.
+    If given, progress() is called with the size of each piece hashed."""
+    f.seek(0)
+    remaining = length
+    while remaining:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            break
+        hasher.update(data)
+        remaining -= len(data)
+        if progress:
+            progress(len(data))
+    return length - remaining
+
+
+class ThreadedHasher(object):
+    """I look like a hashlib object, but update() hands its data to a thread
+    that does the hashing (hashlib lets go of the GIL for anything over
+    2KiB), so the caller only waits when that thread falls more than
+    'backlog' updates behind. digest() waits for it to catch up. close()
+    stops the thread, after which digest() still works.
+    """
+
+    def __init__(self, hasher, backlog=64):
+        self._hasher = hasher
+        self._queue = queue.Queue(backlog)
+        self._thread = None
+
+    def update(self, data):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="wormhole-hasher")
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(data)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is not None:
+                self._hasher.update(data)
+            self._queue.task_done()
+            if data is None:
+                break
+
+    def digest(self):
+        self._queue.join()
+        return self._hasher.digest()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class _Task(object):
+    # a function call, which some thread will run(), and whose result()
+    # can be waited for
+    def __init__(self, f, args, inline):
+        self._f = f
+        self._args = args
+        self._inline = inline
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self._f(*self._args)
+        except BaseException as e:
+            self._error = e
+        self._done.set()
+
+    def result(self):
+        if self._inline and not self._done.is_set():
+            self.run()
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class WorkerPool(object):
+    """I run tasks on 'jobs' threads: submit() returns a task whose result()
+    waits for it (and raises whatever it raised). zlib and hashlib let go of
+    the GIL while they work, so compressing or hashing several chunks at
+    once really does use several CPUs. With jobs=1, each task is run by
+    whoever asks for its result. close() stops the threads once they've
+    finished what they're doing.
+    """
+
+    def __init__(self, jobs):
+        self._queue = queue.Queue()
+        self._closed = False
+        self._threads = []
+        if jobs > 1:
+            for i in range(jobs):
+                t = threading.Thread(
+                    target=self._work, name="wormhole-worker-%d" % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, f, *args):
+        task = _Task(f, args, inline=not self._threads)
+        if self._threads:
+            self._queue.put(task)
+        return task
+
+    def _work(self):
+        while not self._closed:
+            task = self._queue.get()
+            if task is None:
+                break
+            task.run()
+
+    def close(self):
+        self._closed = True
+        for t in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+
+class SpoolFile(tempfile.SpooledTemporaryFile):
+    """A SpooledTemporaryFile that moves to disk (in 'dir', or the usual
+    temp directory) once it holds more than 'max_size' bytes, and remembers
+    the most it ever held in memory (as .peak_memory), for the timing data.
+    """
+
+    def __init__(self, max_size, dir=None):
+        # (py2's SpooledTemporaryFile is an old-style class: no super())
+        tempfile.SpooledTemporaryFile.__init__(
+            self, max_size=max_size, dir=dir)
+        self.peak_memory = 0
+
+    @property
+    def rolled(self):
+        return self._rolled
+
+    def write(self, s):
+        if not self._rolled:
+            # it only rolls over once a write takes it past max_size
+            end = max(self.tell() + len(s), self.peak_memory)
+            self.peak_memory = end
+        return tempfile.SpooledTemporaryFile.write(self, s)
+
+    def seekable(self):
+        # https://bugs.python.org/issue26175 (STF doesn't fully implement
+        # IOBase), which breaks the zipfile in py3.7.0, which expects this
+        return True